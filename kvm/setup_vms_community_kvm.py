@@ -1,125 +1,27 @@
 #!/usr/bin/python
 
 '''Quick and Dirty script to setup the community edition of VMS/X86
-   so that I can log in with DECNET and SSH to complete it.'''
+   so that I can log in with DECNET and SSH to complete it.
 
-import logging
-import os
-import re
-import sys
-from time import sleep
-import libvirt     # type: ignore
+   With --fleet, every target listed in a JSON fleet file is set up
+   concurrently from this one process.  With --save-golden the result
+   is saved as a golden image that --golden clones new nodes from.'''
 
-logger = logging.getLogger(__name__)
+from vms_kvm_dialogue import Phase, Profile, main
+from vms_kvm_fleet import Target, to_bytes
 
-# System specific data
-# pylint: disable=invalid-name
-host_url = 'qemu:///system'
-
-# target specific information
-# pylint: disable=invalid-name
-target_name = "robin"
-# pylint: disable=invalid-name
-target_root = b"sys0"
-# pylint: disable=invalid-name
-target_name_upper_str = target_name.upper()
-# pylint: disable=invalid-name
-target_scsnode = target_name.encode('utf-8', 'replace')
-# pylint: disable=invalid-name
-target_decnet_area_int = 1
-# pylint: disable=invalid-name
-target_decnet_number_int = 13
-# pylint: disable=invalid-name
-target_scssystemid_int = \
-    target_decnet_area_int * 1024 + target_decnet_number_int
-# pylint: disable=invalid-name
-target_decnet_area = str(target_decnet_area_int).encode('utf-8', 'replace')
-# pylint: disable=invalid-name
-target_decnet_number = str(target_decnet_number_int).encode('utf-8', 'replace')
-# pylint: disable=invalid-name
-target_scssystemid = str(target_scssystemid_int).encode('utf-8', 'replace')
-# pylint: disable=invalid-name
-target_domain = b'xile.realm'
-# pylint: disable=invalid-name
-target_gateway_address = b'192.168.0.201'
-# pylint: disable=invalid-name
-target_gateway_hostname = b'wap.xile.realm'
-# pylint: disable=invalid-name
-target_bind_server = b'eagle.xile.realm'
-# pylint: disable=invalid-name
-target_bind_address = b'192.168.0.2'
-
-target_env_password = 'VMS_PASSWORD'
-if target_env_password in os.environ:
-    target_password_str = os.environ[target_env_password]
-    target_password = target_password_str.encode('utf-8', 'replace')
-else:
-    logger.error('Need %s environment set!', target_env_password)
-    sys.exit(1)
-
-# Some code from:
-# https://github.com/libvirt/
-# libvirt-python/blob/master/examples/consolecallback.py
-
-
-def error_handler(_unused, error) -> None:
-    ''' Error Handler. '''
-    # The console stream errors on VM shutdown; we don't care
-    if error[0] == libvirt.VIR_ERR_RPC and error[1] == libvirt.VIR_FROM_STREAMS:
-        return
-    logging.warning(error)
-
-
-# pylint: disable=too-many-instance-attributes, too-few-public-methods
-class Console():
-    ''' Class Console '''
-    def __init__(self, uri: str, name: str) -> None:
-        self.uri = uri
-        self.name = name
-        libvirt.virEventRegisterDefaultImpl()
-        self.connection = libvirt.open(uri)
-        self.domain = self.connection.lookupByName(self.name)
-        self.state = self.domain.state(0)
-        if self.state[0] != libvirt.VIR_DOMAIN_RUNNING:
-            self.domain.create()
-            self.state = self.domain.state(0)
-        self.connection.domainEventRegister(lifecycle_callback, self)
-        self.stream = None  # Optional [libvirt.virStream]
-        self.run_console = True
-        self.stdin_watch = -1
-        self.ring_index = 0
-        self.ring_max = 10
-        self.ring_buffer = ()
-        self.current_string = ''
-        self.reboot = False
-        self.prompt_index = {}
-        for prompt in PROMPT_ACTIONS:
-            if prompt[1] not in self.prompt_index:
-                self.prompt_index[prompt[1]] = 0
-        print(f'prompt_index = {self.prompt_index}')
-
-        logging.info("%s initial state %d, reason %d",
-                     self.name, self.state[0], self.state[1])
-
-
-def check_console(console: Console) -> bool:
-    ''' Check console. '''
-    if (console.state[0] == libvirt.VIR_DOMAIN_RUNNING or \
-       console.state[0] == libvirt.VIR_DOMAIN_PAUSED):
-        if console.stream is None:
-            console.stream = console.connection.newStream(
-                libvirt.VIR_STREAM_NONBLOCK)
-            console.domain.openConsole(None, console.stream, 0)
-            console.stream.eventAddCallback(libvirt.VIR_STREAM_EVENT_READABLE,
-                                            stream_callback, console)
-            print("Created console stream")
-    else:
-        if console.stream:
-            print("Destroyed console stream")
-            console.stream.eventRemoveCallback()
-            console.stream = None
-
-    return console.run_console
+# Default target specific information, fleet files can override any
+# of these for each target.
+TARGET_DEFAULTS = {
+    'name': 'robin',
+    'root': 'sys0',
+    'decnet_area': 1,
+    'decnet_number': 13,
+    'domain': 'xile.realm',
+    'gateway_address': '192.168.0.201',
+    'gateway_hostname': 'wap.xile.realm',
+    'bind_server': 'eagle.xile.realm',
+    'bind_address': '192.168.0.2'}
 
 
 ESC_ACTIONS = [
@@ -129,7 +31,7 @@ ESC_ACTIONS = [
 
 BOOTMGR_ACTIONS = [
     b'AUTO BOOT',
-    b'AUTO 5',
+    b'AUTO 1',      # Shortest auto-boot countdown.
     b'FLAGS 0',
     b'BOOT DKA0 0 1',
     b'FLAGS 0',
@@ -140,41 +42,14 @@ BOOTMGR_ACTIONS = [
 SYSBOOT_ACTIONS = [
     b'SET/STARTUP OPA0:',
     b'SET WINDOW_SYSTEM 0',
-    b'SET WRITESYSPARAMS 0',
-    b'CONTINUE',
-    b'CONTINUE'
-    ]
-
+    b'SET WRITESYSPARAMS 0']
 
-DOLLAR_ACTIONS = [
-    b'SET DEF SYS$SYSTEM:',
-    b'RUN SYS$SYSTEM:AUTHORIZE',
-    b'SPAWN',
-    b'@SYS$SYSTEM:STARTUP.COM',
-    b'open/append mpd sys$system:modparams.dat',
-    b'write mpd "SCSNODE="""' + target_scsnode + b'""',
-    b'write mpd "SCSSYSTEMID="' + target_scssystemid,
-    b'close mpd',
-    b'set noverify',
-    b'@sys$update:autogen GETDATA SETPARAMS',
-    b'mcr sysman shutdown node /auto /min=0',
-    b'wait 00:10',
-    b'@sys$manager:net$configure',
-    b'show network',
-    b'@sys$manager:tcpip$config',
-    b'show network',
-    b'mcr sysman shutdown node /auto /min=0',
-    b'wait 00:10',
-    b'show network',
-    b'@sys$startup:ssh$startup.com']
 
 DECNET_OPTION_ACTIONS = [b'0']
+CLONE_DECNET_OPTION_ACTIONS = [
+    b'2',   # Change naming information
+    b'0']   # Exit
 DECNET_DOMAIN_ACTIONS = [b'local']
-DECNET_LOCAL_ACTIONS = [b'LOCAL:.' + target_scsnode]
-
-UAF_ACTIONS = [
-    b'MODIFY SYSTEM/NOPWDEXP/NOPWDLIFE/PASS="' + target_password + B'"',
-    b'EXIT']
 
 INTSET_ACTIONS = [
     b'',
@@ -183,14 +58,6 @@ INTSET_ACTIONS = [
 
 USERNAME_ACTIONS = [ b'SYSTEM' ]
 
-PASSWORD_ACTIONS = [
-    target_password,
-    target_password,
-    target_password,
-    target_password,
-    target_password,
-    ]
-
 TCPIP_CONFIG_ACTIONS = [
     b'1',   # Select Core
     b'1',   # Domain
@@ -211,149 +78,217 @@ TCPIP_CONFIG_ACTIONS = [
     b'E'    # exit config
 ]
 
-TCPIP_NODE_MANAGE_ACTIONS = [ target_scsnode ]
-TCPIP_DOMAIN_ACTIONS = [ target_domain ]
-TCPIP_GATEWAY_ADDRESS_ACTIONS = [ target_gateway_address ]
-TCPIP_GATEWAY_HOSTNAME_ACTIONS = [ target_gateway_hostname ]
-TCPIP_BIND_SERVER_ACTIONS = [ target_bind_server, b'' ]
-TCPIP_BIND_ADDRESS_ACTIONS = [ target_bind_address ]
 TCPIP_SYSTEM_DEVICE_ACTIONS = [ b'sys$sysdevice:']
-TCPIP_SYSTEM_ROOT_ACTIONS = [ target_root ]
 
 YES_ACTIONS = [ b'YES' ]
 ZERO_ACTIONS = [ b'0' ]
 DEFAULT_ACTIONS = [ b'', b'' ]
 
-PROMPT_ACTIONS = [
-    ('Press <ESC>', 'ESC', ESC_ACTIONS),
-    ('BOOTMGR> ', 'BOOTMGR', BOOTMGR_ACTIONS),
-    ('SYSBOOT> ', 'SYSBOOT', SYSBOOT_ACTIONS),
-    ('\r\n\x00$ ', 'DOLLAR', DOLLAR_ACTIONS),
-    ('\r\x00$ ', 'DOLLAR', DOLLAR_ACTIONS),
-    ('UAF> ', 'UAF', UAF_ACTIONS),
-    ('job terminated at ', 'INTSET', INTSET_ACTIONS),
-    ('\r\nUsername: ', 'USERNAME', USERNAME_ACTIONS),
-    ('\n\rUsername: ', 'USERNAME', USERNAME_ACTIONS),
-    ('\r\nPassword: ', 'PASSWORD', PASSWORD_ACTIONS),
-    ('\n\rPassword: ', 'PASSWORD', PASSWORD_ACTIONS),
-    ('Do you wish to shutdown the network ? ', 'DECNET_SHUTDOWN', YES_ACTIONS),
-    ('Minutes till network shutdown ? ', 'DECNET_MINUTES', ZERO_ACTIONS),
-    ('configuration option to perform? ', 'DECNET_OPTION',
-      DECNET_OPTION_ACTIONS),
-    (',Domain] : ', 'DECNET_DOMAIN', DECNET_DOMAIN_ACTIONS),
-    ('LOCAL    ', 'DECNET_LOCAL', DECNET_LOCAL_ACTIONS),
-    (f'[{target_name_upper_str}] : ', 'DECNET_SYNONYM', DEFAULT_ACTIONS),
-    ('[ENDNODE] : ', 'DECNET_ENDNODE', DEFAULT_ACTIONS),
-    (f' [{target_decnet_area_int}.{target_decnet_number_int}] : ',
-     'DECNET_PHASE4', DEFAULT_ACTIONS),
-    ('Load MOP on this system? ', 'DECNET_MOP', DEFAULT_ACTIONS),
-    ('apply this configuration? ', 'DECNET_APPLY', DEFAULT_ACTIONS),
-    ('scripts? ', 'DECNET_SCRIPTS', DEFAULT_ACTIONS),
-    ('network? ', 'DECNET_START', DEFAULT_ACTIONS),
-    ('configuration option: ', 'TCPIP_CONFIG', TCPIP_CONFIG_ACTIONS),
-    ('Enter name of node to manage ', 'TCPIP_NODE_MANAGE',
-     TCPIP_NODE_MANAGE_ACTIONS),
-    ('Enter system device for ', 'TCPIP_SYSTEM_DEVICE',
-     TCPIP_SYSTEM_DEVICE_ACTIONS),
-    ('Enter system root for ', 'TCPIP_SYSTEM_ROOT',
-     TCPIP_SYSTEM_ROOT_ACTIONS),
-    ('Enter Internet domain','TCPIP_DOMAIN', TCPIP_DOMAIN_ACTIONS),
-    ('domain on live system [NO]: ', 'TCPIP_LIVE_DOMAIN', DEFAULT_ACTIONS),
-    ('DHCP PRIMARY? (Y,N,HELP)', 'TCPIP_DHCP_PRIMARY', DEFAULT_ACTIONS),
-    ('Do you want to configure dynamic ROUTED or GATED ', 'TCPIP_ROUTING',
-     DEFAULT_ACTIONS),
-    ('configure a default route [YES]: ', 'TCPIP_ROUTED2', DEFAULT_ACTIONS),
-    ('host name or address: ', 'TCPIP_GATEWAY_ADDRESS',
-     TCPIP_GATEWAY_ADDRESS_ACTIONS),
-    ('Enter the Default Gateway host name ', 'TCPIP_GATEWAY_HOSTNAME',
-     TCPIP_GATEWAY_HOSTNAME_ACTIONS),
-    ('Do you want to reconfigure BIND [NO]: ', 'TCPIP_BIND_RECONFIGURE',
-     DEFAULT_ACTIONS),
-    ('BIND server name: ', 'TCPIP_BIND_SERVER', TCPIP_BIND_SERVER_ACTIONS),
-    ('Enter Internet address for ', 'TCPIP_BIND_ADDRESS',
-     TCPIP_BIND_ADDRESS_ACTIONS),
-    ('Press <ENTER> key to continue', 'TCPIP_BIND_ERROR', DEFAULT_ACTIONS)
-    ]
-
-
-def prompt_handler(console: Console, prompt: tuple):
-    ''' Prompt Handler '''
-    if console.stream:
-        num_cmds = len(prompt[2])
-        prompt_index = console.prompt_index[prompt[1]]
-        if prompt_index >= num_cmds:
-            logging.info(
-              "Unexpected Prompt %s %s > %s ",
-              prompt[1], prompt_index, num_cmds)
-            if prompt[1] == 'DOLLAR':
-                print('\n\nConfiguration complete.\n')
-                sys.exit(0)
-            return
-        cmd = prompt[2][prompt_index] + b'\r'
-        if prompt[1] == 'INTSET':
-            print("reboot seen")
-            console.reboot = True
-            sleep(10)
-            console.stream.send(cmd)
-        elif prompt[1] == 'USERNAME':
-            if console.reboot:
-                console.stream.send(cmd)
-                console.reboot = False
-        else:
-            console.prompt_index[prompt[1]] += 1
-            console.stream.send(cmd)
-        # if prompt[1] == 'USERNAME':
-        #     print("--------------------------------------------")
-        #     print("Username: seen")
-        #     print("--------------------------------------------")
-
-
-def stream_callback(_stream: libvirt.virStream,
-                    _events: int, console: Console) -> None:
-    ''' Stream Callback. '''
-    try:
-        assert console.stream
-        # Add current capture to current buffer
-        new_data = console.stream.recv(1024)
-        # print(f'-{new_data}-')
-        new_string = new_data.decode('utf-8', 'replace')
-        os.write(0, new_data)
-        console.current_string += new_string
-
-        for prompt in PROMPT_ACTIONS:
-            if prompt[0] in console.current_string:
-                parts = re.split(prompt[0], console.current_string, maxsplit=1)
-                if len(parts) > 1:
-                    console.current_string = parts[1]
-                else:
-                    console.current_string = ''
-                prompt_handler(console, prompt)
-
-    # pylint: disable=broad-exception-caught
-    except Exception as exp:
-        logging.info("stream_callback exception %s", exp, exc_info=True)
-
-
-def lifecycle_callback(_connection: libvirt.virConnect,
-                       _domain: libvirt.virDomain,
-                       _event: int, _detail: int, console: Console) -> None:
-    ''' Life cycle callback. '''
-    console.state = console.domain.state(0)
-    logging.info("%s transitioned to state %d, reason %d",
-                 console.uuid, console.state[0], console.state[1])
-
-
-
-def main():
-    ''' Main. '''
-    logging.basicConfig(level=logging.INFO)
-    console = Console(host_url, target_name)
-    try:
-        while check_console(console):
-            libvirt.virEventRunDefaultImpl()
-    except KeyboardInterrupt:
-        pass
+# Watchdog seconds without a prompt in the phases that run long.
+LONG_PHASE_TIMEOUT = 1800.0
+
+
+def build_profile(target: Target, clone: bool = False,
+                  power_off: bool = False) -> Profile:
+    ''' Build the setup dialogue for one target.
+
+        The node identity, DECnet and TCP/IP are all configured on the
+        first boot and take effect with the one AUTOGEN and reboot at
+        the end.  A clone of a golden image boots straight to the login
+        prompt, so it only has its node identity changed: the new
+        SCSNODE and SCSSYSTEMID take effect with AUTOGEN and a reboot,
+        then only the DECnet naming and the TCP/IP domain are changed,
+        without running the full menus again.  With power_off the
+        system is shut down at the end, ready to be saved as a golden
+        image.  The MODPARAMS.DAT entries of a tuning profile are
+        written along with the identity, before AUTOGEN.'''
+    # pylint: disable=too-many-locals
+    modparams = target.modparams or {}
+    tuning_actions = [b'write mpd "' + to_bytes(f'{name}={value}') + b'"'
+                      for name, value in modparams.items()]
+    esc_actions = ESC_ACTIONS
+    decnet_option_actions = DECNET_OPTION_ACTIONS
+    bootmgr_actions = BOOTMGR_ACTIONS
+    # The node identity is made active for the first boot as well, so
+    # NET$CONFIGURE offers the node's own synonym and Phase IV address.
+    sysboot_actions = SYSBOOT_ACTIONS + [
+        b'SET SCSNODE "' + target.scsnode.upper() + b'"',
+        b'SET SCSSYSTEMID ' + target.scssystemid,
+        b'CONTINUE',
+        b'CONTINUE']
+    dollar_actions = [
+        b'SET DEF SYS$SYSTEM:',
+        b'RUN SYS$SYSTEM:AUTHORIZE',
+        b'SPAWN',
+        b'@SYS$SYSTEM:STARTUP.COM',
+        b'open/append mpd sys$system:modparams.dat',
+        b'write mpd "SCSNODE="""' + target.scsnode + b'""',
+        b'write mpd "SCSSYSTEMID="' + target.scssystemid] + tuning_actions + [
+        b'close mpd',
+        b'set noverify',
+        b'@sys$manager:net$configure',
+        b'show network',
+        b'@sys$manager:tcpip$config',
+        b'show network',
+        b'@sys$update:autogen GETDATA SETPARAMS',
+        b'mcr sysman shutdown node /auto /min=0',
+        b'wait 00:10',
+        b'show network',
+        b'@sys$startup:ssh$startup.com']
+
+    if clone:
+        esc_actions = []
+        bootmgr_actions = []
+        sysboot_actions = []
+        # Drop the entries of the golden image that are written again.
+        replaced = b','.join(b'"' + to_bytes(name) + b'"' for name in
+                             ['SCSNODE', 'SCSSYSTEMID'] + list(modparams))
+        dollar_actions = [
+            b'SET DEF SYS$SYSTEM:',
+            b'search/match=nor/output=sys$system:modparams.dat'
+            b' sys$system:modparams.dat ' + replaced,
+            b'open/append mpd sys$system:modparams.dat',
+            b'write mpd "SCSNODE="""' + target.scsnode + b'""',
+            b'write mpd "SCSSYSTEMID="' + target.scssystemid] + \
+            tuning_actions + [
+            b'close mpd',
+            # The new identity is active after this reboot, so the
+            # DECnet and TCP/IP changes below already see it.
+            b'@sys$update:autogen GETDATA SETPARAMS',
+            b'mcr sysman shutdown node /auto /min=0',
+            b'wait 00:10',
+            b'@sys$manager:net$configure',
+            b'show network',
+            # The DHCP client takes its host name from SCSNODE, only
+            # the domain needs to be set.
+            b'tcpip set configuration name_service /domain=' +
+            target.domain,
+            b'show network',
+            b'@sys$startup:ssh$startup.com']
+        decnet_option_actions = CLONE_DECNET_OPTION_ACTIONS
+    if power_off:
+        dollar_actions = dollar_actions + [
+            b'mcr sysman shutdown node /min=0 /power_off']
+
+    decnet_local_actions = [b'LOCAL:.' + target.scsnode]
+    decnet_synonym_actions = [target.scsnode.upper()] * 2
+    decnet_phase4_actions = [target.decnet_area + b'.' +
+                             target.decnet_number] * 2
+
+    uaf_actions = [
+        b'MODIFY SYSTEM/NOPWDEXP/NOPWDLIFE/PASS="' + target.password + B'"',
+        b'EXIT']
+
+    password_actions = [
+        target.password,
+        target.password,
+        target.password,
+        target.password,
+        target.password,
+        ]
+
+    tcpip_node_manage_actions = [ target.scsnode ]
+    tcpip_domain_actions = [ target.domain ]
+    tcpip_gateway_address_actions = [ target.gateway_address ]
+    tcpip_gateway_hostname_actions = [ target.gateway_hostname ]
+    tcpip_bind_server_actions = [ target.bind_server, b'' ]
+    tcpip_bind_address_actions = [ target.bind_address ]
+    tcpip_system_root_actions = [ target.root ]
+
+    firmware = [('Press <ESC>', 'ESC', esc_actions)]
+    bootmgr = [('BOOTMGR> ', 'BOOTMGR', bootmgr_actions)]
+    sysboot = [('SYSBOOT> ', 'SYSBOOT', sysboot_actions)]
+    dcl = [
+        ('\r\n\x00$ ', 'DOLLAR', dollar_actions),
+        ('\r\x00$ ', 'DOLLAR', dollar_actions)]
+    uaf = [('UAF> ', 'UAF', uaf_actions)]
+    login = [
+        ('job terminated at ', 'INTSET', INTSET_ACTIONS),
+        ('\r\nUsername: ', 'USERNAME', USERNAME_ACTIONS),
+        ('\n\rUsername: ', 'USERNAME', USERNAME_ACTIONS),
+        ('\r\nPassword: ', 'PASSWORD', password_actions),
+        ('\n\rPassword: ', 'PASSWORD', password_actions)]
+    decnet = [
+        ('Do you wish to shutdown the network ? ', 'DECNET_SHUTDOWN',
+         YES_ACTIONS),
+        ('Minutes till network shutdown ? ', 'DECNET_MINUTES', ZERO_ACTIONS),
+        ('configuration option to perform? ', 'DECNET_OPTION',
+         decnet_option_actions),
+        (',Domain] : ', 'DECNET_DOMAIN', DECNET_DOMAIN_ACTIONS),
+        ('LOCAL    ', 'DECNET_LOCAL', decnet_local_actions),
+        (f'[{target.scsnode_str.upper()}] : ', 'DECNET_SYNONYM',
+         decnet_synonym_actions),
+        ('[ENDNODE] : ', 'DECNET_ENDNODE', DEFAULT_ACTIONS),
+        (f' [{target.decnet_area_int}.{target.decnet_number_int}] : ',
+         'DECNET_PHASE4', decnet_phase4_actions),
+        ('Load MOP on this system? ', 'DECNET_MOP', DEFAULT_ACTIONS),
+        ('apply this configuration? ', 'DECNET_APPLY', DEFAULT_ACTIONS),
+        ('scripts? ', 'DECNET_SCRIPTS', DEFAULT_ACTIONS),
+        ('network? ', 'DECNET_START', DEFAULT_ACTIONS)]
+    tcpip = [
+        ('configuration option: ', 'TCPIP_CONFIG', TCPIP_CONFIG_ACTIONS),
+        ('Enter name of node to manage ', 'TCPIP_NODE_MANAGE',
+         tcpip_node_manage_actions),
+        ('Enter system device for ', 'TCPIP_SYSTEM_DEVICE',
+         TCPIP_SYSTEM_DEVICE_ACTIONS),
+        ('Enter system root for ', 'TCPIP_SYSTEM_ROOT',
+         tcpip_system_root_actions),
+        ('Enter Internet domain','TCPIP_DOMAIN', tcpip_domain_actions),
+        ('domain on live system [NO]: ', 'TCPIP_LIVE_DOMAIN',
+         DEFAULT_ACTIONS),
+        ('DHCP PRIMARY? (Y,N,HELP)', 'TCPIP_DHCP_PRIMARY', DEFAULT_ACTIONS),
+        ('Do you want to configure dynamic ROUTED or GATED ',
+         'TCPIP_ROUTING', DEFAULT_ACTIONS),
+        ('configure a default route [YES]: ', 'TCPIP_ROUTED2',
+         DEFAULT_ACTIONS),
+        ('host name or address: ', 'TCPIP_GATEWAY_ADDRESS',
+         tcpip_gateway_address_actions),
+        ('Enter the Default Gateway host name ', 'TCPIP_GATEWAY_HOSTNAME',
+         tcpip_gateway_hostname_actions),
+        ('Do you want to reconfigure BIND [NO]: ', 'TCPIP_BIND_RECONFIGURE',
+         DEFAULT_ACTIONS),
+        ('BIND server name: ', 'TCPIP_BIND_SERVER',
+         tcpip_bind_server_actions),
+        ('Enter Internet address for ', 'TCPIP_BIND_ADDRESS',
+         tcpip_bind_address_actions),
+        ('Press <ENTER> key to continue', 'TCPIP_BIND_ERROR',
+         DEFAULT_ACTIONS)]
+
+    phases = [
+        Phase('ESC', firmware + bootmgr, {'BOOTMGR': 'BOOTMGR'}),
+        Phase('BOOTMGR', bootmgr + sysboot + firmware,
+              {'SYSBOOT': 'SYSBOOT'}),
+        Phase('SYSBOOT', sysboot + dcl, {'DOLLAR': 'DCL'}),
+        # The full STARTUP.COM, AUTOGEN and the reboot take longer than
+        # the watchdog default between prompts.
+        Phase('DCL', dcl + login, timeout=LONG_PHASE_TIMEOUT),
+        Phase('AUTHORIZE', uaf + dcl, {'DOLLAR': 'DCL'}),
+        Phase('NET$CONFIGURE', decnet + dcl + login),
+        Phase('TCPIP$CONFIG', tcpip + dcl + login),
+        Phase('AUTOGEN', dcl + login, timeout=LONG_PHASE_TIMEOUT),
+        Phase('REBOOT', firmware + bootmgr + sysboot + login + dcl,
+              timeout=LONG_PHASE_TIMEOUT),
+        Phase('SSH', dcl + login)]
+    command_phases = {
+        b'RUN SYS$SYSTEM:AUTHORIZE': 'AUTHORIZE',
+        b'@sys$update:autogen GETDATA SETPARAMS': 'AUTOGEN',
+        b'mcr sysman shutdown node /auto /min=0': 'REBOOT',
+        b'@sys$manager:net$configure': 'NET$CONFIGURE',
+        b'@sys$manager:tcpip$config': 'TCPIP$CONFIG',
+        b'@sys$startup:ssh$startup.com': 'SSH'}
+    # Plain DCL commands that neither prompt nor take long, safe to type
+    # ahead of their prompts with --typeahead.
+    typeahead = {cmd for cmd in dollar_actions
+                 if cmd.lower().startswith((b'set def', b'search/',
+                                            b'open/', b'write ', b'close ',
+                                            b'set noverify'))}
+    # A clone boots straight to the login prompt.
+    start = 'REBOOT' if clone else 'ESC'
+    return Profile('v923', phases, start, command_phases,
+                   ready_phase='SSH', typeahead=typeahead,
+                   heavy_phases={'ESC', 'BOOTMGR', 'SYSBOOT', 'AUTOGEN',
+                                 'REBOOT'})
 
 
 if __name__ == "__main__":
-    main()
+    main(build_profile, __doc__, TARGET_DEFAULTS)
@@ -0,0 +1,212 @@
+'''Admission control for the I/O heavy phases of concurrent installs.
+
+   Booting, AUTOGEN and rebooting many OpenVMS guests at once makes them
+   fight over the disks and CPUs of their host, until adding guests
+   makes the whole fleet slower.  Consoles therefore need a slot from
+   the AdmissionController of their host before they enter a heavy
+   phase, and give it back once they reach a light one; the dialogue
+   phases in between run freely.
+
+   The number of slots adapts.  Every interval the host is sampled: the
+   load average and the memory and I/O pressure stall information from
+   /proc for a local host, and the CPU I/O wait and free memory from the
+   libvirt node statistics for any host.  Under pressure the limit is
+   halved.  Otherwise, while consoles are waiting for a slot, the limit
+   is stepped up, and stepped back as soon as a step lowers the rate at
+   which heavy phases complete, so the limit settles where the most
+   nodes per hour get through.'''
+
+import asyncio
+import logging
+import os
+import time
+import urllib.parse
+from typing import Dict, Optional
+
+import libvirt     # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# Seconds between samples and limit changes.
+ADMISSION_INTERVAL = 60.0
+# Pressure that makes the controller back off.
+IO_PRESSURE = 30.0          # /proc/pressure/io some avg10, percent
+MEMORY_PRESSURE = 10.0      # /proc/pressure/memory some avg10, percent
+IOWAIT = 0.30               # Fraction of CPU time waiting for I/O
+MEMORY_FREE = 0.10          # Fraction of memory free, buffers or cache
+LOAD_PER_CPU = 1.5          # One minute load average per CPU
+
+
+def read_loadavg() -> Optional[float]:
+    ''' Return the one minute load average of this host. '''
+    try:
+        with open('/proc/loadavg', 'r', encoding='ascii') as loadavg:
+            return float(loadavg.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_pressure(resource: str) -> Optional[float]:
+    ''' Return the 10 second 'some' stall percentage of a resource from
+        /proc/pressure, or None without PSI. '''
+    try:
+        with open(f'/proc/pressure/{resource}', 'r',
+                  encoding='ascii') as pressure:
+            for line in pressure:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    return float(dict(field.split('=', 1)
+                                      for field in fields[1:])['avg10'])
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+# pylint: disable=too-few-public-methods
+class HostSampler():
+    ''' Samples the load of one host. '''
+    def __init__(self, connection: libvirt.virConnect, uri: str) -> None:
+        self.connection = connection
+        # /proc only describes the host for a local URI.
+        self.local = not urllib.parse.urlparse(uri).netloc
+        self.cpu_times = None   # Optional [Dict[str, int]]
+
+    def sample(self) -> Dict[str, float]:
+        ''' Return the pressure indicators that can be read. '''
+        sample = {}
+        if self.local:
+            load = read_loadavg()
+            if load is not None:
+                sample['load_per_cpu'] = load / (os.cpu_count() or 1)
+            for resource in ('io', 'memory'):
+                pressure = read_pressure(resource)
+                if pressure is not None:
+                    sample[f'{resource}_pressure'] = pressure
+        try:
+            times = self.connection.getCPUStats(
+                libvirt.VIR_NODE_CPU_STATS_ALL_CPUS, 0)
+            if self.cpu_times and 'iowait' in times:
+                deltas = {key: times[key] - self.cpu_times.get(key, 0)
+                          for key in times}
+                total = sum(deltas.values())
+                if total > 0:
+                    sample['iowait'] = deltas['iowait'] / total
+            self.cpu_times = times
+            memory = self.connection.getMemoryStats(
+                libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS, 0)
+            if memory.get('total'):
+                sample['memory_free'] = sum(
+                    memory.get(key, 0) for key in
+                    ('free', 'buffers', 'cached')) / memory['total']
+        except libvirt.libvirtError as exp:
+            logger.debug('node statistics not available: %s', exp)
+        return sample
+
+
+def under_pressure(sample: Dict[str, float]) -> Optional[str]:
+    ''' Return what the host is short of, or None. '''
+    if sample.get('io_pressure', 0.0) >= IO_PRESSURE:
+        return f'I/O pressure {sample["io_pressure"]:.0f}%'
+    if sample.get('memory_pressure', 0.0) >= MEMORY_PRESSURE:
+        return f'memory pressure {sample["memory_pressure"]:.0f}%'
+    if sample.get('iowait', 0.0) >= IOWAIT:
+        return f'I/O wait {100 * sample["iowait"]:.0f}%'
+    if sample.get('memory_free', 1.0) < MEMORY_FREE:
+        return f'{100 * sample["memory_free"]:.0f}% memory free'
+    if sample.get('load_per_cpu', 0.0) >= LOAD_PER_CPU:
+        return f'load {sample["load_per_cpu"]:.1f} per CPU'
+    return None
+
+
+# pylint: disable=too-many-instance-attributes
+class AdmissionController():
+    ''' Slots for the heavy phases on one host. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, uri: str, sampler: Optional[HostSampler],
+                 limit: int = 2, maximum: int = 0,
+                 interval: float = ADMISSION_INTERVAL) -> None:
+        self.uri = uri
+        self.sampler = sampler
+        self.limit = max(1, limit)
+        # No more slots than this, 0 for no cap.
+        self.maximum = maximum
+        self.interval = interval
+        self.holders = set()    # Set [str]
+        self.waiting = 0
+        self.changed = asyncio.Condition()
+        # Heavy phases completed, and the rate and step of the last
+        # adjustment.
+        self.completed = 0
+        self.window_start = time.monotonic()
+        self.last_rate = None   # Optional [float]
+        self.step = 1
+
+    async def acquire(self, console) -> None:
+        ''' Wait for a slot for the console. '''
+        if console.name in self.holders:
+            return
+        start = time.monotonic()
+        async with self.changed:
+            self.waiting += 1
+            try:
+                await self.changed.wait_for(
+                    lambda: len(self.holders) < self.limit)
+            finally:
+                self.waiting -= 1
+            self.holders.add(console.name)
+        waited = time.monotonic() - start
+        console.session.metrics.admission_wait += waited
+        # The console sat at a prompt while it waited, that is no stall.
+        console.session.last_received = time.monotonic()
+        if waited >= 1.0:
+            logger.info('%s: admitted to %s after %.0f s', console.name,
+                        console.phase.name, waited)
+
+    def release(self, console) -> None:
+        ''' Give back the slot of a console that left the heavy phases. '''
+        if console.name not in self.holders:
+            return
+        self.holders.discard(console.name)
+        self.completed += 1
+        asyncio.get_running_loop().create_task(self.notify())
+
+    async def notify(self) -> None:
+        ''' Wake the consoles waiting for a slot. '''
+        async with self.changed:
+            self.changed.notify_all()
+
+    def adjust(self, sample: Dict[str, float]) -> None:
+        ''' Change the limit from a host sample and the completion rate
+            since the last adjustment. '''
+        now = time.monotonic()
+        rate = 3600.0 * self.completed / max(now - self.window_start, 1.0)
+        self.completed = 0
+        self.window_start = now
+        limit = self.limit
+        reason = under_pressure(sample)
+        if reason:
+            limit = max(1, limit // 2)
+            self.step = 1
+        elif self.waiting and len(self.holders) >= self.limit:
+            if self.last_rate is not None and rate < self.last_rate:
+                # The last step made things worse, go the other way.
+                self.step = -self.step
+            limit = max(1, limit + self.step)
+            reason = f'{self.waiting} waiting, {rate:.1f} per hour'
+        if self.maximum:
+            limit = min(limit, self.maximum)
+        self.last_rate = rate
+        if limit != self.limit:
+            logger.info('%s: admission limit %d -> %d, %s', self.uri,
+                        self.limit, limit, reason)
+            self.limit = limit
+
+    async def run(self) -> None:
+        ''' Sample the host and adjust the limit until cancelled. '''
+        while True:
+            await asyncio.sleep(self.interval)
+            sample = await asyncio.to_thread(self.sampler.sample) \
+                if self.sampler else {}
+            logger.debug('%s: %s', self.uri, sample)
+            self.adjust(sample)
+            await self.notify()
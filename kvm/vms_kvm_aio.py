@@ -0,0 +1,268 @@
+'''asyncio console engine for the OpenVMS console scripts.
+
+   Uses the libvirtaio event loop integration, so libvirt stream and
+   domain events are dispatched from the asyncio loop.  A session is
+   driven with await session.expect(prompts, timeout) and
+   await session.send(cmd); waiting on one console never blocks the
+   others, so many installs can share one core.'''
+
+import asyncio
+import collections
+import logging
+import time
+from typing import Optional, Sequence, Union
+
+import libvirt     # type: ignore
+import libvirtaio  # type: ignore
+
+from vms_kvm_buffer import ConsoleBuffer
+from vms_kvm_matcher import PromptEntry, PromptMatcher
+from vms_kvm_metrics import ConsoleMetrics
+from vms_kvm_replay import RECEIVED, SENT
+from vms_kvm_transcript import OutputRing
+
+logger = logging.getLogger(__name__)
+
+# Bytes asked for per console read, and read at most per stream event
+# so a console in a burst does not hold up the others.
+READ_SIZE = 64 * 1024
+DRAIN_LIMIT = 256 * 1024
+
+
+class ConsoleClosed(Exception):
+    ''' The session was closed while a prompt was awaited. '''
+
+
+def register_event_loop(loop: Optional[asyncio.AbstractEventLoop] = None):
+    ''' Route libvirt events through the asyncio loop.
+
+        Must be called before any libvirt connection is opened.'''
+    return libvirtaio.virEventRegisterAsyncIOImpl(loop=loop)
+
+
+# pylint: disable=too-many-instance-attributes
+class ConsoleSession():
+    ''' Console of one libvirt domain driven from asyncio. '''
+    def __init__(self, connection: libvirt.virConnect,
+                 domain: libvirt.virDomain, name: str) -> None:
+        self.connection = connection
+        self.domain = domain
+        self.name = name
+        self.stream = None  # Optional [libvirt.virStream]
+        self.buffer = ConsoleBuffer()
+        self.inbox = collections.deque()
+        self.matcher = None  # Optional [PromptMatcher]
+        # Key of the prompt expect returned last, the one a send answers.
+        self.prompt_key = None  # Optional [str]
+        self.readable = asyncio.Event()
+        # Closed for good, wakes and fails a pending expect.
+        self.closed = False
+        self.send_retry = 0.01
+        self.recorder = None  # Optional [TranscriptRecorder]
+        # Console output goes to the ring, and to the sinks through the
+        # background writer if there is one.
+        self.ring = OutputRing()
+        self.writer = None  # Optional [TranscriptWriter]
+        self.sinks = []
+        self.metrics = ConsoleMetrics(name)
+        # time.monotonic() of the last console output, for the watchdog.
+        self.last_received = time.monotonic()
+
+    def attach(self, force: bool = False) -> None:
+        ''' Open the domain console and start reading from it.
+
+            With force any other session on the console, such as a
+            stream of ours left over from before a restart, is closed.'''
+        if self.stream is not None:
+            return
+        self.stream = self.connection.newStream(libvirt.VIR_STREAM_NONBLOCK)
+        self.domain.openConsole(
+            None, self.stream, libvirt.VIR_DOMAIN_CONSOLE_FORCE if force
+            else 0)
+        self.stream.eventAddCallback(
+            libvirt.VIR_STREAM_EVENT_READABLE |
+            libvirt.VIR_STREAM_EVENT_ERROR | libvirt.VIR_STREAM_EVENT_HANGUP,
+            stream_callback, self)
+        # Time spent detached, or waiting to be started, is not a stall.
+        self.last_received = time.monotonic()
+        logger.info('%s: created console stream', self.name)
+
+    def detach(self) -> None:
+        ''' Stop reading from the domain console.
+
+            Output still in the stream is read first.  The buffer and
+            the queued output are kept, so a prompt split across a
+            reattach is still matched.'''
+        if self.stream is None:
+            return
+        try:
+            self.drain()
+        except libvirt.libvirtError:
+            pass
+        logger.info('%s: destroyed console stream', self.name)
+        try:
+            self.stream.eventRemoveCallback()
+            self.stream.abort()
+        except libvirt.libvirtError:
+            pass
+        self.stream = None
+
+    def close(self) -> None:
+        ''' Stop reading from the console for good.
+
+            An expect waiting for a prompt raises ConsoleClosed.'''
+        self.detach()
+        self.closed = True
+        self.readable.set()
+
+    def reattach(self) -> None:
+        ''' Reopen the console at once if the domain is still active. '''
+        self.detach()
+        try:
+            if self.domain.isActive():
+                self.attach(force=True)
+                logger.info('%s: reattached with %d unmatched bytes kept',
+                            self.name, len(self.buffer) + sum(
+                                len(data) for data in self.inbox))
+        except libvirt.libvirtError as exp:
+            logger.warning('%s: can not reopen the console: %s',
+                           self.name, exp)
+
+    def discard(self) -> None:
+        ''' Drop the output not matched yet, e.g. of a boot that was
+            reset, so no prompt of it is answered. '''
+        self.buffer = ConsoleBuffer(self.buffer.capacity)
+        self.inbox.clear()
+        self.prompt_key = None
+
+    def received(self, data: bytes) -> None:
+        ''' Queue console data for the next expect. '''
+        self.last_received = time.monotonic()
+        self.ring.write(data)
+        if self.writer:
+            self.writer.write(self.sinks, data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s: %r', self.name, self.buffer.decode(data))
+        if self.recorder:
+            self.recorder.record(RECEIVED, data)
+        self.inbox.append(data)
+        self.readable.set()
+
+    def drain(self) -> int:
+        ''' Read from the console until it would block, return the number
+            of bytes read.
+
+            Each chunk read is queued as it is.  received copies it into
+            the output ring, the recorder file if recording, and later
+            into the console buffer; the transcript writer queues a
+            reference and its sinks write it from their thread.'''
+        size = 0
+        reads = 0
+        while size < DRAIN_LIMIT:
+            data = self.stream.recv(READ_SIZE)
+            if data == -2 or not data:
+                break
+            reads += 1
+            size += len(data)
+            self.received(data)
+        self.metrics.reads += reads
+        return size
+
+    @staticmethod
+    def _matcher(prompts: Union[PromptMatcher, Sequence[PromptEntry]]
+                 ) -> PromptMatcher:
+        ''' Return a compiled matcher for prompts.
+
+            Prompt lists are compiled on each call, callers that expect
+            the same prompts often pass a PromptMatcher.'''
+        if isinstance(prompts, PromptMatcher):
+            return prompts
+        return PromptMatcher(prompts)
+
+    async def expect(self,
+                     prompts: Union[PromptMatcher, Sequence[PromptEntry]],
+                     timeout: Optional[float] = None) -> PromptEntry:
+        ''' Wait for the next prompt from prompts and return its entry.
+
+            Raises asyncio.TimeoutError if none is seen within timeout
+            seconds, and ConsoleClosed once the session is closed.  Output
+            is consumed only up to the returned prompt, so the next
+            expect may look for a different prompt set.'''
+        matcher = self._matcher(prompts)
+        if matcher is not self.matcher:
+            self.matcher = matcher
+            self.buffer.rescan()
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            if self.closed:
+                raise ConsoleClosed(f'{self.name}: console closed')
+            match = self.buffer.next_match(matcher)
+            if match:
+                self.metrics.prompt_seen(match[1][1])
+                self.prompt_key = match[1][1]
+                return match[1]
+            if self.inbox:
+                # Take all queued output that fits, then scan it once.
+                while self.inbox and \
+                        len(self.buffer) < self.buffer.capacity:
+                    data = self.inbox.popleft()
+                    taken = self.buffer.append(data)
+                    if taken < len(data):
+                        self.inbox.appendleft(memoryview(data)[taken:])
+                continue
+            self.readable.clear()
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                if remaining is not None and remaining <= 0:
+                    raise asyncio.TimeoutError()
+                await asyncio.wait_for(self.readable.wait(), remaining)
+            except asyncio.TimeoutError as exp:
+                raise asyncio.TimeoutError(
+                    f'{self.name}: no prompt within {timeout} seconds'
+                    ) from exp
+
+    async def send(self, cmd: bytes) -> int:
+        ''' Send cmd to the console, waiting while the stream is full. '''
+        sent = 0
+        while sent < len(cmd):
+            if self.stream is None:
+                logger.warning('%s: console closed, dropped %r',
+                               self.name, cmd[sent:])
+                break
+            count = self.stream.send(cmd[sent:])
+            if count == -2:
+                # Non-blocking stream would block, try again shortly.
+                await asyncio.sleep(self.send_retry)
+                continue
+            if count < 0:
+                raise libvirt.libvirtError(f'{self.name}: send failed')
+            sent += count
+        if sent:
+            self.metrics.command_sent()
+            if self.recorder:
+                self.recorder.record(SENT, cmd[:sent], self.prompt_key)
+        return sent
+
+
+def stream_callback(_stream: libvirt.virStream,
+                    events: int, session: ConsoleSession) -> None:
+    ''' Stream Callback. '''
+    cpu_start = time.thread_time()
+    size = 0
+    try:
+        if session.stream is None:
+            return
+        if events & (libvirt.VIR_STREAM_EVENT_ERROR |
+                     libvirt.VIR_STREAM_EVENT_HANGUP):
+            # The console went away under a running domain, e.g. on a
+            # restart; pick it up again without waiting for an event.
+            session.reattach()
+            return
+        size = session.drain()
+
+    # pylint: disable=broad-exception-caught
+    except Exception as exp:
+        logger.info("stream_callback exception %s", exp, exc_info=True)
+    finally:
+        session.metrics.callback(size, time.thread_time() - cpu_start)
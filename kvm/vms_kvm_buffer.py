@@ -0,0 +1,99 @@
+'''Bounded console buffer for the OpenVMS console scripts.
+
+   Console output is kept in a fixed size bytearray window that the
+   prompt matcher scans in place.  Everything before the last match, or
+   too old to be the start of a prompt, is trimmed after every scan so
+   the memory used stays flat for the whole install.'''
+
+import codecs
+from typing import List, Optional
+
+from vms_kvm_matcher import Match, PromptMatcher
+
+
+# pylint: disable=too-many-instance-attributes
+class ConsoleBuffer():
+    ''' Sliding window over the console byte stream. '''
+    def __init__(self, capacity: int = 65536) -> None:
+        self.capacity = capacity
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        # Window is buffer[start:end], buffer[start:scanned] is the
+        # unmatched tail left over from the previous scan.
+        self.start = 0
+        self.scanned = 0
+        self.end = 0
+        self.total = 0
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def tail(self) -> bytes:
+        ''' Return a copy of the unmatched bytes in the window. '''
+        return bytes(self.view[self.start:self.end])
+
+    def _make_room(self, size: int) -> None:
+        ''' Slide the unmatched tail to the front of the buffer. '''
+        if self.capacity - self.end >= size or self.start == 0:
+            return
+        kept = self.end - self.start
+        self.buffer[0:kept] = self.view[self.start:self.end]
+        self.scanned -= self.start
+        self.start = 0
+        self.end = kept
+
+    def append(self, data) -> int:
+        ''' Copy as much of data into the window as fits, return the
+            number of bytes taken. '''
+        self._make_room(len(data))
+        size = min(len(data), self.capacity - self.end)
+        if size <= 0:
+            # The tail alone fills the buffer, which only happens if
+            # the capacity is smaller than the longest prompt.
+            raise ValueError('Console buffer too small for prompts')
+        self.view[self.end:self.end + size] = data[:size]
+        self.end += size
+        self.total += size
+        return size
+
+    def next_match(self, matcher: PromptMatcher) -> Optional[Match]:
+        ''' Return the first prompt in the bytes not yet scanned.
+
+            The window is consumed up to the end of the prompt, so the
+            bytes after it can be scanned again with another matcher.
+            Returns None, and trims the window down to the tail that may
+            still start a prompt, once everything has been scanned.'''
+        window = self.view[self.start:self.end]
+        found, consumed = matcher.scan(window, self.scanned - self.start,
+                                       first=True)
+        window.release()
+        if found:
+            self.start = self.scanned = self.start + consumed
+            return found[0]
+        self.scanned = self.end
+        self.start = max(self.start + consumed,
+                         self.end - matcher.tail_length())
+        if self.start == self.end:
+            self.start = self.scanned = self.end = 0
+        return None
+
+    def feed(self, data, matcher: PromptMatcher) -> List[Match]:
+        ''' Add new console data and return the prompts it completes. '''
+        matches = []
+        data = memoryview(data)
+        while data:
+            data = data[self.append(data):]
+            match = self.next_match(matcher)
+            while match:
+                matches.append(match)
+                match = self.next_match(matcher)
+        return matches
+
+    def rescan(self) -> None:
+        ''' Scan the retained tail again, e.g. with a new matcher. '''
+        self.scanned = self.start
+
+    def decode(self, data, final: bool = False) -> str:
+        ''' Decode console bytes, keeping split UTF-8 sequences intact. '''
+        return self.decoder.decode(data, final)
@@ -0,0 +1,176 @@
+'''Checkpoint and resume of the OpenVMS setup dialogue.
+
+   The progress of each console, its phase, how far through each prompt
+   table it is and whether it is waiting for a reboot, is saved to a
+   small JSON state file after every command sent, replacing the file
+   atomically so that a crash or host reboot leaves either the old or
+   the new state.  The file is written and synced in a thread, the
+   event loop keeps serving the other consoles meanwhile.
+
+   Optionally a libvirt snapshot of the running domain is taken when
+   chosen phases are done, at the DCL prompt before the command that
+   starts the next phase.  Resuming reverts the domain to the last
+   snapshot and continues the dialogue from the state saved with it;
+   a fresh DCL prompt is asked for since the one the snapshot was taken
+   at has already been seen.  Only the last snapshot is kept, and it is
+   deleted with the state file once the setup is complete.'''
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from typing import Iterable, Optional
+from xml.sax.saxutils import escape
+
+import libvirt     # type: ignore
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PREFIX = 'vms-setup-'
+
+
+def snapshot_name(phase: str) -> str:
+    ''' Return the snapshot name for the end of a phase. '''
+    return SNAPSHOT_PREFIX + re.sub(r'[^a-z0-9]+', '-', phase.lower())
+
+
+class Checkpoint():
+    ''' Saved progress of one console. '''
+    def __init__(self, directory: str, name: str, profile: str,
+                 snapshot_phases: Iterable[str] = ()) -> None:
+        self.path = os.path.join(directory, f'{name}.json')
+        self.name = name
+        self.profile = profile
+        self.snapshot_phases = set(snapshot_phases)
+        self.snapshot = None    # Optional [dict]
+        self.commands = 0
+
+    @staticmethod
+    def step(console) -> dict:
+        ''' Return the dialogue state of a console. '''
+        return {'phase': console.phase.name,
+                'prompt_index': dict(console.prompt_index),
+                'reboot': console.reboot}
+
+    async def save(self, console) -> None:
+        ''' Save the state of a console after a command was sent. '''
+        self.commands += 1
+        state = {'name': self.name, 'profile': self.profile,
+                 'saved': time.time(), 'commands': self.commands,
+                 'snapshot': self.snapshot}
+        state.update(self.step(console))
+        await asyncio.to_thread(self.write, state)
+
+    def write(self, state: dict) -> None:
+        ''' Replace the state file with state. '''
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as state_file:
+            json.dump(state, state_file, indent=2)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_path, self.path)
+
+    def load(self) -> Optional[dict]:
+        ''' Return the saved state, or None if there is none usable. '''
+        try:
+            with open(self.path, 'r', encoding='utf-8') as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exp:
+            logger.warning('%s: can not read %s: %s', self.name, self.path,
+                           exp)
+            return None
+        if state.get('profile') != self.profile:
+            logger.warning('%s: %s is for profile %s, not %s', self.name,
+                           self.path, state.get('profile'), self.profile)
+            return None
+        self.snapshot = state.get('snapshot')
+        self.commands = state.get('commands', 0)
+        return state
+
+    async def phase_done(self, console, cmd: bytes) -> None:
+        ''' Snapshot the domain if cmd, about to be sent at a DCL
+            prompt, ends one of the snapshot phases. '''
+        phase = console.phase.name
+        if phase not in self.snapshot_phases or \
+                cmd not in console.profile.command_phases:
+            return
+        name = snapshot_name(phase)
+        if self.snapshot and self.snapshot['name'] == name and \
+                self.snapshot['prompt_index'] == console.prompt_index:
+            # Resumed from this very snapshot.
+            return
+        xml = (f'<domainsnapshot><name>{escape(name)}</name>'
+               f'<description>{escape(phase)} done</description>'
+               f'</domainsnapshot>')
+        start = time.monotonic()
+        try:
+            await asyncio.to_thread(self.delete_snapshot, console.domain,
+                                    name)
+            await asyncio.to_thread(console.domain.snapshotCreateXML, xml, 0)
+        except libvirt.libvirtError as exp:
+            logger.warning('%s: no snapshot after %s: %s', self.name, phase,
+                           exp)
+            return
+        logger.info('%s: snapshot %s taken in %.1f s', self.name, name,
+                    time.monotonic() - start)
+        previous = self.snapshot
+        self.snapshot = {'name': name}
+        self.snapshot.update(self.step(console))
+        if previous and previous['name'] != name:
+            await asyncio.to_thread(self.delete_snapshot, console.domain,
+                                    previous['name'])
+
+    def delete_snapshot(self, domain: libvirt.virDomain, name: str) -> None:
+        ''' Delete a snapshot of the domain if it exists. '''
+        try:
+            domain.snapshotLookupByName(name, 0).delete(0)
+        except libvirt.libvirtError as exp:
+            if exp.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN_SNAPSHOT:
+                logger.warning('%s: can not delete snapshot %s: %s',
+                               self.name, name, exp)
+
+    def revert(self, domain: libvirt.virDomain) -> Optional[dict]:
+        ''' Revert the domain to the last snapshot, leaving it running,
+            and return the dialogue state saved with it.
+
+            Returns None if there is no snapshot or it is gone or can
+            not be reverted to; the snapshot is then forgotten.'''
+        if not self.snapshot:
+            return None
+        name = self.snapshot['name']
+        logger.info('%s: reverting to snapshot %s', self.name, name)
+        try:
+            snapshot = domain.snapshotLookupByName(name, 0)
+            domain.revertToSnapshot(
+                snapshot, libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING)
+        except libvirt.libvirtError as exp:
+            logger.warning('%s: can not revert to snapshot %s: %s',
+                           self.name, name, exp)
+            self.snapshot = None
+            return None
+        return self.snapshot
+
+    def complete(self, domain: libvirt.virDomain) -> None:
+        ''' Remove the snapshot and the state file of a finished setup. '''
+        if self.snapshot:
+            self.delete_snapshot(domain, self.snapshot['name'])
+            self.snapshot = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def restore(console, step: dict) -> None:
+    ''' Put a console back into a saved dialogue state.
+
+        The domain is running and the prompt the dialogue waits for has
+        already been printed, so a CR is sent to print it again.'''
+    console.set_phase(step['phase'])
+    console.prompt_index.update(step['prompt_index'])
+    console.reboot = step['reboot']
+    console.nudge = True
@@ -0,0 +1,926 @@
+'''Console dialogue engine shared by the OpenVMS setup scripts.
+
+   A setup dialogue is declared as a Profile: a set of phases, each with
+   its own small compiled prompt set, the phase the dialogue starts in,
+   and the transitions between phases.  A phase is left either when one
+   of its prompts names a next phase, or when a command that starts
+   another phase is sent.  Only the prompts of the active phase are
+   matched, so a generic prompt such as 'network? ' can not fire while
+   the firmware or SYSBOOT is talking.
+
+   The setup scripts for each OpenVMS release only declare their profile
+   and call main().'''
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import libvirt     # type: ignore
+
+from vms_kvm_admission import AdmissionController, HostSampler
+from vms_kvm_aio import ConsoleClosed, ConsoleSession, register_event_loop
+from vms_kvm_checkpoint import Checkpoint, restore
+from vms_kvm_domain import (PROFILES as DEVICE_PROFILES, TEMPLATE,
+                            define_domain)
+from vms_kvm_fleet import ConnectionPool, FleetProgress, Target, load_fleet
+from vms_kvm_golden import GOLDEN_XML, clone_domain, save_golden
+from vms_kvm_image import backing_chain, create_images, node_images
+from vms_kvm_matcher import PromptEntry, PromptMatcher
+from vms_kvm_metrics import write_json, write_prometheus
+from vms_kvm_placement import LEDGER, Allocation, Ledger, read_topology
+from vms_kvm_prewarm import boot_files, prewarm
+from vms_kvm_probe import PROBES, ReadinessProber
+from vms_kvm_replay import TranscriptRecorder
+from vms_kvm_scheduler import MIB, domain_demand, query_host, schedule
+from vms_kvm_transcript import (COMPRESSION, RotatingTranscript,
+                                TerminalSink, TranscriptWriter, zstandard)
+from vms_kvm_tuning import TUNING_PROFILES, domain_resources, modparams
+from vms_kvm_watchdog import (ACTIONS as STALL_ACTIONS, INACTIVITY_TIMEOUT,
+                              PROMPT_TIMEOUT, StallError, Watchdog)
+
+logger = logging.getLogger(__name__)
+
+# System specific data
+# pylint: disable=invalid-name
+host_url = 'qemu:///system'
+
+target_env_password = 'VMS_PASSWORD'
+
+# Bytes that may wait in the OpenVMS terminal type-ahead buffer, the
+# default of the TTY_TYPAHDSZ system parameter.  More is discarded.
+TYPEAHEAD_LIMIT = 78
+# Seconds to wait for the echo of a command sent ahead.
+TYPEAHEAD_TIMEOUT = 60.0
+# Prompt keys that both setup scripts answer with the password.
+SECRET_PROMPTS = frozenset({'PASSWORD', 'UAF'})
+# CTRL/X discards the current line and the type-ahead buffer.
+CTRL_X = b'\x18'
+
+# Some code from:
+# https://github.com/libvirt/
+# libvirt-python/blob/master/examples/consolecallback.py
+
+
+# pylint: disable=too-few-public-methods
+class Phase():
+    ''' One phase of the dialogue and the prompts valid in it. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, name: str, prompts: List[PromptEntry],
+                 on_prompt: Optional[Dict[str, str]] = None,
+                 timeout: Optional[float] = None,
+                 inactivity: Optional[float] = None) -> None:
+        self.name = name
+        self.prompts = prompts
+        # Prompt key -> phase entered when that prompt is seen.
+        self.on_prompt = on_prompt or {}
+        self.matcher = PromptMatcher(prompts)
+        # Watchdog seconds without a prompt and without any output in
+        # this phase, None for the watchdog defaults.
+        self.timeout = timeout
+        self.inactivity = inactivity
+
+
+class Profile():
+    ''' The setup dialogue for one OpenVMS release. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, name: str, phases: List[Phase], start: str,
+                 command_phases: Dict[bytes, str],
+                 ready_phase: Optional[str] = None,
+                 typeahead: Optional[Set[bytes]] = None,
+                 heavy_phases: Optional[Set[str]] = None,
+                 secret_prompts: Optional[Set[str]] = None) -> None:
+        self.name = name
+        self.phases = {phase.name: phase for phase in phases}
+        self.start = start
+        # Once in this phase the node is done as soon as it is
+        # reachable over the network.
+        self.ready_phase = ready_phase
+        # Command sent -> phase entered once it is sent.
+        self.command_phases = command_phases
+        # DCL commands that neither prompt nor change phase, and can be
+        # typed ahead of the DCL prompt in one batch.
+        self.typeahead = (typeahead or set()) - set(command_phases)
+        # Disk and CPU heavy phases, such as booting, that only a limited
+        # number of consoles per host may be in at once.
+        self.heavy_phases = heavy_phases or set()
+        # Prompt keys whose answers hold the password, redacted from
+        # recordings.
+        self.secret_prompts = SECRET_PROMPTS if secret_prompts is None \
+            else secret_prompts
+        next_phases = list(command_phases.values()) + \
+            list(self.heavy_phases)
+        for phase in phases:
+            next_phases.extend(phase.on_prompt.values())
+        for next_phase in next_phases + [start] + \
+                ([ready_phase] if ready_phase else []):
+            if next_phase not in self.phases:
+                raise ValueError(f'{name}: unknown phase {next_phase}')
+
+    def prompts(self) -> List[PromptEntry]:
+        ''' Return every prompt entry of the profile once. '''
+        prompts = []
+        for phase in self.phases.values():
+            for prompt in phase.prompts:
+                if prompt not in prompts:
+                    prompts.append(prompt)
+        return prompts
+
+    async def handle(self, console, prompt: PromptEntry) -> Optional[bytes]:
+        ''' Answer a prompt, return the command sent if any.
+
+            After a reboot the login prompts are only answered once the
+            startup job has finished, and the DCL prompt after the last
+            command completes the configuration.'''
+        session = console.session
+        if not session.stream:
+            return None
+        num_cmds = len(prompt[2])
+        prompt_index = console.prompt_index[prompt[1]]
+        if prompt_index >= num_cmds:
+            logging.info(
+              "Unexpected Prompt %s %s > %s ",
+              prompt[1], prompt_index, num_cmds)
+            if prompt[1] == 'DOLLAR':
+                print(f'\n\n{console.name}: Configuration complete.\n')
+                console.finish()
+            return None
+        cmd = prompt[2][prompt_index]
+        if prompt[1] == 'INTSET':
+            print("reboot seen")
+            console.reboot = True
+            await asyncio.sleep(console.intset_delay)
+            await session.send(cmd + b'\r')
+        elif prompt[1] == 'USERNAME':
+            if not console.reboot:
+                return None
+            await session.send(cmd + b'\r')
+            console.reboot = False
+        elif prompt[1] == 'DOLLAR' and console.typeahead:
+            batch = self.typeahead_batch(prompt[2][prompt_index:])
+            console.prompt_index[prompt[1]] += len(batch)
+            if len(batch) == 1:
+                await session.send(cmd + b'\r')
+            else:
+                await send_typeahead(console, batch)
+            cmd = batch[-1]
+        else:
+            console.prompt_index[prompt[1]] += 1
+            await session.send(cmd + b'\r')
+        return cmd
+
+    def typeahead_batch(self, commands: List[bytes]) -> List[bytes]:
+        ''' Return the commands to send now, the first of commands and
+            those after it that can be typed ahead.
+
+            Only the commands after the first wait in the type-ahead
+            buffer, so only those count against its size.'''
+        batch = commands[:1]
+        if batch[0] not in self.typeahead:
+            return batch
+        waiting = 0
+        for cmd in commands[1:]:
+            if cmd not in self.typeahead or \
+                    waiting + len(cmd) + 1 > TYPEAHEAD_LIMIT:
+                break
+            waiting += len(cmd) + 1
+            batch.append(cmd)
+        return batch
+
+
+async def send_typeahead(console, batch: List[bytes]) -> None:
+    ''' Send a batch of DCL commands at once and check their echoes.
+
+        DCL echoes each command as it reads it, after the prompt for it,
+        so the echoes must come back in order with one DCL prompt
+        between them.  If an echo is missing or out of place the rest of
+        the type-ahead buffer is cleared with CTRL/X, so no command runs
+        twice, and the console falls back to one command per prompt,
+        starting again from the first command whose echo was not seen.'''
+    session = console.session
+    dcl = [entry for entry in console.phase.prompts if entry[1] == 'DOLLAR']
+    dcl_matcher = PromptMatcher(dcl)
+    await session.send(b''.join(cmd + b'\r' for cmd in batch))
+    logger.debug('%s: typed ahead %d commands', console.name, len(batch))
+    for index, cmd in enumerate(batch):
+        echo = [(cmd, 'ECHO', [])]
+        try:
+            if index:
+                await session.expect(dcl_matcher, TYPEAHEAD_TIMEOUT)
+            seen = await session.expect(echo + dcl, TYPEAHEAD_TIMEOUT)
+        except asyncio.TimeoutError:
+            seen = None
+        if seen is None or seen[1] != 'ECHO':
+            logger.error('%s: no echo of typed ahead %r, back to one'
+                         ' command per prompt, recent output:\n%s',
+                         console.name, cmd, session.ring.text())
+            console.typeahead = False
+            console.prompt_index['DOLLAR'] -= len(batch) - index
+            # Drop the commands still waiting in the type-ahead buffer,
+            # they are sent again.  The DCL prompt, if any, has been used
+            # up; ask for another.
+            await session.send(CTRL_X + b'\r')
+            return
+
+
+def error_handler(_unused, error) -> None:
+    ''' Error Handler. '''
+    # The console stream errors on VM shutdown; we don't care
+    if error[0] == libvirt.VIR_ERR_RPC and error[1] == libvirt.VIR_FROM_STREAMS:
+        return
+    logging.warning(error)
+
+
+# pylint: disable=too-many-instance-attributes
+class Console():
+    ''' Class Console '''
+    def __init__(self, connection: libvirt.virConnect, target: Target,
+                 profile: Profile) -> None:
+        self.target = target
+        self.profile = profile
+        self.name = target.name
+        self.connection = connection
+        self.domain = self.connection.lookupByName(self.name)
+        self.state = self.domain.state(0)
+        self.session = ConsoleSession(connection, self.domain, self.name)
+        self.lifecycle_id = self.connection.domainEventRegisterAny(
+            self.domain, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+            lifecycle_callback, self)
+        self.run_console = True
+        self.stdin_watch = -1
+        self.phase = profile.phases[profile.start]
+        self.session.metrics.enter_phase(self.phase.name)
+        self.reboot = False
+        self.intset_delay = 10
+        # Send runs of type-ahead safe DCL commands in one batch.
+        self.typeahead = False
+        self.fleet = None   # Optional [FleetProgress]
+        self.checkpoint = None  # Optional [Checkpoint]
+        self.watchdog = None    # Optional [Watchdog]
+        self.admission = None   # Optional [AdmissionController]
+        # Resumed on a running domain whose prompt was already printed,
+        # send a CR to have it printed again.
+        self.nudge = False
+        self.prompt_index = {}
+        for prompt in profile.prompts():
+            if prompt[1] not in self.prompt_index:
+                self.prompt_index[prompt[1]] = 0
+        logging.debug('%s prompt_index = %s', self.name, self.prompt_index)
+
+        logging.info("%s initial state %d, reason %d",
+                     self.name, self.state[0], self.state[1])
+
+    def start(self) -> None:
+        ''' Open the console, starting the domain first if needed.
+
+            A domain that is not running is started, or left, paused
+            until the console is open, so that not even the first
+            firmware prompt is missed.'''
+        if self.state[0] == libvirt.VIR_DOMAIN_RUNNING:
+            self.session.attach()
+            return
+        if not self.domain.isActive():
+            self.domain.createWithFlags(libvirt.VIR_DOMAIN_START_PAUSED)
+        self.session.attach()
+        self.domain.resume()
+        self.state = self.domain.state(0)
+
+    def lifecycle(self) -> None:
+        ''' Keep the console open exactly while the domain is active. '''
+        if not self.run_console:
+            return
+        if self.state[0] in (libvirt.VIR_DOMAIN_RUNNING,
+                             libvirt.VIR_DOMAIN_PAUSED):
+            if self.session.stream is None:
+                try:
+                    self.session.attach(force=True)
+                except libvirt.libvirtError as exp:
+                    logging.warning('%s: can not open the console: %s',
+                                    self.name, exp)
+        else:
+            self.session.detach()
+
+    def set_phase(self, name: str) -> None:
+        ''' Move the dialogue to another phase. '''
+        if name != self.phase.name:
+            logging.info('%s: %s -> %s', self.name, self.phase.name, name)
+            self.phase = self.profile.phases[name]
+            self.session.metrics.enter_phase(name)
+            if self.admission and name not in self.profile.heavy_phases:
+                self.admission.release(self)
+
+    def progress(self) -> tuple:
+        ''' Return the number of commands sent and the total. '''
+        totals = {}
+        for prompt in self.profile.prompts():
+            totals[prompt[1]] = len(prompt[2])
+        sent = sum(min(self.prompt_index[key], count)
+                   for key, count in totals.items())
+        return sent, sum(totals.values())
+
+    def finish(self, failure: Optional[dict] = None) -> None:
+        ''' Stop servicing this console, failed if there is a failure.
+
+            Only the first call counts, a dialogue still waiting for a
+            prompt is woken up and ends. '''
+        if not self.run_console:
+            return
+        self.run_console = False
+        self.session.metrics.failure = failure
+        self.session.metrics.finish()
+        if self.admission:
+            self.admission.release(self)
+        self.session.close()
+        if self.session.recorder:
+            self.session.recorder.close()
+            self.session.recorder = None
+        if self.lifecycle_id >= 0:
+            self.connection.domainEventDeregisterAny(self.lifecycle_id)
+            self.lifecycle_id = -1
+        if self.checkpoint and failure is None:
+            self.checkpoint.complete(self.domain)
+        if self.fleet:
+            self.fleet.done(self, failed=failure is not None)
+
+
+async def prompt_handler(console: Console, prompt: PromptEntry) -> None:
+    ''' Prompt Handler '''
+    next_phase = console.phase.on_prompt.get(prompt[1])
+    if next_phase:
+        console.set_phase(next_phase)
+    checkpoint = console.checkpoint
+    if prompt[1] == 'DOLLAR' and \
+            console.prompt_index['DOLLAR'] < len(prompt[2]):
+        upcoming = prompt[2][console.prompt_index['DOLLAR']]
+        if checkpoint:
+            await checkpoint.phase_done(console, upcoming)
+        if console.admission and console.profile.command_phases.get(
+                upcoming) in console.profile.heavy_phases:
+            await console.admission.acquire(console)
+    cmd = await console.profile.handle(console, prompt)
+    if cmd is not None:
+        next_phase = console.profile.command_phases.get(cmd)
+        if next_phase:
+            console.set_phase(next_phase)
+        if checkpoint:
+            await checkpoint.save(console)
+
+
+async def run_dialogue(console: Console) -> None:
+    ''' Answer console prompts until the configuration is complete. '''
+    try:
+        if console.nudge:
+            while console.run_console and console.session.stream is None:
+                await asyncio.sleep(0.25)
+            await console.session.send(b'\r')
+        while console.run_console:
+            if console.watchdog:
+                prompt = await console.watchdog.expect(console)
+            else:
+                prompt = await console.session.expect(console.phase.matcher)
+            await prompt_handler(console, prompt)
+    except ConsoleClosed:
+        # Finished from elsewhere, e.g. handed off by the probe.
+        pass
+    except StallError as exp:
+        # Only this node fails, the rest of the fleet carries on.
+        console.finish(failure=exp.details())
+    except Exception:
+        logger.error('%s: dialogue failed in phase %s, recent output:\n%s',
+                     console.name, console.phase.name,
+                     console.session.ring.text())
+        raise
+
+
+async def run_console(console: Console) -> None:
+    ''' Start the console, once admitted if it starts in a heavy phase,
+        and run its dialogue. '''
+    if console.admission and \
+            console.phase.name in console.profile.heavy_phases:
+        await console.admission.acquire(console)
+    console.start()
+    await run_dialogue(console)
+
+
+def node_address(console: Console) -> Optional[str]:
+    ''' Return the address to probe the node at.
+
+        The fleet file address if there is one, else the first IPv4
+        address libvirt has seen the guest use, else the node's name in
+        its Internet domain.'''
+    if console.target.address:
+        return console.target.address
+    try:
+        interfaces = console.domain.interfaceAddresses(
+            libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_ARP)
+        for interface in interfaces.values():
+            for address in interface.get('addrs') or []:
+                if address['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                    return address['addr']
+    except (libvirt.libvirtError, AttributeError):
+        pass
+    if console.target.domain:
+        return console.target.scsnode_str + '.' + \
+            console.target.domain.decode('utf-8')
+    return None
+
+
+async def probe_console(console: Console, kinds: List[str],
+                        hand_off: bool = True) -> None:
+    ''' Wait for the ready phase, then probe the node until it is
+        reachable, and hand it off by finishing the console. '''
+    ready = console.profile.ready_phase
+    while console.run_console and console.phase.name != ready:
+        await asyncio.sleep(1)
+    if console.phase.name != ready:
+        return
+    prober = ReadinessProber(console.name, lambda: node_address(console),
+                             kinds)
+    console.session.metrics.reachable = prober.reachable
+    await prober.run(console.session.metrics.start)
+    if hand_off and console.run_console and \
+            len(prober.reachable) == len(kinds):
+        print(f'\n\n{console.name}: Reachable, configuration complete.\n')
+        console.finish()
+
+
+def lifecycle_callback(_connection: libvirt.virConnect,
+                       _domain: libvirt.virDomain,
+                       event: int, detail: int, console: Console) -> None:
+    ''' Life cycle callback, opens or closes the console as the domain
+        starts and stops. '''
+    console.state = console.domain.state(0)
+    logging.info("%s transitioned to state %d, reason %d (event %d/%d)",
+                 console.name, console.state[0], console.state[1],
+                 event, detail)
+    console.lifecycle()
+
+
+def resume_target(connection: libvirt.virConnect, target: Target,
+                  checkpoint: Checkpoint) -> Optional[dict]:
+    ''' Load the saved progress of a target and return the dialogue
+        state to continue from.
+
+        With a snapshot the domain is reverted to it.  Without one, or
+        if it can not be reverted to, the saved state is only used while
+        the domain is still running, otherwise the setup starts over.
+        Either way the console of a resumed target is nudged with a CR
+        once it is open.'''
+    state = checkpoint.load()
+    if state is None:
+        logging.info('%s: nothing to resume, starting over', target.name)
+        return None
+    domain = connection.lookupByName(target.name)
+    if checkpoint.snapshot:
+        step = checkpoint.revert(domain)
+        if step:
+            return step
+    if domain.isActive():
+        logging.info('%s: resuming in phase %s without a snapshot',
+                     target.name, state['phase'])
+        return state
+    logging.warning('%s: not running and no snapshot, starting over',
+                    target.name)
+    return None
+
+
+def place_targets(pool: ConnectionPool, targets: List[Target],
+                  uris: List[str], golden_dir: Optional[str]) -> None:
+    ''' Spread the targets over the hosts, each to the host with the
+        most headroom for a node like the template or golden image. '''
+    hosts = [query_host(pool.get(uri), uri) for uri in dict.fromkeys(uris)]
+    if golden_dir:
+        memory, vcpus = domain_demand(os.path.join(golden_dir, GOLDEN_XML))
+    else:
+        memory, vcpus = domain_demand()
+    schedule(targets, hosts, memory, vcpus)
+    for host in hosts:
+        logging.info('%s: %d running, %s placed', host.uri,
+                     len(host.running), ', '.join(host.placed) or 'none')
+
+
+def pin_domain(connection: libvirt.virConnect, name: str, xml_path: str,
+               ledger: Optional[Ledger], hugepages: bool
+               ) -> Optional[Allocation]:
+    ''' Return the host CPUs, NUMA node and hugepages for a new domain
+        like the XML file, or None without a ledger.  Raises ValueError
+        if the host has no room left for it. '''
+    if ledger is None:
+        return None
+    memory, vcpus = domain_demand(xml_path)
+    defined = [domain.name() for domain in connection.listAllDomains(0)]
+    return ledger.allocate(name, vcpus, memory // MIB, read_topology(),
+                           hugepages, defined)
+
+
+# pylint: disable=too-many-arguments
+def prepare_clone(connection: libvirt.virConnect, target: Target,
+                  golden_dir: str, image_dir: str,
+                  ledger: Optional[Ledger] = None,
+                  hugepages: bool = True) -> None:
+    ''' Define the target domain from the golden image if needed, pinned
+        as the ledger places it if there is one. '''
+    try:
+        connection.lookupByName(target.name)
+        logging.info('%s already defined, not cloning it', target.name)
+    except libvirt.libvirtError:
+        placement = pin_domain(connection, target.name,
+                               os.path.join(golden_dir, GOLDEN_XML), ledger,
+                               hugepages)
+        clone_domain(connection, golden_dir, target.name, image_dir,
+                     placement)
+
+
+# pylint: disable=too-many-arguments
+def prepare_domain(connection: libvirt.virConnect, target: Target,
+                   device_profile: str, image_dir: str,
+                   ledger: Optional[Ledger] = None,
+                   hugepages: bool = True) -> None:
+    ''' Define the target domain from the XML template if needed, pinned
+        as the ledger places it if there is one. '''
+    try:
+        connection.lookupByName(target.name)
+        logging.info('%s already defined, using it as it is', target.name)
+    except libvirt.libvirtError:
+        placement = pin_domain(connection, target.name, TEMPLATE, ledger,
+                               hugepages)
+        define_domain(connection, target.name, device_profile, image_dir,
+                      placement=placement)
+
+
+def tune_target(connection: libvirt.virConnect, target: Target,
+                golden_dir: Optional[str]) -> None:
+    ''' Size the MODPARAMS.DAT entries of the tuning profile of a target
+        to the memory and vCPUs of its domain, or of the template or
+        golden image if the domain is not defined. '''
+    if not target.tuning or target.modparams is not None:
+        return
+    try:
+        memory_mib, vcpus = domain_resources(
+            connection.lookupByName(target.name))
+    except libvirt.libvirtError:
+        if golden_dir:
+            memory, vcpus = domain_demand(os.path.join(golden_dir,
+                                                       GOLDEN_XML))
+        else:
+            memory, vcpus = domain_demand()
+        memory_mib = memory // MIB
+    target.modparams = modparams(target.tuning, memory_mib, vcpus)
+    target.settings['modparams'] = target.modparams
+    logging.info('%s: %s tuning for %d MiB and %d vCPUs', target.name,
+                 target.tuning, memory_mib, vcpus)
+
+
+def prepare_images(targets: List[Target], base: str,
+                   image_dir: str) -> None:
+    ''' Create the missing disks of all targets in parallel, and check
+        the backing chain of their system disks. '''
+    images = []
+    for target in targets:
+        images.extend(node_images(target.name, image_dir, base,
+                                  preallocation='metadata'))
+    create_images(images)
+    for path, options in images:
+        if options.get('backing'):
+            backing_chain(path)
+
+
+async def prewarm_targets(pool: ConnectionPool, targets: List[Target],
+                          uri: str) -> None:
+    ''' Read the boot files of the domains about to be started into
+        the page cache, once and sequentially. '''
+    paths = []
+    for target in targets:
+        domain = pool.get(target.uri or uri).lookupByName(target.name)
+        if not domain.isActive():
+            paths.extend(boot_files(domain))
+    await asyncio.to_thread(prewarm, paths)
+
+
+async def save_golden_image(console: Console, golden_dir: str,
+                            timeout: float = 600.0) -> None:
+    ''' Wait for the configured system to power off and save it. '''
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while console.domain.isActive():
+        if loop.time() > deadline:
+            logging.error('%s did not power off, golden image not saved',
+                          console.name)
+            return
+        await asyncio.sleep(5)
+    save_golden(console.domain, golden_dir, console.target.settings)
+
+
+def open_transcripts(args: argparse.Namespace,
+                     consoles: List[Console]) -> Tuple[TranscriptWriter, List]:
+    ''' Hand the console output of every session to a background
+        writer, return it and the sinks to close at exit. '''
+    if args.transcript:
+        os.makedirs(args.transcript, exist_ok=True)
+    writer = TranscriptWriter()
+    terminal = TerminalSink()
+    sinks = []
+    for console in consoles:
+        console.session.writer = writer
+        if not args.quiet:
+            console.session.sinks.append(terminal)
+        if args.transcript:
+            transcript = RotatingTranscript(
+                os.path.join(args.transcript, f'{console.name}.log'),
+                args.transcript_max_bytes, args.transcript_backups,
+                args.transcript_compress)
+            console.session.sinks.append(transcript)
+            sinks.append(transcript)
+    return writer, sinks
+
+
+def report_metrics(args: argparse.Namespace,
+                   consoles: List[Console]) -> None:
+    ''' Write the timing summary of all consoles. '''
+    metrics = [console.session.metrics for console in consoles]
+    try:
+        write_json(args.metrics, metrics)
+        if args.prometheus:
+            write_prometheus(args.prometheus, metrics)
+    except OSError as exp:
+        logger.error('Can not write metrics: %s', exp)
+
+
+ProfileBuilder = Callable[..., Profile]
+
+
+def task_failed(console: Console, exp: BaseException) -> None:
+    ''' Fail the console of a task that raised, the rest of the fleet
+        carries on. '''
+    logger.error('%s: %s', console.name, exp, exc_info=exp)
+    try:
+        console.finish(failure={'node': console.name, 'error': 'exception',
+                                'phase': console.phase.name,
+                                'reason': repr(exp)})
+    except libvirt.libvirtError:
+        # finish reports to the fleet last, it did not get that far.
+        if console.fleet:
+            console.fleet.done(console, failed=True)
+
+
+async def wait_consoles(tasks: Dict[asyncio.Task, Console],
+                        fleet: FleetProgress) -> None:
+    ''' Wait for the dialogue and probe tasks of the consoles, reporting
+        the fleet progress meanwhile. '''
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(
+            pending, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and task.exception():
+                task_failed(tasks[task], task.exception())
+        fleet.report()
+
+
+async def run_consoles(args: argparse.Namespace, targets: List[Target],
+                       build_profile: ProfileBuilder) -> int:
+    ''' Run the dialogue for all targets from one event loop, return
+        the number of nodes that failed. '''
+    register_event_loop()
+    pool = ConnectionPool()
+    consoles = []
+    controllers = []
+    transcripts = None
+    try:
+        if args.host:
+            try:
+                place_targets(pool, targets, args.host, args.golden)
+            except ValueError as exp:
+                logger.error('%s', exp)
+                return len(targets)
+        ledger = Ledger(args.ledger) if args.pin else None
+        hugepages = args.pin == 'hugepages'
+        try:
+            if args.golden:
+                for target in targets:
+                    prepare_clone(pool.get(target.uri or args.uri), target,
+                                  args.golden, args.image_dir, ledger,
+                                  hugepages)
+            elif args.device_profile:
+                if args.base_image:
+                    prepare_images(targets, args.base_image, args.image_dir)
+                for target in targets:
+                    prepare_domain(pool.get(target.uri or args.uri), target,
+                                   args.device_profile, args.image_dir,
+                                   ledger, hugepages)
+        except (OSError, ValueError) as exp:
+            logger.error('%s', exp)
+            return len(targets)
+        if args.prewarm:
+            await prewarm_targets(pool, targets, args.uri)
+        options = {'clone': bool(args.golden),
+                   'power_off': bool(args.save_golden)}
+        for target in targets:
+            connection = pool.get(target.uri or args.uri)
+            tune_target(connection, target, args.golden)
+            profile = build_profile(target, **options)
+            checkpoint = None
+            step = None
+            if args.checkpoint:
+                checkpoint = Checkpoint(args.checkpoint, target.name,
+                                        profile.name, args.snapshot or [])
+                if args.resume:
+                    step = await asyncio.to_thread(
+                        resume_target, connection, target, checkpoint)
+            console = Console(connection, target, profile)
+            console.checkpoint = checkpoint
+            if args.stall_action != 'none':
+                console.watchdog = Watchdog(args.inactivity_timeout,
+                                            args.prompt_timeout,
+                                            action=args.stall_action)
+            if step:
+                restore(console, step)
+            consoles.append(console)
+        if args.record:
+            for console in consoles:
+                console.session.recorder = TranscriptRecorder(
+                    os.path.join(args.record, f'{console.name}.vmsrec'),
+                    console.target, console.profile.name, options,
+                    args.typeahead, console.profile.secret_prompts)
+        transcripts = open_transcripts(args, consoles)
+        fleet = FleetProgress(consoles)
+        for console in consoles:
+            console.fleet = fleet
+            console.typeahead = args.typeahead
+        tasks = {}
+        if args.admit:
+            for uri in dict.fromkeys(console.target.uri or args.uri
+                                     for console in consoles):
+                controller = AdmissionController(
+                    uri, HostSampler(pool.get(uri), uri), args.admit,
+                    args.max_admit)
+                controllers.append(asyncio.create_task(controller.run()))
+                for console in consoles:
+                    if (console.target.uri or args.uri) == uri:
+                        console.admission = controller
+        for console in consoles:
+            tasks[asyncio.create_task(run_console(console))] = console
+            if args.probe and console.profile.ready_phase:
+                tasks[asyncio.create_task(probe_console(
+                    console, args.probe,
+                    hand_off=not args.save_golden))] = console
+        await wait_consoles(tasks, fleet)
+        if args.save_golden and not fleet.failed:
+            await save_golden_image(consoles[0], args.save_golden)
+        return len(fleet.failed)
+    finally:
+        for controller in controllers:
+            controller.cancel()
+        pool.close()
+        if transcripts:
+            writer, sinks = transcripts
+            writer.close(sinks)
+        report_metrics(args, consoles)
+
+
+def main(build_profile: ProfileBuilder, description: str,
+         target_defaults: Dict) -> None:
+    ''' Main. '''
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--fleet', metavar='FILE',
+                        help='JSON file listing the targets to set up')
+    parser.add_argument('--uri', default=host_url,
+                        help=f'libvirt connection URI (default {host_url})')
+    parser.add_argument('--host', action='append', metavar='URI',
+                        help='spread the targets over these libvirt hosts'
+                        ' by free memory and CPUs; may be given more than'
+                        ' once')
+    parser.add_argument('--record', metavar='DIR',
+                        help='record console transcripts for replay in DIR')
+    parser.add_argument('--save-golden', metavar='DIR',
+                        help='power off when done and save the system as'
+                        ' a golden image in DIR')
+    parser.add_argument('--golden', metavar='DIR',
+                        help='create missing domains as overlays on the'
+                        ' golden image in DIR and only set their identity')
+    parser.add_argument('--probe', action='append', choices=PROBES,
+                        help='once the last phase starts, finish as soon'
+                        ' as the node answers on this service; may be'
+                        ' given more than once')
+    parser.add_argument('--typeahead', action='store_true',
+                        help='type runs of simple DCL commands ahead of'
+                        ' the prompt instead of one per prompt')
+    parser.add_argument('--checkpoint', metavar='DIR',
+                        help='save the progress of each console to'
+                        ' DIR/<name>.json after every command')
+    parser.add_argument('--snapshot', action='append', metavar='PHASE',
+                        help='with --checkpoint, snapshot the domain when'
+                        ' PHASE is done; may be given more than once')
+    parser.add_argument('--resume', action='store_true',
+                        help='with --checkpoint, revert to the last'
+                        ' snapshot and continue from the saved progress')
+    parser.add_argument('--inactivity-timeout', type=float,
+                        default=INACTIVITY_TIMEOUT, metavar='SECONDS',
+                        help='a console with no output for this long is'
+                        ' stalled, unless its phase sets another value')
+    parser.add_argument('--prompt-timeout', type=float,
+                        default=PROMPT_TIMEOUT, metavar='SECONDS',
+                        help='a console with no expected prompt for this'
+                        ' long is stalled, unless its phase sets another'
+                        ' value')
+    parser.add_argument('--stall-action', choices=STALL_ACTIONS + ('none',),
+                        default='fail',
+                        help='what to do once a CR and a rescan did not'
+                        ' get a stalled console going: fail the node,'
+                        ' reset it, or no watchdog at all')
+    parser.add_argument('--admit', type=int, default=0, metavar='N',
+                        help='consoles per host let into the boot and'
+                        ' AUTOGEN phases at first, adapted to the host'
+                        ' load from there; 0 lets all in (default 0,'
+                        ' off)')
+    parser.add_argument('--max-admit', type=int, default=0, metavar='N',
+                        help='never let more than N consoles per host into'
+                        ' those phases')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='read the backing image and firmware into the'
+                        ' page cache before starting the domains')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not echo the consoles to the terminal')
+    parser.add_argument('--transcript', metavar='DIR',
+                        help='write each console to DIR/<name>.log')
+    parser.add_argument('--transcript-max-bytes', type=int,
+                        default=16 * 1024 * 1024,
+                        help='rotate transcripts at this size')
+    parser.add_argument('--transcript-backups', type=int, default=5,
+                        help='rotated transcripts to keep')
+    parser.add_argument('--transcript-compress', choices=COMPRESSION,
+                        default='gzip',
+                        help='compression of rotated transcripts')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='write the JSON timing summary to FILE'
+                        ' (- for stdout) instead of the log')
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help='also write the timings as a Prometheus'
+                        ' text file')
+    parser.add_argument('--device-profile', choices=DEVICE_PROFILES,
+                        help='define missing domains from the XML template'
+                        ' with this device profile')
+    parser.add_argument('--tuning', choices=TUNING_PROFILES,
+                        help='write the MODPARAMS.DAT entries of this'
+                        ' AUTOGEN tuning profile, sized to each domain')
+    parser.add_argument('--base-image', metavar='FILE',
+                        help='with --device-profile, also create missing'
+                        ' disks, the system disk as an overlay on FILE')
+    parser.add_argument('--pin', choices=('hugepages', 'cpus'),
+                        help='pin the vCPUs of new domains to whole host'
+                        ' cores and bind their memory to one NUMA node,'
+                        ' backed by hugepages unless cpus is given')
+    parser.add_argument('--ledger', default=LEDGER,
+                        help='allocation ledger for --pin (default'
+                        f' {LEDGER})')
+    parser.add_argument('--image-dir', default='/data/libvirt_pools/main',
+                        help='directory for the disk images of new domains')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if target_env_password not in os.environ:
+        logger.error('Need %s environment set!', target_env_password)
+        sys.exit(1)
+    defaults = dict(target_defaults)
+    defaults['password'] = os.environ[target_env_password]
+    if args.tuning:
+        defaults['tuning'] = args.tuning
+    if args.fleet:
+        targets = load_fleet(args.fleet, defaults)
+    else:
+        targets = [Target.from_dict(defaults)]
+    if args.transcript_compress == 'zstd' and zstandard is None:
+        parser.error('--transcript-compress zstd needs zstandard')
+    if args.save_golden and len(targets) != 1:
+        parser.error('--save-golden needs exactly one target')
+    if args.pin and args.host:
+        parser.error('--pin places domains on this host, not with --host')
+    if args.pin and not (args.golden or args.device_profile):
+        parser.error('--pin needs --golden or --device-profile')
+    if (args.snapshot or args.resume) and not args.checkpoint:
+        parser.error('--snapshot and --resume need --checkpoint')
+    try:
+        for target in targets:
+            if target.tuning and target.tuning not in TUNING_PROFILES:
+                raise ValueError(f'{target.name}: no tuning profile'
+                                 f' {target.tuning}')
+            profile = build_profile(target, clone=bool(args.golden),
+                                    power_off=bool(args.save_golden))
+            for phase in args.snapshot or []:
+                if phase not in profile.phases:
+                    raise ValueError(f'no phase {phase} in profile'
+                                     f' {profile.name}')
+    except ValueError as exp:
+        parser.error(str(exp))
+    if args.checkpoint:
+        os.makedirs(args.checkpoint, exist_ok=True)
+
+    try:
+        if asyncio.run(run_consoles(args, targets, build_profile)):
+            sys.exit(1)
+    except KeyboardInterrupt:
+        if args.checkpoint:
+            logger.info('Interrupted, progress is saved in %s, continue'
+                        ' with --resume', args.checkpoint)
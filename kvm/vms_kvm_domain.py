@@ -0,0 +1,310 @@
+#!/usr/bin/python
+
+'''Domain XML generator for OpenVMS x86 guests.
+
+   Renders the XML of a new domain from vms_kvm_template.xml, dropping
+   the runtime details of the dump it was made from (ids, aliases, PCI
+   addresses, pty paths, MAC address, security labels) and applying one
+   of the device profiles below.  The result can be printed, defined
+   through libvirt, or every profile checked against the libvirt test
+   driver with --check.
+
+   Which devices OpenVMS can use depends on the release; the template
+   profile is what virt-install made for V9.2-x, the virtio profile
+   needs a release with VirtIO SCSI and network drivers.'''
+
+import argparse
+import logging
+import os
+import sys
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional
+
+import libvirt     # type: ignore
+
+from vms_kvm_placement import Allocation, apply_placement
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'vms_kvm_template.xml')
+TEMPLATE_NAME = 'myname'
+NVRAM_DIR = '/var/lib/libvirt/qemu/nvram'
+IMAGE_DIR = '/data/libvirt_pools/main'
+
+# The disks of the template that are carried over, by file name suffix.
+# The old 9.2-2 system disk the template was dumped with is not.
+DISKS = ('_vms923.qcow2', '_data.qcow2', '_backup.qcow2')
+# NIC models QEMU emulates for q35 guests.
+NIC_MODELS = ('e1000', 'e1000e', 'rtl8139', 'virtio')
+
+
+# pylint: disable=too-few-public-methods, too-many-instance-attributes
+class DeviceProfile():
+    ''' Disk, controller and NIC settings for a generated domain. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, name: str, description: str,
+                 disk_bus: str = 'sata', nic_model: str = 'e1000',
+                 cache: Optional[str] = None, io: Optional[str] = None,
+                 discard: Optional[str] = None, iothreads: int = 0,
+                 lean: bool = False) -> None:
+        self.name = name
+        self.description = description
+        self.disk_bus = disk_bus
+        self.nic_model = nic_model
+        # Disk driver attributes, None leaves the hypervisor default.
+        self.cache = cache
+        self.io = io
+        self.discard = discard
+        self.iothreads = iothreads
+        # Drop the USB controllers and the unused PCIe root ports, and
+        # let libvirt add the ports the devices need.
+        self.lean = lean
+
+
+PROFILES = {profile.name: profile for profile in [
+    DeviceProfile('template',
+                  'devices as virt-install made them, SATA and e1000'),
+    DeviceProfile('sata', 'SATA and e1000 with host cache off, native'
+                  ' AIO and discard, no USB or spare PCIe ports',
+                  cache='none', io='native', discard='unmap', lean=True),
+    DeviceProfile('virtio', 'VirtIO SCSI on its own iothread and VirtIO'
+                  ' network, host cache off, native AIO and discard',
+                  disk_bus='scsi', nic_model='virtio', cache='none',
+                  io='native', discard='unmap', iothreads=1, lean=True)]}
+
+
+def strip_runtime(root: ET.Element) -> None:
+    ''' Remove what only makes sense for the running domain dumped. '''
+    root.attrib.pop('id', None)
+    for parent in root.iter():
+        for child in list(parent):
+            if child.tag in ('alias', 'address', 'seclabel'):
+                parent.remove(child)
+        if len(parent) == 0 and parent.text and not parent.text.strip():
+            parent.text = None
+    for disk in root.findall('./devices/disk'):
+        disk.find('source').attrib.pop('index', None)
+        for backing_store in disk.findall('backingStore'):
+            disk.remove(backing_store)
+    for interface in root.findall('./devices/interface'):
+        for tag in ('mac', 'target'):
+            element = interface.find(tag)
+            if element is not None:
+                interface.remove(element)
+    for device in root.findall('./devices/serial') + \
+            root.findall('./devices/console'):
+        device.attrib.pop('tty', None)
+        source = device.find('source')
+        if source is not None:
+            device.remove(source)
+
+
+def apply_profile(root: ET.Element, profile: DeviceProfile) -> None:
+    ''' Apply a device profile to a stripped template. '''
+    devices = root.find('devices')
+    for disk in root.findall('./devices/disk'):
+        driver = disk.find('driver')
+        for attribute in ('cache', 'io', 'discard'):
+            value = getattr(profile, attribute)
+            if value:
+                driver.set(attribute, value)
+        disk.find('target').set('bus', profile.disk_bus)
+    if profile.disk_bus == 'scsi':
+        # No disk is left on SATA.  libvirt still lists the AHCI
+        # controller that is built into the q35 machine.
+        for controller in root.findall("./devices/controller[@type='sata']"):
+            devices.remove(controller)
+        controller = ET.SubElement(devices, 'controller',
+                                   {'type': 'scsi', 'index': '0',
+                                    'model': 'virtio-scsi'})
+        if profile.iothreads:
+            ET.SubElement(controller, 'driver', {'iothread': '1'})
+    if profile.iothreads:
+        iothreads = ET.Element('iothreads')
+        iothreads.text = str(profile.iothreads)
+        root.insert(list(root).index(root.find('vcpu')) + 1, iothreads)
+    for model in root.findall('./devices/interface/model'):
+        model.set('type', profile.nic_model)
+    if profile.lean:
+        for controller in root.findall('./devices/controller'):
+            if controller.get('type') == 'usb' or \
+                    controller.get('model') in ('pcie-root-port',
+                                                'pcie-to-pci-bridge'):
+                devices.remove(controller)
+        ET.SubElement(devices, 'controller',
+                      {'type': 'usb', 'index': '0', 'model': 'none'})
+
+
+# pylint: disable=too-many-arguments
+def render_domain(name: str, profile: str = 'template',
+                  image_dir: str = IMAGE_DIR,
+                  memory_mib: Optional[int] = None,
+                  vcpus: Optional[int] = None,
+                  template: str = TEMPLATE,
+                  placement: Optional[Allocation] = None) -> str:
+    ''' Return the domain XML for a new node, with its vCPUs pinned,
+        memory bound and hugepages as placed if placement is given. '''
+    root = ET.parse(template).getroot()
+    strip_runtime(root)
+    root.find('name').text = name
+    devices = root.find('devices')
+    for disk in root.findall("./devices/disk[@device='disk']"):
+        source = disk.find('source')
+        file_name = os.path.basename(source.get('file'))
+        if not file_name.endswith(DISKS):
+            devices.remove(disk)
+            continue
+        source.set('file', os.path.join(
+            image_dir, file_name.replace(TEMPLATE_NAME, name, 1)))
+    nvram = root.find('./os/nvram')
+    if nvram is not None:
+        nvram.text = os.path.join(NVRAM_DIR, f'{name}_VARS.qcow2')
+    if memory_mib:
+        for tag in ('memory', 'currentMemory'):
+            element = root.find(tag)
+            element.set('unit', 'KiB')
+            element.text = str(memory_mib * 1024)
+    if vcpus:
+        root.find('vcpu').text = str(vcpus)
+    apply_profile(root, PROFILES[profile])
+    validate_domain(root)
+    if placement:
+        apply_placement(root, placement)
+    ET.indent(root)
+    return ET.tostring(root, encoding='unicode')
+
+
+def define_domain(connection: libvirt.virConnect, name: str,
+                  profile: str = 'template', image_dir: str = IMAGE_DIR,
+                  **options) -> libvirt.virDomain:
+    ''' Define a new domain from the template. '''
+    logger.info('%s: defining from template with the %s profile',
+                name, profile)
+    return connection.defineXML(render_domain(name, profile, image_dir,
+                                              **options))
+
+
+def check_profiles(uri: str = 'test:///default',
+                   profiles: Optional[List[str]] = None) -> Dict[str, str]:
+    ''' Define every profile on a libvirt connection, normally the test
+        driver, and check the settings survive.  Returns the errors. '''
+    errors = {}
+    connection = libvirt.open(uri)
+    try:
+        for profile in profiles or list(PROFILES):
+            name = f'vms-check-{profile}'
+            try:
+                domain = define_domain(connection, name, profile)
+                try:
+                    check_domain(ET.fromstring(domain.XMLDesc(0)),
+                                 PROFILES[profile])
+                finally:
+                    domain.undefine()
+            except (libvirt.libvirtError, ValueError) as exp:
+                errors[profile] = str(exp)
+    finally:
+        connection.close()
+    return errors
+
+
+def check_domain(root: ET.Element, profile: DeviceProfile) -> None:
+    ''' Raise ValueError if a defined domain lost profile settings. '''
+    for disk in root.findall("./devices/disk[@device='disk']"):
+        driver = disk.find('driver')
+        for attribute in ('cache', 'io', 'discard'):
+            value = getattr(profile, attribute)
+            if value and driver.get(attribute) != value:
+                raise ValueError(f'disk {attribute} is'
+                                 f' {driver.get(attribute)}, not {value}')
+        if disk.find('target').get('bus') != profile.disk_bus:
+            raise ValueError(f'disk bus is not {profile.disk_bus}')
+    if profile.disk_bus == 'scsi' and root.find(
+            "./devices/controller[@model='virtio-scsi']") is None:
+        raise ValueError('no virtio-scsi controller')
+    for model in root.findall('./devices/interface/model'):
+        if model.get('type') != profile.nic_model:
+            raise ValueError(f'NIC model is not {profile.nic_model}')
+    if profile.iothreads and root.findtext('iothreads') != \
+            str(profile.iothreads):
+        raise ValueError(f'iothreads is not {profile.iothreads}')
+
+
+def validate_domain(root: ET.Element) -> None:
+    ''' Raise ValueError for what libvirt would refuse to define, or
+        define differently, without needing libvirt: duplicate disk
+        targets or controllers, a disk bus without its controller, an
+        unknown NIC model or I/O thread. '''
+    devices = root.find('devices')
+    targets = [disk.find('target').get('dev')
+               for disk in devices.findall('disk')]
+    if len(set(targets)) != len(targets):
+        raise ValueError(f'duplicate disk targets {targets}')
+    controllers = [(controller.get('type'), controller.get('index'))
+                   for controller in devices.findall('controller')
+                   if controller.get('type') != 'usb']
+    if len(set(controllers)) != len(controllers):
+        raise ValueError(f'duplicate controllers {controllers}')
+    machine = root.find('./os/type').get('machine', '')
+    for disk in devices.findall('disk'):
+        bus = disk.find('target').get('bus')
+        # The AHCI controller is built into q35, libvirt adds it.
+        if bus == 'sata' and 'q35' in machine:
+            continue
+        if bus in ('sata', 'scsi') and (bus, '0') not in controllers:
+            raise ValueError(f'disk on {bus} without a {bus} controller')
+    iothreads = int(root.findtext('iothreads') or 0)
+    for driver in devices.findall('./controller/driver[@iothread]'):
+        if not 1 <= int(driver.get('iothread')) <= iothreads:
+            raise ValueError(f'iothread {driver.get("iothread")} of'
+                             f' {iothreads}')
+    for model in devices.findall('./interface/model'):
+        if model.get('type') not in NIC_MODELS:
+            raise ValueError(f'unknown NIC model {model.get("type")}')
+
+
+def main():
+    ''' Main. '''
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter,
+        epilog='profiles:\n' + '\n'.join(
+            f'  {profile.name:10} {profile.description}'
+            for profile in PROFILES.values()))
+    parser.add_argument('name', nargs='?', help='name of the new domain')
+    parser.add_argument('--profile', choices=PROFILES, default='template',
+                        help='device profile (default template)')
+    parser.add_argument('--image-dir', default=IMAGE_DIR,
+                        help='directory of the disk images')
+    parser.add_argument('--memory', type=int, metavar='MIB',
+                        help='memory size in MiB')
+    parser.add_argument('--vcpus', type=int, help='number of vCPUs')
+    parser.add_argument('--define', action='store_true',
+                        help='define the domain instead of printing it')
+    parser.add_argument('--uri', default='qemu:///system',
+                        help='libvirt connection URI for --define')
+    parser.add_argument('--check', action='store_true',
+                        help='check every profile against the libvirt test'
+                        ' driver')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.check:
+        errors = check_profiles()
+        for profile in PROFILES:
+            print(f'{profile}: {errors.get(profile, "ok")}')
+        sys.exit(1 if errors else 0)
+    if not args.name:
+        parser.error('a domain name is needed')
+    options = {'memory_mib': args.memory, 'vcpus': args.vcpus}
+    if args.define:
+        connection = libvirt.open(args.uri)
+        define_domain(connection, args.name, args.profile, args.image_dir,
+                      **options)
+        connection.close()
+    else:
+        print(render_domain(args.name, args.profile, args.image_dir,
+                            **options))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,558 @@
+#!/usr/bin/python
+
+'''Synthetic OpenVMS console and console pipeline benchmark.
+
+   The emulator plays an OpenVMS guest on a Unix socket or a pty.  Its
+   prompts, and the answers it expects to them, come from the prompt
+   tables of the setup_vms_community_kvm.py profile; what follows each
+   answer is what the real system does: the boot manager boots on BOOT,
+   conversationally into SYSBOOT if the boot flags ask for it,
+   AUTHORIZE, NET$CONFIGURE and TCPIP$CONFIG ask their questions until
+   every answer in their tables is used, a shutdown boots again and logs
+   in after the startup job, and every DCL command is echoed and
+   followed by some output.  Answers that differ from the tables are
+   counted as errors.
+
+   On a Unix socket each connection is one guest, which first reads one
+   line of JSON with the target settings, as in the header of a console
+   recording.  `vms_kvm_emulator.py serve --pty`
+   plays one guest with the default target on a new pty instead, for a
+   terminal program to connect to.
+
+   `vms_kvm_emulator.py bench --nodes 200` starts a server and drives
+   that many consoles through the real dialogue engine at once, through
+   a stand-in for the libvirt console stream, and reports the nodes set
+   up per minute, the time from each prompt to its answer as seen by
+   the guests, and the CPU time and peak memory of the engine process.
+   Neither needs libvirt.'''
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import resource
+import socket
+import sys
+import tempfile
+import time
+import tty
+from typing import Dict, List, Optional
+
+from vms_kvm_replay import load_profile, offline_libvirt, percentile
+
+logger = logging.getLogger(__name__)
+
+# Profile played.  The 9.2-2 dialogue answers the login prompt twice,
+# which only works with the timing of a real boot.
+PROFILE = 'v923'
+# Prompt keys the emulator plays itself; the prompts of any other key
+# form the questions of the phase that a DCL command starts.
+BOOT_KEYS = ('ESC', 'BOOTMGR', 'SYSBOOT')
+LOGIN_KEYS = ('INTSET', 'USERNAME', 'PASSWORD')
+BASE_KEYS = BOOT_KEYS + LOGIN_KEYS + ('DOLLAR',)
+# DCL commands after which the guest is busy for a long time.
+LONG_COMMANDS = (b'startup.com', b'autogen')
+# Commands after which the guest boots again.
+REBOOT_COMMANDS = (b'shutdown',)
+FILLER = b'%EMULATOR-I-OUTPUT, synthetic console output\r\n'
+# Default console output after each command, and factor for boots and
+# long commands.
+OUTPUT_BYTES = 512
+LONG_OUTPUT = 16
+# Connections waiting to be accepted, at least.
+BACKLOG = 128
+# Lines a guest reads at most, a runaway controller is cut off.
+MAX_LINES = 10000
+
+
+class GuestError(Exception):
+    ''' The controller stopped answering the emulated guest. '''
+
+
+# pylint: disable=too-many-instance-attributes
+class Guest():
+    ''' One emulated OpenVMS console. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, name: str, profile, reader: asyncio.StreamReader,
+                 writer, delay: float = 0.0,
+                 output: int = OUTPUT_BYTES) -> None:
+        self.name = name
+        self.profile = profile
+        self.reader = reader
+        self.writer = writer
+        self.delay = delay
+        self.output = output
+        # Prompt key -> the first prompt text and the table of answers.
+        self.tables = {}
+        for text, key, answers in profile.prompts():
+            self.tables.setdefault(key, (text.encode('latin-1'), answers))
+        self.index = {key: 0 for key in self.tables}
+        self.latencies = []     # List [float]
+        self.errors = []        # List [dict]
+        self.lines = 0
+
+    async def write(self, data: bytes) -> None:
+        ''' Print on the console. '''
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def filler(self, size: int) -> None:
+        ''' Print size bytes of command output. '''
+        count, rest = divmod(size, len(FILLER))
+        await self.write(FILLER * count + FILLER[:rest])
+
+    async def readline(self) -> bytes:
+        ''' Read one answer, up to its CR. '''
+        self.lines += 1
+        if self.lines > MAX_LINES:
+            raise GuestError(f'more than {MAX_LINES} lines')
+        try:
+            line = await self.reader.readuntil(b'\r')
+        except asyncio.IncompleteReadError as exp:
+            raise GuestError('console closed') from exp
+        return line[:-1].lstrip(b'\n')
+
+    async def ask(self, key: str) -> bytes:
+        ''' Print the prompt of a key, and read and check its answer. '''
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        text, answers = self.tables[key]
+        await self.write(text)
+        start = time.monotonic()
+        answer = await self.readline()
+        self.latencies.append(time.monotonic() - start)
+        index = self.index[key]
+        expected = answers[index] if index < len(answers) else None
+        if answer != expected:
+            self.errors.append({'prompt': key, 'index': index,
+                                'expected': repr(expected),
+                                'received': repr(answer)})
+            logger.warning('%s: %s answer %d was %r, not %r', self.name,
+                           key, index, answer, expected)
+        self.index[key] = index + 1
+        if key not in ('ESC', 'PASSWORD'):
+            await self.write(answer + b'\r\n')
+        return answer
+
+    async def boot(self) -> None:
+        ''' Boot: the firmware and boot manager prompts, then either
+            SYSBOOT and the DCL prompt of a minimal startup, or the
+            startup job and a login. '''
+        await self.filler(self.output)
+        await self.ask('ESC')
+        while not (await self.ask('BOOTMGR')).upper().startswith(b'BOOT'):
+            pass
+        flags = self.tables['BOOTMGR'][1][self.index['BOOTMGR'] - 1]
+        await self.filler(LONG_OUTPUT * self.output)
+        if flags.split()[-1:] == [b'1'] and 'SYSBOOT' in self.tables:
+            while (await self.ask('SYSBOOT')).upper() != b'CONTINUE':
+                pass
+            await self.filler(LONG_OUTPUT * self.output)
+            return
+        for key in LOGIN_KEYS:
+            if key in self.tables:
+                await self.ask(key)
+
+    def questions(self, phase_name: str) -> List[str]:
+        ''' Return the keys of the questions of a phase, in table order. '''
+        keys = []
+        for _text, key, _answers in self.profile.phases[phase_name].prompts:
+            if key not in BASE_KEYS and key not in keys:
+                keys.append(key)
+        return keys
+
+    async def command(self, cmd: bytes) -> None:
+        ''' Carry out a DCL command. '''
+        lower = cmd.lower()
+        phase_name = self.profile.command_phases.get(cmd)
+        if phase_name:
+            for key in self.questions(phase_name):
+                while self.index[key] < len(self.tables[key][1]):
+                    await self.ask(key)
+        if any(word in lower for word in REBOOT_COMMANDS):
+            await self.boot()
+        elif any(word in lower for word in LONG_COMMANDS):
+            await self.filler(LONG_OUTPUT * self.output)
+        else:
+            await self.filler(self.output)
+
+    def complete(self) -> bool:
+        ''' Return whether every DCL command was received. '''
+        return self.index['DOLLAR'] >= len(self.tables['DOLLAR'][1])
+
+    async def run(self) -> dict:
+        ''' Play the guest until the controller closes the console, and
+            return a report. '''
+        start = time.monotonic()
+        failure = None
+        try:
+            await self.boot()
+            while not self.complete():
+                await self.command(await self.ask('DOLLAR'))
+            # The controller closes the console at this last prompt,
+            # possibly before it is even flushed.
+            await self.ask('DOLLAR')
+        except (GuestError, ConnectionError) as exp:
+            if not self.complete():
+                failure = f'{self.name}: {exp}'
+        return {'name': self.name, 'complete': failure is None,
+                'failure': failure, 'errors': self.errors,
+                'seconds': round(time.monotonic() - start, 3),
+                'latencies': [round(value, 6) for value in self.latencies]}
+
+
+def guest_for(header: dict, reader, writer, delay: float,
+              output: int) -> Guest:
+    ''' Return a guest for a recording style header. '''
+    target, profile = load_profile(header)
+    return Guest(target.name, profile, reader, writer, delay, output)
+
+
+async def serve_socket(path: str, count: int, delay: float,
+                       output: int) -> None:
+    ''' Play a guest on every connection to a Unix socket, printing a
+        JSON report line for each, until count guests are done. '''
+    done = asyncio.Event()
+    served = 0
+
+    async def connected(reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter) -> None:
+        nonlocal served
+        try:
+            header = json.loads(await reader.readline())
+            report = await guest_for(header, reader, writer, delay,
+                                     output).run()
+        except (ValueError, KeyError) as exp:
+            report = {'complete': False, 'failure': f'bad header: {exp}'}
+        writer.close()
+        print(json.dumps(report), flush=True)
+        served += 1
+        if count and served >= count:
+            done.set()
+
+    # Controllers connect their consoles all at once, and block when
+    # the backlog is full.
+    server = await asyncio.start_unix_server(
+        connected, path, limit=1 << 20, backlog=max(count, BACKLOG))
+    async with server:
+        await done.wait()
+
+
+async def serve_pty(header: dict, delay: float, output: int) -> dict:
+    ''' Play one guest on a new pty. '''
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print(f'console on {os.ttyname(slave)}', flush=True)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    # pylint: disable=consider-using-with
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader),
+        open(master, 'rb', buffering=0, closefd=False))
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, open(master, 'wb', buffering=0))
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    try:
+        return await guest_for(header, reader, writer, delay, output).run()
+    finally:
+        writer.close()
+        os.close(slave)
+
+
+class SocketStream():
+    ''' Non-blocking console stream on a Unix socket, with the methods
+        of libvirt.virStream the console engine uses. '''
+    # Values of libvirt.VIR_STREAM_EVENT_READABLE and _HANGUP.
+    READABLE = 1
+    HANGUP = 8
+
+    def __init__(self) -> None:
+        self.sock = None    # Optional [socket.socket]
+        self.callback = None
+
+    def connect(self, path: str, header: bytes) -> None:
+        ''' Connect to the emulator and name the guest to play. '''
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.sock.sendall(header)
+        self.sock.setblocking(False)
+
+    def recv(self, nbytes: int):
+        ''' Return up to nbytes, -2 if none are ready, b'' at the end. '''
+        try:
+            return self.sock.recv(nbytes)
+        except BlockingIOError:
+            return -2
+
+    def send(self, data: bytes) -> int:
+        ''' Send what fits, -2 if nothing does. '''
+        try:
+            return self.sock.send(data)
+        except BlockingIOError:
+            return -2
+
+    # pylint: disable=invalid-name
+    def eventAddCallback(self, _events: int, callback, opaque) -> None:
+        ''' Call callback from the event loop when data arrives. '''
+        self.callback = (callback, opaque)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(),
+                                              self.readable)
+
+    def readable(self) -> None:
+        ''' Dispatch a readable event, or a hangup once at the end. '''
+        callback, opaque = self.callback
+        try:
+            ended = not self.sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return
+        if ended:
+            self.eventRemoveCallback()
+        callback(self, self.HANGUP if ended else self.READABLE, opaque)
+
+    def eventRemoveCallback(self) -> None:
+        ''' Stop watching the socket. '''
+        if self.callback:
+            asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.callback = None
+
+    def abort(self) -> None:
+        ''' Close the console. '''
+        self.eventRemoveCallback()
+        if self.sock:
+            self.sock.close()
+
+
+class EmulatedDomain():
+    ''' Running domain whose console is an emulated guest. '''
+    def __init__(self, name: str, path: str, header: bytes) -> None:
+        self.name = name
+        self.path = path
+        self.header = header
+        self.opened = False
+
+    def state(self, _flags: int) -> list:
+        ''' Always running. '''
+        return [1, 1]
+
+    def isActive(self) -> bool:    # pylint: disable=invalid-name
+        ''' Running until its console was opened and closed again. '''
+        return not self.opened
+
+    # pylint: disable=invalid-name
+    def openConsole(self, _dev, stream: SocketStream, _flags: int) -> None:
+        ''' Connect the stream to a new emulated guest. '''
+        stream.connect(self.path, self.header)
+        self.opened = True
+
+
+class EmulatedConnection():
+    ''' Connection with one domain played by the emulator. '''
+    def __init__(self, name: str, path: str, header: dict) -> None:
+        self.domain = EmulatedDomain(
+            name, path, json.dumps(header).encode('utf-8') + b'\n')
+
+    # pylint: disable=invalid-name
+    def lookupByName(self, _name: str) -> EmulatedDomain:
+        ''' Return the domain. '''
+        return self.domain
+
+    @staticmethod
+    def newStream(_flags: int) -> SocketStream:
+        ''' Return an unconnected console stream. '''
+        return SocketStream()
+
+    def domainEventRegisterAny(self, *_args) -> int:
+        ''' No events are ever delivered. '''
+        return 0
+
+    def domainEventDeregisterAny(self, _callback_id: int) -> None:
+        ''' Nothing to deregister. '''
+
+
+def bench_header(index: int) -> dict:
+    ''' Return the header of the index'th benchmark node. '''
+    return {'profile': PROFILE,
+            'settings': {'name': f'emu{index:04d}',
+                         'decnet': f'{1 + index // 1000}.{1 + index % 1000}',
+                         'domain': 'bench.example', 'password': 'bench'}}
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    ''' Return millisecond percentiles of latencies in seconds. '''
+    return {'count': len(values),
+            'p50_ms': round(1000 * percentile(values, 0.50), 3),
+            'p90_ms': round(1000 * percentile(values, 0.90), 3),
+            'p99_ms': round(1000 * percentile(values, 0.99), 3),
+            'max_ms': round(1000 * max(values, default=0.0), 3)}
+
+
+async def collect(stdout: asyncio.StreamReader, reports: List[dict]) -> None:
+    ''' Read the guest reports of an emulator until it exits. '''
+    while True:
+        line = await stdout.readline()
+        if not line:
+            return
+        reports.append(json.loads(line))
+
+
+# pylint: disable=too-many-arguments, too-many-locals
+async def bench(nodes: int, delay: float = 0.0,
+                output: int = OUTPUT_BYTES, typeahead: bool = False,
+                timeout: float = 600.0) -> dict:
+    ''' Set up nodes emulated consoles at once through the dialogue
+        engine and return the throughput, latency and resource use. '''
+    offline_libvirt()
+    # pylint: disable=import-outside-toplevel
+    import vms_kvm_dialogue as dialogue
+
+    directory = tempfile.mkdtemp(prefix='vms-emulator-')
+    path = os.path.join(directory, 'console.sock')
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), 'serve', '--socket',
+        path, '--count', str(nodes), '--delay', str(delay), '--output',
+        str(output), stdout=asyncio.subprocess.PIPE)
+    try:
+        while not os.path.exists(path):
+            if server.returncode is not None:
+                raise RuntimeError('emulator exited')
+            await asyncio.sleep(0.05)
+        consoles = []
+        for index in range(nodes):
+            header = bench_header(index)
+            target, profile = load_profile(header)
+            console = dialogue.Console(
+                EmulatedConnection(target.name, path, header), target,
+                profile)
+            console.intset_delay = 0
+            console.typeahead = typeahead
+            consoles.append(console)
+        # Reports are read as they come, a full pipe would stall the
+        # emulator.
+        reports = []
+        collector = asyncio.create_task(collect(server.stdout, reports))
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.monotonic()
+        finished = []
+
+        async def run(console) -> None:
+            await dialogue.run_console(console)
+            finished.append(time.monotonic() - start)
+
+        done, pending = await asyncio.wait(
+            [asyncio.create_task(run(console)) for console in consoles],
+            timeout=timeout)
+        wall = time.monotonic() - start
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        for task in done:
+            if task.exception():
+                logger.error('dialogue failed: %s', task.exception())
+        for task in pending:
+            task.cancel()
+        for console in consoles:
+            if console.run_console:
+                logger.error('%s: not done in phase %s, recent output:\n%s',
+                             console.name, console.phase.name,
+                             console.session.ring.text()[-300:])
+                console.finish()
+        try:
+            await asyncio.wait_for(collector, 10.0)
+        except asyncio.TimeoutError:
+            logger.error('%d of %d guest reports received', len(reports),
+                         nodes)
+    finally:
+        if server.returncode is None:
+            server.terminate()
+        await server.wait()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(directory)
+    cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime)
+    complete = [report for report in reports
+                if report['complete'] and not report['errors']]
+    engine = [value for console in consoles
+              for values in console.session.metrics.responses.values()
+              for value in values]
+    return {
+        'nodes': nodes,
+        'typeahead': typeahead,
+        'delay_seconds': delay,
+        'output_bytes': output,
+        'complete': len(complete),
+        'failed': nodes - len(complete),
+        'answer_errors': sum(len(report.get('errors', ()))
+                             for report in reports),
+        'wall_seconds': round(wall, 3),
+        'nodes_per_minute': round(60.0 * len(complete) / wall, 1)
+        if wall else 0.0,
+        'node_seconds_p50': round(percentile(finished, 0.50), 3),
+        'node_seconds_max': round(max(finished, default=0.0), 3),
+        'prompt_to_answer': latency_summary(
+            [value for report in reports
+             for value in report.get('latencies', ())]),
+        'engine_response': latency_summary(engine),
+        'controller_cpu_seconds': round(cpu, 3),
+        'controller_cpu_percent': round(100.0 * cpu / wall, 1)
+        if wall else 0.0,
+        'controller_max_rss_mib': round(after.ru_maxrss / 1024, 1),
+        'bytes_received': sum(console.session.metrics.bytes_received
+                              for console in consoles),
+        'callbacks': sum(console.session.metrics.callbacks
+                         for console in consoles)}
+
+
+def main():
+    ''' Main. '''
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    serve = subparsers.add_parser('serve', help='play emulated guests')
+    where = serve.add_mutually_exclusive_group(required=True)
+    where.add_argument('--socket', metavar='PATH',
+                       help='Unix socket to play a guest on per connection')
+    where.add_argument('--pty', action='store_true',
+                       help='play one guest on a new pty')
+    serve.add_argument('--count', type=int, default=0,
+                       help='exit after COUNT guests (default never)')
+    serve.add_argument('--name', default='robin',
+                       help='node name of the --pty guest')
+    run = subparsers.add_parser('bench', help='benchmark the console'
+                                ' engine with emulated guests')
+    run.add_argument('--nodes', type=int, default=100,
+                     help='consoles set up at once (default 100)')
+    run.add_argument('--typeahead', action='store_true',
+                     help='type simple DCL commands ahead')
+    run.add_argument('--timeout', type=float, default=600.0,
+                     help='seconds before the run is cut off')
+    for sub in (serve, run):
+        sub.add_argument('--delay', type=float, default=0.0,
+                         help='seconds a guest waits before each prompt')
+        sub.add_argument('--output', type=int, default=OUTPUT_BYTES,
+                         metavar='BYTES', help='console output after each'
+                         f' command (default {OUTPUT_BYTES}, {LONG_OUTPUT}'
+                         ' times that for boots and long commands)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.action == 'bench':
+        # The progress the dialogue prints is kept out of the report.
+        with contextlib.redirect_stdout(sys.stderr):
+            results = asyncio.run(bench(args.nodes, args.delay,
+                                        args.output, args.typeahead,
+                                        args.timeout))
+        print(json.dumps(results, indent=2))
+        sys.exit(1 if results['failed'] else 0)
+    if args.socket:
+        asyncio.run(serve_socket(args.socket, args.count, args.delay,
+                                 args.output))
+        return
+    header = {'profile': PROFILE,
+              'settings': {'name': args.name, 'decnet': '1.13'}}
+    report = asyncio.run(serve_pty(header, args.delay, args.output))
+    report.pop('latencies')
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
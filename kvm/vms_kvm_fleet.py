@@ -0,0 +1,165 @@
+'''Fleet support for the OpenVMS console scripts.
+
+   A fleet is a list of target nodes that are provisioned together from
+   one process.  Each target gets its own Console state machine, while
+   all of them share pooled libvirt connections and one event loop.'''
+
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+
+import libvirt     # type: ignore
+
+logger = logging.getLogger(__name__)
+
+
+def to_bytes(value) -> bytes:
+    ''' Encode a setting the way the console dialogue sends it. '''
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8', 'replace')
+
+
+# pylint: disable=too-many-instance-attributes, too-few-public-methods
+class Target():
+    ''' Per node settings for one OpenVMS domain. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, name: str, decnet_area: int, decnet_number: int,
+                 domain: str = '', gateway_address: str = '',
+                 gateway_hostname: str = '', bind_server: str = '',
+                 bind_address: str = '', scsnode: Optional[str] = None,
+                 root: str = 'sys0', uri: Optional[str] = None,
+                 password: str = '', address: Optional[str] = None,
+                 tuning: Optional[str] = None,
+                 modparams: Optional[Dict[str, int]] = None) -> None:
+        # Everything but the password, safe to write into transcripts.
+        self.settings = {
+            'name': name, 'decnet_area': decnet_area,
+            'decnet_number': decnet_number, 'domain': domain,
+            'gateway_address': gateway_address,
+            'gateway_hostname': gateway_hostname,
+            'bind_server': bind_server, 'bind_address': bind_address,
+            'scsnode': scsnode, 'root': root, 'uri': uri,
+            'address': address, 'tuning': tuning, 'modparams': modparams}
+        self.name = name
+        self.name_upper_str = name.upper()
+        self.scsnode_str = scsnode or name
+        self.scsnode = to_bytes(self.scsnode_str)
+        self.root = to_bytes(root)
+        self.decnet_area_int = int(decnet_area)
+        self.decnet_number_int = int(decnet_number)
+        self.scssystemid_int = \
+            self.decnet_area_int * 1024 + self.decnet_number_int
+        self.decnet_area = to_bytes(self.decnet_area_int)
+        self.decnet_number = to_bytes(self.decnet_number_int)
+        self.scssystemid = to_bytes(self.scssystemid_int)
+        self.domain = to_bytes(domain)
+        self.gateway_address = to_bytes(gateway_address)
+        self.gateway_hostname = to_bytes(gateway_hostname)
+        self.bind_server = to_bytes(bind_server)
+        self.bind_address = to_bytes(bind_address)
+        self.uri = uri
+        # IP address or host name to probe, found via libvirt if None.
+        self.address = address
+        self.password = to_bytes(password)
+        # AUTOGEN tuning profile, and the MODPARAMS.DAT entries it gave
+        # for the domain once it is known.
+        self.tuning = tuning
+        self.modparams = modparams
+
+    @classmethod
+    def from_dict(cls, spec: Dict, defaults: Optional[Dict] = None):
+        ''' Build a target from a fleet file entry. '''
+        settings = dict(defaults or {})
+        settings.update(spec)
+        if 'decnet' in settings:
+            area, number = str(settings.pop('decnet')).split('.')
+            settings['decnet_area'] = area
+            settings['decnet_number'] = number
+        return cls(**settings)
+
+
+def load_fleet(path: str, defaults: Optional[Dict] = None) -> List[Target]:
+    ''' Load target specs from a JSON fleet file.
+
+        The file is either a list of targets, or an object with an
+        optional "defaults" object and a "targets" list.  Every target
+        needs a name and a DECnet address, either as "decnet": "1.13"
+        or as separate decnet_area and decnet_number values.'''
+    with open(path, 'r', encoding='utf-8') as fleet_file:
+        fleet = json.load(fleet_file)
+    settings = dict(defaults or {})
+    if isinstance(fleet, dict):
+        settings.update(fleet.get('defaults', {}))
+        fleet = fleet['targets']
+    targets = [Target.from_dict(spec, settings) for spec in fleet]
+    names = [target.name for target in targets]
+    ids = [target.scssystemid_int for target in targets]
+    if len(set(names)) != len(names) or len(set(ids)) != len(ids):
+        raise ValueError(f'{path}: duplicate target name or DECnet address')
+    return targets
+
+
+class ConnectionPool():
+    ''' Hands out one shared libvirt connection per URI. '''
+    def __init__(self) -> None:
+        self.connections = {}   # Dict [str, libvirt.virConnect]
+
+    def get(self, uri: str) -> libvirt.virConnect:
+        ''' Return the pooled connection for uri, opening it if needed. '''
+        connection = self.connections.get(uri)
+        if connection is None or not connection.isAlive():
+            connection = libvirt.open(uri)
+            self.connections[uri] = connection
+        return connection
+
+    def close(self) -> None:
+        ''' Close all pooled connections. '''
+        for connection in self.connections.values():
+            try:
+                connection.close()
+            except libvirt.libvirtError:
+                pass
+        self.connections = {}
+
+
+class FleetProgress():
+    ''' Aggregate progress reporting for a set of consoles. '''
+    def __init__(self, consoles: List, interval: float = 30.0) -> None:
+        self.consoles = consoles
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last_report = self.start
+        self.finished = {}   # Dict [str, float]
+        # The finished consoles that failed.
+        self.failed = set()
+
+    def done(self, console, failed: bool = False) -> None:
+        ''' Record that a console has completed, or failed. '''
+        if console.name not in self.finished:
+            elapsed = time.monotonic() - self.start
+            self.finished[console.name] = elapsed
+            if failed:
+                self.failed.add(console.name)
+            logger.info('%s %s after %.0f seconds (%d of %d)',
+                        console.name, 'failed' if failed else 'complete',
+                        elapsed, len(self.finished), len(self.consoles))
+            self.report(force=True)
+
+    def report(self, force: bool = False) -> None:
+        ''' Log the fleet progress if the report interval has passed. '''
+        now = time.monotonic()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        sent = 0
+        total = 0
+        for console in self.consoles:
+            done, count = console.progress()
+            sent += done
+            total += count
+        logger.info('fleet: %d of %d nodes complete, %d failed, %d of %d'
+                    ' commands sent, %.0f seconds elapsed',
+                    len(self.finished), len(self.consoles),
+                    len(self.failed), sent, total, now - self.start)
@@ -0,0 +1,194 @@
+'''Golden image support for the OpenVMS console scripts.
+
+   After a full install the configured system disk, NVRAM and TPM state
+   of the domain are saved as a read-only golden image.  New domains are
+   then defined as thin qcow2 overlays on that image, so only the per
+   node identity needs to be changed on their first boot instead of
+   running the whole BOOTMGR, SYSBOOT, AUTOGEN and configuration dialogue
+   again.'''
+
+import json
+import logging
+import os
+import shutil
+import stat
+import uuid
+import xml.etree.ElementTree as ET
+from typing import Dict, Optional
+
+import libvirt     # type: ignore
+
+from vms_kvm_image import NODE_DISKS, backing_chain, create_image, image_size
+from vms_kvm_placement import Allocation, apply_placement, clear_placement
+
+logger = logging.getLogger(__name__)
+
+SWTPM_DIR = '/var/lib/libvirt/swtpm'
+NVRAM_DIR = '/var/lib/libvirt/qemu/nvram'
+
+GOLDEN_DISK = 'system.qcow2'
+GOLDEN_NVRAM = 'VARS.qcow2'
+GOLDEN_TPM = 'tpm'
+GOLDEN_XML = 'domain.xml'
+GOLDEN_INFO = 'golden.json'
+
+READ_ONLY = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def system_disk(root: ET.Element) -> ET.Element:
+    ''' Return the disk element of the system disk, the first disk. '''
+    disk = root.find("./devices/disk[@device='disk']")
+    if disk is None:
+        raise ValueError('domain has no disk')
+    return disk
+
+
+def data_disks(root: ET.Element) -> Dict[str, ET.Element]:
+    ''' Return the disk elements after the system disk by the suffix of
+        their file name.  Raises ValueError for any other disk. '''
+    suffixes = [NODE_DISKS[role] for role in NODE_DISKS if role != 'system']
+    disks = {}
+    for disk in root.findall("./devices/disk[@device='disk']")[1:]:
+        file_name = disk.find('source').get('file', '')
+        suffix = next((suffix for suffix in suffixes
+                       if file_name.endswith(suffix)), None)
+        if suffix is None or suffix in disks:
+            raise ValueError(f'can not clone disk {file_name}, only the'
+                             f' {", ".join(suffixes)} disks of a node')
+        disks[suffix] = disk
+    return disks
+
+
+def make_read_only(path: str) -> None:
+    ''' Make a file, or every file below a directory, read-only. '''
+    if os.path.isdir(path):
+        for parent, _dirs, files in os.walk(path):
+            for name in files:
+                os.chmod(os.path.join(parent, name), READ_ONLY)
+    else:
+        os.chmod(path, READ_ONLY)
+
+
+def save_golden(domain: libvirt.virDomain, golden_dir: str,
+                settings: Optional[dict] = None) -> None:
+    ''' Save a shut off, fully configured domain as a golden image. '''
+    if domain.isActive():
+        raise ValueError(f'{domain.name()} must be shut off to save it')
+    root = ET.fromstring(domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+    # Data disks are not saved, only their size to give clones empty
+    # disks of their own.
+    sizes = {}
+    for suffix, disk in data_disks(root).items():
+        driver = disk.find('driver')
+        image_format = 'qcow2' if driver is None else \
+            driver.get('type', 'qcow2')
+        sizes[suffix] = image_size(disk.find('source').get('file'),
+                                   image_format)
+    os.makedirs(golden_dir, exist_ok=True)
+
+    # The system disk keeps its own backing file reference, so the
+    # golden image is itself a small overlay on the distribution image.
+    disk_file = system_disk(root).find('source').get('file')
+    logger.info('%s: saving %s', domain.name(), disk_file)
+    shutil.copyfile(disk_file, os.path.join(golden_dir, GOLDEN_DISK))
+
+    nvram = root.find('./os/nvram')
+    if nvram is not None and nvram.text:
+        shutil.copyfile(nvram.text, os.path.join(golden_dir, GOLDEN_NVRAM))
+
+    tpm_state = os.path.join(SWTPM_DIR, domain.UUIDString())
+    if root.find('./devices/tpm') is not None and os.path.isdir(tpm_state):
+        golden_tpm = os.path.join(golden_dir, GOLDEN_TPM)
+        shutil.rmtree(golden_tpm, ignore_errors=True)
+        shutil.copytree(tpm_state, golden_tpm)
+
+    with open(os.path.join(golden_dir, GOLDEN_XML), 'w',
+              encoding='utf-8') as xml_file:
+        xml_file.write(ET.tostring(root, encoding='unicode'))
+    with open(os.path.join(golden_dir, GOLDEN_INFO), 'w',
+              encoding='utf-8') as info_file:
+        json.dump({'source': domain.name(), 'settings': settings or {},
+                   'disks': sizes}, info_file, indent=2)
+    for name in (GOLDEN_DISK, GOLDEN_NVRAM, GOLDEN_TPM):
+        path = os.path.join(golden_dir, name)
+        if os.path.exists(path):
+            make_read_only(path)
+    logger.info('%s: golden image saved in %s', domain.name(), golden_dir)
+
+
+def create_overlay(path: str, backing: str) -> None:
+    ''' Create a qcow2 overlay on a backing file. '''
+    backing_chain(backing)
+    create_image(path, backing=backing)
+
+
+def clone_domain(connection: libvirt.virConnect, golden_dir: str,
+                 name: str, image_dir: str,
+                 placement: Optional[Allocation] = None) -> libvirt.virDomain:
+    ''' Define a new domain as a thin overlay on a golden image, placed
+        on host CPUs, a NUMA node and hugepages if placement is given. '''
+    with open(os.path.join(golden_dir, GOLDEN_XML), 'r',
+              encoding='utf-8') as xml_file:
+        root = ET.fromstring(xml_file.read())
+    new_uuid = str(uuid.uuid4())
+    root.find('name').text = name
+    uuid_element = root.find('uuid')
+    if uuid_element is None:
+        uuid_element = ET.SubElement(root, 'uuid')
+    uuid_element.text = new_uuid
+    for interface in root.findall('./devices/interface'):
+        # Let libvirt generate a new MAC address.
+        mac = interface.find('mac')
+        if mac is not None:
+            interface.remove(mac)
+
+    # The system disk is an overlay on the golden image, the data disks
+    # belong to the node the image was made from, so each clone gets
+    # new empty ones of the same size.
+    disk = system_disk(root)
+    overlay = os.path.join(image_dir, name + NODE_DISKS['system'])
+    if os.path.exists(overlay):
+        raise ValueError(f'{overlay} already exists')
+    with open(os.path.join(golden_dir, GOLDEN_INFO), 'r',
+              encoding='utf-8') as info_file:
+        sizes = json.load(info_file).get('disks', {})
+    for suffix, data_disk in data_disks(root).items():
+        if suffix not in sizes:
+            raise ValueError(f'{golden_dir}: no size saved for the'
+                             f' {suffix} disk, save the golden image again')
+        path = os.path.join(image_dir, name + suffix)
+        if not os.path.exists(path):
+            create_image(path, size=sizes[suffix])
+        data_disk.find('source').set('file', path)
+        driver = data_disk.find('driver')
+        if driver is not None:
+            driver.set('type', 'qcow2')
+    create_overlay(overlay, os.path.join(golden_dir, GOLDEN_DISK))
+    disk.find('source').set('file', overlay)
+    backing_store = disk.find('backingStore')
+    if backing_store is not None:
+        disk.remove(backing_store)
+
+    nvram = root.find('./os/nvram')
+    golden_nvram = os.path.join(golden_dir, GOLDEN_NVRAM)
+    if nvram is not None and os.path.exists(golden_nvram):
+        nvram.text = os.path.join(NVRAM_DIR, f'{name}_VARS.qcow2')
+        shutil.copyfile(golden_nvram, nvram.text)
+        os.chmod(nvram.text, stat.S_IRUSR | stat.S_IWUSR)
+
+    golden_tpm = os.path.join(golden_dir, GOLDEN_TPM)
+    if os.path.isdir(golden_tpm):
+        tpm_state = os.path.join(SWTPM_DIR, new_uuid)
+        shutil.copytree(golden_tpm, tpm_state)
+        for parent, _dirs, files in os.walk(tpm_state):
+            for file_name in files:
+                os.chmod(os.path.join(parent, file_name),
+                         stat.S_IRUSR | stat.S_IWUSR)
+
+    # The pinning of the domain the image was saved from is not reused.
+    if placement:
+        apply_placement(root, placement)
+    else:
+        clear_placement(root)
+    logger.info('%s: defining clone of %s', name, golden_dir)
+    return connection.defineXML(ET.tostring(root, encoding='unicode'))
@@ -0,0 +1,345 @@
+#!/usr/bin/python
+
+'''qcow2 disk images for OpenVMS guests without qemu-img.
+
+   Writes version 3 qcow2 images directly: overlays that only hold a
+   header pointing at their backing file, and empty data disks with a
+   chosen cluster size, optionally with their metadata preallocated.
+   Headers are read back to check the backing chain of a disk before
+   the domain using it is booted.  Images only hold metadata, so the
+   disks of a whole fleet are created in parallel in a few seconds.
+
+   Layout of a new image, one cluster each unless noted: the header
+   with its extensions and backing file name, the refcount table, the
+   refcount blocks, the L1 table, then with metadata preallocation the
+   L2 tables, followed by the (sparse) data clusters.'''
+
+import argparse
+import array
+import concurrent.futures
+import logging
+import os
+import struct
+import sys
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'QFI\xfb'
+VERSION = 3
+HEADER = struct.Struct('>4sIQIIQIIQQIIQQQQII')
+EXTENSION = struct.Struct('>II')
+EXT_END = 0
+EXT_BACKING_FORMAT = 0xe2792aca
+# Refcounts are 16 bit, refcount_order 4.
+REFCOUNT_ORDER = 4
+# L1 and L2 entry flag: the cluster has a refcount of exactly one.
+OFLAG_COPIED = 1 << 63
+OFFSET_MASK = 0x00fffffffffffe00
+# Incompatible feature bits: dirty, corrupt, external data file,
+# compression type, extended L2 entries.
+INCOMPATIBLE_DIRTY = 1
+INCOMPATIBLE_CORRUPT = 2
+INCOMPATIBLE_KNOWN = 0x1f
+
+PREALLOCATION = ('off', 'metadata')
+BASE_IMAGE = '/var/lib/libvirt/images/community-flat_v923.qcow2'
+GIB = 1024 * 1024 * 1024
+
+
+def ceil_div(value: int, divisor: int) -> int:
+    ''' Integer division rounding up. '''
+    return -(-value // divisor)
+
+
+def parse_size(text: str) -> int:
+    ''' Parse a size such as 512M or 8G into bytes. '''
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.strip().upper().rstrip('B').rstrip('I')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def big_endian(values: array.array) -> bytes:
+    ''' Return the bytes of an array of integers in big endian order. '''
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+# pylint: disable=too-many-arguments, too-many-locals
+def create_image(path: str, size: Optional[int] = None,
+                 backing: Optional[str] = None,
+                 backing_format: str = 'qcow2', cluster_bits: int = 16,
+                 preallocation: str = 'off') -> None:
+    ''' Create a qcow2 image, an overlay if backing is given.
+
+        The size of an overlay defaults to that of its backing file.
+        Metadata preallocation allocates every L2 table and maps every
+        data cluster, so the guest never extends the metadata, but the
+        data clusters stay holes in a sparse file.  An existing file is
+        never overwritten, that raises ValueError as well.'''
+    if os.path.exists(path):
+        raise ValueError(f'{path} already exists')
+    if not 9 <= cluster_bits <= 21:
+        raise ValueError(f'cluster_bits {cluster_bits} not in 9..21')
+    if preallocation not in PREALLOCATION:
+        raise ValueError(f'Unknown preallocation {preallocation}')
+    if backing:
+        backing = os.path.abspath(backing)
+        if size is None:
+            size = image_size(backing, backing_format)
+    if not size:
+        raise ValueError(f'{path}: size needed')
+    metadata = preallocation == 'metadata'
+    cluster_size = 1 << cluster_bits
+    l2_entries = cluster_size // 8
+    data_clusters = ceil_div(size, cluster_size)
+    l1_size = ceil_div(data_clusters, l2_entries)
+    l1_clusters = max(1, ceil_div(l1_size * 8, cluster_size))
+    l2_clusters = l1_size if metadata else 0
+    data = data_clusters if metadata else 0
+
+    # The refcount structures count themselves, so size them until
+    # they cover every cluster including their own.
+    refs_per_block = cluster_size * 8 >> REFCOUNT_ORDER
+    table_clusters = 1
+    block_clusters = 1
+    while True:
+        total = 1 + table_clusters + block_clusters + l1_clusters + \
+            l2_clusters + data
+        blocks = ceil_div(total, refs_per_block)
+        tables = ceil_div(blocks * 8, cluster_size)
+        if (blocks, tables) == (block_clusters, table_clusters):
+            break
+        block_clusters, table_clusters = blocks, tables
+    table_offset = cluster_size
+    block_offset = table_offset + table_clusters * cluster_size
+    l1_offset = block_offset + block_clusters * cluster_size
+    l2_offset = l1_offset + l1_clusters * cluster_size
+    data_offset = l2_offset + l2_clusters * cluster_size
+
+    extensions = b''
+    backing_name = b''
+    if backing:
+        backing_name = backing.encode('utf-8')
+        name = backing_format.encode('ascii')
+        extensions += EXTENSION.pack(EXT_BACKING_FORMAT, len(name)) + \
+            name + bytes(-len(name) % 8)
+    extensions += EXTENSION.pack(EXT_END, 0)
+    backing_offset = HEADER.size + len(extensions) if backing else 0
+    header = HEADER.pack(
+        MAGIC, VERSION, backing_offset, len(backing_name), cluster_bits,
+        size, 0, l1_size, l1_offset, table_offset, table_clusters, 0, 0,
+        0, 0, 0, REFCOUNT_ORDER, HEADER.size) + extensions + backing_name
+    if len(header) > cluster_size:
+        raise ValueError(f'{path}: backing file name too long')
+
+    table = array.array('Q', (block_offset + index * cluster_size
+                              for index in range(block_clusters)))
+    refcounts = array.array('H', [1]) * total
+    l1_table = array.array('Q', [0]) * l1_size
+    if metadata:
+        l1_table = array.array('Q', (
+            (l2_offset + index * cluster_size) | OFLAG_COPIED
+            for index in range(l1_size)))
+
+    with open(path, 'xb') as image:
+        image.write(header)
+        image.seek(table_offset)
+        image.write(big_endian(table))
+        image.seek(block_offset)
+        image.write(big_endian(refcounts))
+        image.seek(l1_offset)
+        image.write(big_endian(l1_table))
+        if metadata:
+            image.seek(l2_offset)
+            image.write(big_endian(array.array('Q', (
+                (data_offset + index * cluster_size) | OFLAG_COPIED
+                for index in range(data_clusters)))))
+        image.truncate(total * cluster_size)
+    logger.debug('%s: %d byte qcow2 image, %d clusters of metadata',
+                 path, size, total - data)
+
+
+def read_header(path: str) -> Dict:
+    ''' Return the header fields of a qcow2 image. '''
+    with open(path, 'rb') as image:
+        raw = image.read(65536)
+    if len(raw) < 72 or raw[:4] != MAGIC:
+        raise ValueError(f'{path}: not a qcow2 image')
+    fields = struct.unpack_from('>4sIQIIQIIQQIIQ', raw)
+    header = {
+        'path': path, 'version': fields[1], 'backing_offset': fields[2],
+        'backing_size': fields[3], 'cluster_bits': fields[4],
+        'size': fields[5], 'crypt_method': fields[6],
+        'l1_size': fields[7], 'l1_offset': fields[8],
+        'refcount_table_offset': fields[9],
+        'refcount_table_clusters': fields[10],
+        'snapshots': fields[11], 'incompatible': 0,
+        'refcount_order': 4, 'header_length': 72,
+        'backing_file': None, 'backing_format': None}
+    if header['version'] not in (2, 3):
+        raise ValueError(f'{path}: qcow2 version {header["version"]}')
+    if header['version'] == 3:
+        (header['incompatible'], _compatible, _autoclear,
+         header['refcount_order'], header['header_length']) = \
+            struct.unpack_from('>QQQII', raw, 72)
+    offset = header['header_length']
+    while offset + EXTENSION.size <= len(raw):
+        ext_type, length = EXTENSION.unpack_from(raw, offset)
+        offset += EXTENSION.size
+        if ext_type == EXT_END:
+            break
+        if ext_type == EXT_BACKING_FORMAT:
+            header['backing_format'] = \
+                raw[offset:offset + length].decode('ascii')
+        offset += length + (-length % 8)
+    if header['backing_offset']:
+        start = header['backing_offset']
+        header['backing_file'] = raw[
+            start:start + header['backing_size']].decode('utf-8')
+    return header
+
+
+def image_size(path: str, image_format: str = 'qcow2') -> int:
+    ''' Return the virtual size of an image. '''
+    if image_format == 'raw':
+        return os.path.getsize(path)
+    return read_header(path)['size']
+
+
+def backing_chain(path: str) -> List[Dict]:
+    ''' Return the headers of an image and its backing files, checking
+        that the chain is complete and usable.  Raises ValueError. '''
+    chain = []
+    seen = set()
+    image_format = 'qcow2'
+    while path:
+        real = os.path.realpath(path)
+        if real in seen:
+            raise ValueError(f'{path}: backing file loop')
+        seen.add(real)
+        if not os.path.exists(path):
+            previous = chain[-1]['path'] if chain else path
+            raise ValueError(f'{previous}: backing file {path} is missing')
+        if image_format == 'raw':
+            chain.append({'path': path, 'size': os.path.getsize(path),
+                          'backing_file': None, 'backing_format': None})
+            break
+        header = read_header(path)
+        if header['incompatible'] & ~INCOMPATIBLE_KNOWN:
+            raise ValueError(f'{path}: unknown incompatible features')
+        if header['incompatible'] & INCOMPATIBLE_CORRUPT:
+            raise ValueError(f'{path}: image is marked corrupt')
+        if header['incompatible'] & INCOMPATIBLE_DIRTY:
+            logger.warning('%s: image is dirty, it was not closed cleanly',
+                           path)
+        if chain and header['size'] < chain[-1]['size']:
+            logger.info('%s: smaller than its overlay %s', path,
+                        chain[-1]['path'])
+        chain.append(header)
+        backing = header['backing_file']
+        if backing and not os.path.isabs(backing):
+            backing = os.path.join(os.path.dirname(path), backing)
+        path = backing
+        image_format = header['backing_format'] or 'qcow2'
+    return chain
+
+
+# Role of each disk of a node -> file name suffix, as vms_kvm_domain
+# names them.
+NODE_DISKS = {'system': '_vms923.qcow2', 'data': '_data.qcow2',
+              'backup': '_backup.qcow2'}
+
+
+def node_images(name: str, image_dir: str, base: str = BASE_IMAGE,
+                data_size: int = 8 * GIB, backup_size: int = 8 * GIB,
+                **options) -> List[Tuple[str, Dict]]:
+    ''' Return the (path, create_image arguments) of a node's disks. '''
+    images = []
+    for role, suffix in NODE_DISKS.items():
+        path = os.path.join(image_dir, name + suffix)
+        if role == 'system':
+            images.append((path, {'backing': base}))
+        else:
+            size = data_size if role == 'data' else backup_size
+            images.append((path, dict(options, size=size)))
+    return images
+
+
+def create_images(images: List[Tuple[str, Dict]],
+                  workers: int = 16) -> List[str]:
+    ''' Create the missing images in parallel, return those created. '''
+    missing = [(path, options) for path, options in images
+               if not os.path.exists(path)]
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(create_image, path, **options)
+                   for path, options in missing]
+        for future in futures:
+            future.result()
+    for path, _options in missing:
+        logger.info('created %s', path)
+    return [path for path, _options in missing]
+
+
+def main():
+    ''' Main. '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help='create one image')
+    create.add_argument('path')
+    create.add_argument('size', nargs='?', type=parse_size,
+                        help='virtual size, defaults to that of the backing'
+                        ' file')
+    create.add_argument('-b', '--backing', help='backing file')
+    create.add_argument('-F', '--backing-format', default='qcow2',
+                        choices=('qcow2', 'raw'))
+    create.add_argument('--cluster-size', type=parse_size, default=65536)
+    create.add_argument('--preallocation', choices=PREALLOCATION,
+                        default='off')
+    nodes = commands.add_parser('nodes', help='create the disks of nodes')
+    nodes.add_argument('names', nargs='+')
+    nodes.add_argument('--image-dir', default='/data/libvirt_pools/main')
+    nodes.add_argument('--base', default=BASE_IMAGE,
+                       help='backing file of the system disks')
+    nodes.add_argument('--data-size', type=parse_size, default=8 * GIB)
+    nodes.add_argument('--backup-size', type=parse_size, default=8 * GIB)
+    nodes.add_argument('--cluster-size', type=parse_size, default=65536)
+    nodes.add_argument('--preallocation', choices=PREALLOCATION,
+                       default='metadata')
+    check = commands.add_parser('check', help='check backing chains')
+    check.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        if args.command == 'check':
+            for path in args.paths:
+                chain = backing_chain(path)
+                print(' -> '.join(item['path'] for item in chain))
+            return
+        cluster_bits = args.cluster_size.bit_length() - 1
+        if args.cluster_size != 1 << cluster_bits:
+            parser.error('cluster size must be a power of two')
+        if args.command == 'create':
+            create_image(args.path, args.size, args.backing,
+                         args.backing_format, cluster_bits,
+                         args.preallocation)
+        else:
+            backing_chain(args.base)
+            images = []
+            for name in args.names:
+                images.extend(node_images(
+                    name, args.image_dir, args.base, args.data_size,
+                    args.backup_size, cluster_bits=cluster_bits,
+                    preallocation=args.preallocation))
+            create_images(images)
+    except (OSError, ValueError) as exp:
+        logger.error('%s', exp)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
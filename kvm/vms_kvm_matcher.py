@@ -0,0 +1,96 @@
+'''Multi-pattern prompt matcher for the OpenVMS console scripts.
+
+   The prompt table is compiled once into an Aho-Corasick automaton over
+   literal bytes, so each chunk of console output is scanned in a single
+   pass no matter how many prompts are in the table.  Prompt text is never
+   treated as a regular expression.'''
+
+from typing import List, Sequence, Tuple
+
+# The table entries are the (prompt, key, actions) tuples used by the
+# setup scripts.  Only the prompt text in the first slot is looked at.
+PromptEntry = Tuple
+Match = Tuple[int, PromptEntry]
+
+
+def prompt_bytes(prompt) -> bytes:
+    ''' Return the literal bytes for a prompt given as str or bytes. '''
+    if isinstance(prompt, str):
+        return prompt.encode('utf-8', 'replace')
+    return bytes(prompt)
+
+
+class PromptMatcher():
+    ''' Aho-Corasick matcher built from a prompt table. '''
+    def __init__(self, prompts: Sequence[PromptEntry]) -> None:
+        self.prompts = list(prompts)
+        patterns = [prompt_bytes(prompt[0]) for prompt in self.prompts]
+        if not patterns or min(len(pattern) for pattern in patterns) == 0:
+            raise ValueError('Prompt table needs non-empty prompts')
+        self.max_len = max(len(pattern) for pattern in patterns)
+
+        # Build the trie.
+        goto = [{}]
+        output = [-1]
+        for index, pattern in enumerate(patterns):
+            state = 0
+            for byte in pattern:
+                if byte not in goto[state]:
+                    goto.append({})
+                    output.append(-1)
+                    goto[state][byte] = len(goto) - 1
+                state = goto[state][byte]
+            # First entry in the table wins for duplicate prompts.
+            if output[state] < 0:
+                output[state] = index
+
+        # Breadth first pass for the failure links, folding them into a
+        # full transition table so the scan loop is one lookup per byte.
+        fail = [0] * len(goto)
+        delta = [[0] * 256 for _ in goto]
+        for byte, child in goto[0].items():
+            delta[0][byte] = child
+        queue = list(goto[0].values())
+        for state in queue:
+            if output[state] < 0:
+                output[state] = output[fail[state]]
+            row = delta[state]
+            row[:] = delta[fail[state]]
+            for byte, child in goto[state].items():
+                fail[child] = delta[fail[state]][byte]
+                row[byte] = child
+                queue.append(child)
+        # The longest prompt ending at a position wins, so the
+        # '\r\n\x00$ ' form of a prompt is preferred over '\r\x00$ '.
+        self._delta = delta
+        self._output = output
+
+    def scan(self, data, start: int = 0,
+             first: bool = False) -> Tuple[List[Match], int]:
+        ''' Scan data for prompts in stream order.
+
+            Returns the list of (end offset, prompt entry) matches that end
+            after start, and the offset just past the last match.  Matched
+            text is consumed, so matches never overlap.  With first set the
+            scan stops at the first match.'''
+        delta = self._delta
+        output = self._output
+        matches = []
+        consumed = 0
+        state = 0
+        for offset, byte in enumerate(data):
+            state = delta[state][byte]
+            index = output[state]
+            if index >= 0:
+                end = offset + 1
+                consumed = end
+                state = 0
+                if end > start:
+                    matches.append((end, self.prompts[index]))
+                    if first:
+                        break
+        return matches, consumed
+
+    def tail_length(self) -> int:
+        ''' Bytes of unmatched output that may still begin a prompt. '''
+        return self.max_len - 1
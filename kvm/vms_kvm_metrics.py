@@ -0,0 +1,210 @@
+'''Phase timing and console instrumentation for the OpenVMS setup scripts.
+
+   Every console session keeps a ConsoleMetrics with the time each
+   prompt was first seen, the time from detecting a prompt to sending
+   its answer, the time spent in each phase of the dialogue, and the
+   bytes, callbacks and CPU time of the stream callback.  At exit the
+   results of all consoles are written as one JSON summary, and
+   optionally as a Prometheus text file for the node exporter textfile
+   collector.'''
+
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PROMETHEUS_PREFIX = 'vms_setup'
+
+
+# pylint: disable=too-many-instance-attributes
+class ConsoleMetrics():
+    ''' Timing and counters for one console. '''
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.start = time.monotonic()
+        self.end = None     # Optional [float]
+        self.first_seen = {}    # Dict [str, float]
+        self.prompts = {}   # Dict [str, int]
+        self.responses = {}     # Dict [str, List[float]]
+        self.phases = []    # List [Tuple[str, float]]
+        self.bytes_received = 0
+        self.callbacks = 0
+        self.reads = 0
+        self.callback_cpu = 0.0
+        self.commands = 0
+        self.reachable = {}     # Dict [str, float]
+        self.failure = None     # Optional [dict]
+        self.admission_wait = 0.0
+        self._detected = None   # Optional [Tuple[str, float]]
+
+    def elapsed(self) -> float:
+        ''' Seconds since the console was set up, or until it finished. '''
+        return (self.end or time.monotonic()) - self.start
+
+    def prompt_seen(self, key: str) -> None:
+        ''' Note that the dialogue matched a prompt. '''
+        now = time.monotonic()
+        self.first_seen.setdefault(key, now - self.start)
+        self.prompts[key] = self.prompts.get(key, 0) + 1
+        self._detected = (key, now)
+
+    def command_sent(self) -> None:
+        ''' Note that an answer was sent, timing it from its prompt. '''
+        self.commands += 1
+        if self._detected is None:
+            return
+        key, detected = self._detected
+        self._detected = None
+        self.responses.setdefault(key, []).append(
+            time.monotonic() - detected)
+
+    def enter_phase(self, name: str) -> None:
+        ''' Note the start of a dialogue phase. '''
+        self.phases.append((name, time.monotonic() - self.start))
+
+    def callback(self, size: int, cpu: float) -> None:
+        ''' Account for one stream callback. '''
+        self.callbacks += 1
+        self.bytes_received += size
+        self.callback_cpu += cpu
+
+    def finish(self) -> None:
+        ''' Stop the clock for this console. '''
+        if self.end is None:
+            self.end = time.monotonic()
+
+    def phase_durations(self) -> List[dict]:
+        ''' Return each phase visit with its start and duration. '''
+        visits = []
+        ends = [start for _name, start in self.phases[1:]]
+        ends.append(self.elapsed())
+        for (name, start), end in zip(self.phases, ends):
+            visits.append({'phase': name, 'start': round(start, 3),
+                           'seconds': round(end - start, 3)})
+        return visits
+
+    def phase_totals(self) -> Dict[str, float]:
+        ''' Return the total seconds spent in each phase. '''
+        totals = {}
+        for visit in self.phase_durations():
+            totals[visit['phase']] = round(
+                totals.get(visit['phase'], 0.0) + visit['seconds'], 3)
+        return totals
+
+    def summary(self) -> dict:
+        ''' Return the metrics as a JSON friendly dict. '''
+        responses = {}
+        for key, values in self.responses.items():
+            responses[key] = {
+                'count': len(values),
+                'mean_ms': round(1000 * sum(values) / len(values), 3),
+                'max_ms': round(1000 * max(values), 3)}
+        return {
+            'name': self.name,
+            'seconds': round(self.elapsed(), 3),
+            'finished': self.end is not None,
+            'failure': self.failure,
+            'phases': self.phase_durations(),
+            'phase_totals': self.phase_totals(),
+            'prompt_first_seen': {key: round(value, 3) for key, value
+                                  in self.first_seen.items()},
+            'prompt_counts': dict(self.prompts),
+            'response': responses,
+            'reachable_seconds': {kind: round(value, 3) for kind, value
+                                  in self.reachable.items()},
+            'admission_wait_seconds': round(self.admission_wait, 3),
+            'commands_sent': self.commands,
+            'bytes_received': self.bytes_received,
+            'callbacks': self.callbacks,
+            'reads': self.reads,
+            'callback_cpu_seconds': round(self.callback_cpu, 6)}
+
+
+def write_json(path: Optional[str], metrics: List[ConsoleMetrics]) -> None:
+    ''' Write the JSON summary to path, or log it if path is None. '''
+    report = json.dumps({'consoles': [item.summary() for item in metrics]},
+                        indent=2)
+    if path is None:
+        logger.info('metrics: %s', report)
+    elif path == '-':
+        print(report)
+    else:
+        with open(path, 'w', encoding='utf-8') as json_file:
+            json_file.write(report + '\n')
+
+
+def label_value(value: str) -> str:
+    ''' Escape a Prometheus label value. '''
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def prometheus_text(metrics: List[ConsoleMetrics]) -> str:
+    ''' Return the metrics in the Prometheus text exposition format. '''
+    families = [
+        ('duration_seconds', 'gauge', 'Seconds the setup has run.'),
+        ('failed', 'gauge', '1 if the setup of the node failed.'),
+        ('phase_seconds', 'gauge', 'Seconds spent in each phase.'),
+        ('prompt_first_seen_seconds', 'gauge',
+         'Seconds from the start until a prompt was first seen.'),
+        ('prompt_response_seconds', 'summary',
+         'Seconds from detecting a prompt to sending its answer.'),
+        ('reachable_seconds', 'gauge',
+         'Seconds from the start until a service answered.'),
+        ('admission_wait_seconds', 'gauge',
+         'Seconds spent waiting to enter heavy phases.'),
+        ('commands_sent_total', 'counter', 'Commands sent.'),
+        ('console_bytes_total', 'counter', 'Console bytes received.'),
+        ('console_callbacks_total', 'counter', 'Stream callbacks.'),
+        ('console_reads_total', 'counter', 'Console stream reads.'),
+        ('console_callback_cpu_seconds_total', 'counter',
+         'CPU seconds spent in the stream callback.')]
+    samples = {family[0]: [] for family in families}
+    for item in metrics:
+        node = f'node="{label_value(item.name)}"'
+        samples['duration_seconds'].append(('', node, item.elapsed()))
+        samples['failed'].append(('', node, int(item.failure is not None)))
+        for phase, seconds in item.phase_totals().items():
+            samples['phase_seconds'].append(
+                ('', f'{node},phase="{label_value(phase)}"', seconds))
+        for key, seconds in item.first_seen.items():
+            samples['prompt_first_seen_seconds'].append(
+                ('', f'{node},prompt="{label_value(key)}"', seconds))
+        for key, values in item.responses.items():
+            labels = f'{node},prompt="{label_value(key)}"'
+            samples['prompt_response_seconds'].extend([
+                ('_sum', labels, sum(values)),
+                ('_count', labels, len(values))])
+        for kind, seconds in item.reachable.items():
+            samples['reachable_seconds'].append(
+                ('', f'{node},service="{label_value(kind)}"', seconds))
+        samples['admission_wait_seconds'].append(
+            ('', node, item.admission_wait))
+        samples['commands_sent_total'].append(('', node, item.commands))
+        samples['console_bytes_total'].append(
+            ('', node, item.bytes_received))
+        samples['console_callbacks_total'].append(
+            ('', node, item.callbacks))
+        samples['console_reads_total'].append(('', node, item.reads))
+        samples['console_callback_cpu_seconds_total'].append(
+            ('', node, item.callback_cpu))
+    lines = []
+    for family, kind, text in families:
+        name = f'{PROMETHEUS_PREFIX}_{family}'
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for suffix, labels, value in samples[family]:
+            lines.append(f'{name}{suffix}{{{labels}}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path: str, metrics: List[ConsoleMetrics]) -> None:
+    ''' Write the Prometheus text file, replacing it atomically so the
+        textfile collector never reads a partial file. '''
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as prom_file:
+        prom_file.write(prometheus_text(metrics))
+    os.replace(temp_path, path)
@@ -0,0 +1,372 @@
+#!/usr/bin/python
+
+'''vCPU, NUMA and hugepage placement of OpenVMS domains on one host.
+
+   The host topology is read from /sys: the NUMA nodes, the sockets and
+   cores of their CPUs with the hyperthreads of each core, and the free
+   2 MiB hugepages of each node.  A new domain gets whole cores on one
+   NUMA node, one host CPU pinned per vCPU, its memory bound to that
+   node and backed by the node's hugepages.  The first core of every
+   node is left to the host, and the QEMU emulator and I/O threads of
+   the domains on the node are pinned to it, so guests never share a
+   core with each other or with their emulators.
+
+   Allocations are kept in a JSON ledger, locked while it is changed,
+   so domains defined from several processes never get the same cores
+   or count the same hugepages.  Entries of domains that are no longer
+   defined are dropped when the next domain is placed.
+
+   `vms_kvm_placement.py show` prints the topology and the ledger,
+   `allocate robin --vcpus 2 --memory 6144` places a domain and prints
+   its XML elements, and `release robin` frees its allocation.'''
+
+import argparse
+import contextlib
+import fcntl
+import glob
+import json
+import logging
+import os
+import re
+import sys
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SYSFS = '/sys'
+LEDGER = '/var/lib/libvirt/vms_kvm_placement.json'
+# Hugepage size used for guest memory.
+HUGEPAGE_KIB = 2048
+# Cores of each NUMA node left to the host and the emulator threads.
+HOST_CORES = 1
+
+
+def parse_cpulist(text: str) -> List[int]:
+    ''' Return the CPUs of a list such as "0-3,8,10-11". '''
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        first, _sep, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus: List[int]) -> str:
+    ''' Return CPUs as a list of ranges, the way libvirt takes them. '''
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else f'{first}-{last}'
+                    for first, last in ranges)
+
+
+def read_int(path: str, default: int = 0) -> int:
+    ''' Return the number in a sysfs file, or default if it is missing. '''
+    try:
+        with open(path, 'r', encoding='ascii') as sysfs_file:
+            return int(sysfs_file.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def read_cpulist(path: str) -> List[int]:
+    ''' Return the CPUs of a sysfs cpulist file. '''
+    with open(path, 'r', encoding='ascii') as sysfs_file:
+        return parse_cpulist(sysfs_file.read())
+
+
+# pylint: disable=too-few-public-methods
+class NumaNode():
+    ''' The cores and hugepages of one host NUMA node. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, node: int, socket: int, cores: List[List[int]],
+                 hugepages: int = 0, free_hugepages: int = 0) -> None:
+        self.node = node
+        self.socket = socket
+        # Host CPUs of each core, hyperthreads of a core together.
+        self.cores = cores
+        self.hugepages = hugepages
+        self.free_hugepages = free_hugepages
+
+    def summary(self) -> dict:
+        ''' Return the node as a JSON friendly dict. '''
+        return {'node': self.node, 'socket': self.socket,
+                'cpus': format_cpulist([cpu for core in self.cores
+                                        for cpu in core]),
+                'cores': len(self.cores), 'hugepages': self.hugepages,
+                'free_hugepages': self.free_hugepages}
+
+
+def read_topology(sysfs: str = SYSFS,
+                  page_kib: int = HUGEPAGE_KIB) -> List[NumaNode]:
+    ''' Return the NUMA nodes of the host that have online CPUs.
+
+        A kernel without NUMA support is one node with all CPUs and
+        the hugepages of the whole host.'''
+    cpu_dir = os.path.join(sysfs, 'devices', 'system', 'cpu')
+    online = set(read_cpulist(os.path.join(cpu_dir, 'online')))
+    pages_dir = f'hugepages/hugepages-{page_kib}kB'
+    node_dirs = glob.glob(os.path.join(sysfs, 'devices', 'system', 'node',
+                                       'node[0-9]*'))
+    if not node_dirs:
+        node_dirs = [None]
+    nodes = []
+    for node_dir in node_dirs:
+        if node_dir is None:
+            node = 0
+            cpus = sorted(online)
+            pages = os.path.join(sysfs, 'kernel', 'mm', pages_dir)
+        else:
+            node = int(re.sub(r'.*node', '', node_dir))
+            cpus = [cpu for cpu in
+                    read_cpulist(os.path.join(node_dir, 'cpulist'))
+                    if cpu in online]
+            pages = os.path.join(node_dir, pages_dir)
+        if not cpus:
+            continue
+        cores = {}
+        sockets = []
+        for cpu in cpus:
+            topology = os.path.join(cpu_dir, f'cpu{cpu}', 'topology')
+            socket = read_int(os.path.join(topology, 'physical_package_id'))
+            core = read_int(os.path.join(topology, 'core_id'), cpu)
+            cores.setdefault((socket, core), []).append(cpu)
+            sockets.append(socket)
+        nodes.append(NumaNode(
+            node, min(sockets), sorted(cores.values()),
+            read_int(os.path.join(pages, 'nr_hugepages')),
+            read_int(os.path.join(pages, 'free_hugepages'))))
+    return sorted(nodes, key=lambda item: item.node)
+
+
+class Allocation():
+    ''' The host CPUs, NUMA node and hugepages given to one domain. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, name: str, node: int, cpus: List[int],
+                 emulator: List[int], hugepages: int = 0,
+                 page_kib: int = HUGEPAGE_KIB) -> None:
+        self.name = name
+        self.node = node
+        # Host CPU of each vCPU, in vCPU order.
+        self.cpus = cpus
+        self.emulator = emulator
+        # Hugepages backing the memory, 0 for normal pages.
+        self.hugepages = hugepages
+        self.page_kib = page_kib
+
+    def to_dict(self) -> dict:
+        ''' Return the allocation as a ledger entry. '''
+        return {'node': self.node, 'cpus': self.cpus,
+                'emulator': self.emulator, 'hugepages': self.hugepages,
+                'page_kib': self.page_kib}
+
+    @classmethod
+    def from_dict(cls, name: str, entry: dict):
+        ''' Build an allocation from a ledger entry. '''
+        return cls(name, **entry)
+
+
+def choose(nodes: List[NumaNode], allocations: Dict[str, Allocation],
+           name: str, vcpus: int, memory_mib: int,
+           hugepages: bool = True) -> Allocation:
+    ''' Return an allocation for a new domain that overlaps none of the
+        others, on the NUMA node with the most cores left after it.
+        Raises ValueError if no node has the cores or hugepages. '''
+    used = {cpu for allocation in allocations.values()
+            for cpu in allocation.cpus}
+    pages = -(-memory_mib * 1024 // HUGEPAGE_KIB) if hugepages else 0
+    best = None
+    for node in nodes:
+        free = [core for core in node.cores[HOST_CORES:]
+                if not used.intersection(core)]
+        # Whole cores, a hyperthread left over stays unused.
+        cpus = []
+        taken = 0
+        for core in free:
+            if len(cpus) >= vcpus:
+                break
+            cpus.extend(core)
+            taken += 1
+        if len(cpus) < vcpus:
+            continue
+        # Pages running domains use are not free any more, pages of
+        # domains not started yet still are.
+        counted = sum(allocation.hugepages
+                      for allocation in allocations.values()
+                      if allocation.node == node.node)
+        if pages > min(node.free_hugepages, node.hugepages - counted):
+            continue
+        left = len(free) - taken
+        if best is None or left > best[0]:
+            emulator = [cpu for core in node.cores[:HOST_CORES]
+                        for cpu in core]
+            best = (left, Allocation(name, node.node, cpus[:vcpus],
+                                     emulator, pages))
+    if best is None:
+        raise ValueError(f'{name}: no NUMA node has {vcpus} free CPUs'
+                         + (f' and {pages} free hugepages' if pages else ''))
+    return best[1]
+
+
+class Ledger():
+    ''' Allocations of the domains on this host, kept in a JSON file. '''
+    def __init__(self, path: str = LEDGER) -> None:
+        self.path = path
+
+    @contextlib.contextmanager
+    def locked(self) -> Iterator[Dict[str, Allocation]]:
+        ''' Hold the ledger lock, give the allocations and save them. '''
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        with open(f'{self.path}.lock', 'a', encoding='utf-8') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            allocations = self.load()
+            yield allocations
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as ledger_file:
+                json.dump({name: allocation.to_dict() for name, allocation
+                           in sorted(allocations.items())},
+                          ledger_file, indent=2)
+            os.replace(temp_path, self.path)
+
+    def load(self) -> Dict[str, Allocation]:
+        ''' Return the allocations, by domain name. '''
+        try:
+            with open(self.path, 'r', encoding='utf-8') as ledger_file:
+                entries = json.load(ledger_file)
+        except FileNotFoundError:
+            return {}
+        return {name: Allocation.from_dict(name, entry)
+                for name, entry in entries.items()}
+
+    # pylint: disable=too-many-arguments
+    def allocate(self, name: str, vcpus: int, memory_mib: int,
+                 nodes: List[NumaNode], hugepages: bool = True,
+                 defined: Optional[List[str]] = None) -> Allocation:
+        ''' Return the allocation of a domain, placing it if it has none.
+            With defined, the entries of other domains not in it are
+            dropped first. '''
+        with self.locked() as allocations:
+            if defined is not None:
+                for stale in set(allocations) - set(defined) - {name}:
+                    logger.info('%s: no longer defined, releasing its'
+                                ' placement', stale)
+                    del allocations[stale]
+            if name not in allocations:
+                allocations[name] = choose(nodes, allocations, name, vcpus,
+                                           memory_mib, hugepages)
+            allocation = allocations[name]
+        logger.info('%s: vCPUs on %s, emulator on %s, memory on node %d%s',
+                    name, format_cpulist(allocation.cpus),
+                    format_cpulist(allocation.emulator), allocation.node,
+                    f' in {allocation.hugepages} hugepages'
+                    if allocation.hugepages else '')
+        return allocation
+
+    def release(self, name: str) -> bool:
+        ''' Free the allocation of a domain, return whether it had one. '''
+        with self.locked() as allocations:
+            return allocations.pop(name, None) is not None
+
+
+def clear_placement(root: ET.Element) -> None:
+    ''' Remove the pinning, NUMA binding and hugepages of a domain XML. '''
+    for tag in ('cputune', 'numatune', 'memoryBacking'):
+        for element in root.findall(tag):
+            root.remove(element)
+    root.find('vcpu').attrib.pop('cpuset', None)
+
+
+def apply_placement(root: ET.Element, allocation: Allocation) -> None:
+    ''' Pin the vCPUs, emulator and I/O threads of a domain XML, bind
+        its memory to the NUMA node and back it with hugepages. '''
+    clear_placement(root)
+    vcpu = root.find('vcpu')
+    vcpu.text = str(len(allocation.cpus))
+    vcpu.set('placement', 'static')
+    vcpu.set('cpuset', format_cpulist(allocation.cpus))
+    emulator = format_cpulist(allocation.emulator)
+    cputune = ET.Element('cputune')
+    for index, cpu in enumerate(allocation.cpus):
+        ET.SubElement(cputune, 'vcpupin',
+                      {'vcpu': str(index), 'cpuset': str(cpu)})
+    ET.SubElement(cputune, 'emulatorpin', {'cpuset': emulator})
+    for index in range(int(root.findtext('iothreads') or 0)):
+        ET.SubElement(cputune, 'iothreadpin',
+                      {'iothread': str(index + 1), 'cpuset': emulator})
+    numatune = ET.Element('numatune')
+    ET.SubElement(numatune, 'memory',
+                  {'mode': 'strict', 'nodeset': str(allocation.node)})
+    after = root.find('iothreads')
+    if after is None:
+        after = vcpu
+    position = list(root).index(after) + 1
+    root.insert(position, cputune)
+    root.insert(position + 1, numatune)
+    if allocation.hugepages:
+        backing = ET.Element('memoryBacking')
+        ET.SubElement(ET.SubElement(backing, 'hugepages'), 'page',
+                      {'size': str(allocation.page_kib), 'unit': 'KiB'})
+        memory = root.find('currentMemory')
+        if memory is None:
+            memory = root.find('memory')
+        root.insert(list(root).index(memory) + 1, backing)
+
+
+def main():
+    ''' Main. '''
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('command', choices=('show', 'allocate', 'release'))
+    parser.add_argument('name', nargs='?', help='name of the domain')
+    parser.add_argument('--vcpus', type=int, default=2,
+                        help='vCPUs of the domain (default 2)')
+    parser.add_argument('--memory', type=int, default=6144, metavar='MIB',
+                        help='memory of the domain (default 6144)')
+    parser.add_argument('--no-hugepages', action='store_true',
+                        help='pin and bind only, with normal pages')
+    parser.add_argument('--ledger', default=LEDGER,
+                        help=f'allocation ledger (default {LEDGER})')
+    parser.add_argument('--sysfs', default=SYSFS,
+                        help='where sysfs is mounted, for testing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    ledger = Ledger(args.ledger)
+    if args.command == 'show':
+        for node in read_topology(args.sysfs):
+            print(node.summary())
+        for name, allocation in ledger.load().items():
+            print(f'{name}: {allocation.to_dict()}')
+        return
+    if not args.name:
+        parser.error('a domain name is needed')
+    if args.command == 'release':
+        if not ledger.release(args.name):
+            print(f'{args.name}: not in the ledger')
+            sys.exit(1)
+        return
+    try:
+        allocation = ledger.allocate(args.name, args.vcpus, args.memory,
+                                     read_topology(args.sysfs),
+                                     not args.no_hugepages)
+    except ValueError as exp:
+        print(exp)
+        sys.exit(1)
+    root = ET.fromstring('<domain><memory>0</memory>'
+                         '<currentMemory>0</currentMemory>'
+                         '<vcpu>0</vcpu></domain>')
+    apply_placement(root, allocation)
+    ET.indent(root)
+    for element in root:
+        if element.tag not in ('memory', 'currentMemory'):
+            print(ET.tostring(element, encoding='unicode').rstrip())
+
+
+if __name__ == "__main__":
+    main()
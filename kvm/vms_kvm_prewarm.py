@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+'''Page cache prewarming for the files OpenVMS domains boot from.
+
+   When many domains are started at once they all read the shared
+   backing image and firmware files at random, from cold storage.
+   Reading those files once, sequentially, into the page cache before
+   the domains are started turns that into one streaming read.
+
+   Residency is measured with mincore(2) through ctypes; where that is
+   not available every file is simply read.'''
+
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import mmap
+import os
+import time
+import xml.etree.ElementTree as ET
+from typing import List, Optional
+
+import libvirt     # type: ignore
+
+from vms_kvm_image import backing_chain
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 8 * 1024 * 1024
+# Files at least this resident are left alone.
+WARM_FRACTION = 0.95
+
+PROT_READ = 1
+MAP_SHARED = 1
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+_libc = None
+
+
+def libc():
+    ''' Return the C library with mmap, mincore and munmap set up. '''
+    global _libc    # pylint: disable=global-statement
+    if _libc is None:
+        library = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        library.mmap.restype = ctypes.c_void_p
+        library.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                 ctypes.c_long]
+        library.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                    ctypes.c_char_p]
+        library.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        _libc = library
+    return _libc
+
+
+def resident_fraction(path: str) -> Optional[float]:
+    ''' Return the fraction of a file in the page cache, or None if it
+        can not be measured. '''
+    size = os.path.getsize(path)
+    if size == 0:
+        return 1.0
+    try:
+        library = libc()
+        with open(path, 'rb') as image:
+            address = library.mmap(None, size, PROT_READ, MAP_SHARED,
+                                   image.fileno(), 0)
+        if address in (None, MAP_FAILED):
+            return None
+        try:
+            pages = -(-size // mmap.PAGESIZE)
+            vector = ctypes.create_string_buffer(pages)
+            if library.mincore(address, size, vector) != 0:
+                return None
+            resident = sum(byte & 1 for byte in vector.raw)
+        finally:
+            library.munmap(address, size)
+    except (OSError, AttributeError):
+        return None
+    return resident / pages
+
+
+def available_memory() -> Optional[int]:
+    ''' Return MemAvailable from /proc/meminfo in bytes. '''
+    try:
+        with open('/proc/meminfo', 'r', encoding='ascii') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def prewarm_file(path: str, read_size: int = READ_SIZE) -> dict:
+    ''' Read a file into the page cache unless it is already there. '''
+    size = os.path.getsize(path)
+    before = resident_fraction(path)
+    result = {'path': path, 'size': size, 'before': before,
+              'after': before, 'seconds': 0.0, 'skipped': None}
+    if before is not None and before >= WARM_FRACTION:
+        result['skipped'] = 'warm'
+        return result
+    available = available_memory()
+    if available is not None and size > available // 2:
+        result['skipped'] = 'larger than half the available memory'
+        return result
+    start = time.monotonic()
+    buffer = bytearray(read_size)
+    with open(path, 'rb', buffering=0) as image:
+        fd = image.fileno()
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        while image.readinto(buffer):
+            pass
+    result['seconds'] = time.monotonic() - start
+    result['after'] = resident_fraction(path)
+    return result
+
+
+def report(result: dict) -> None:
+    ''' Log the result of one prewarm. '''
+    def percent(fraction):
+        return 'unknown' if fraction is None else f'{100 * fraction:.0f}%'
+    if result['skipped']:
+        logger.info('%s: %s resident, skipped, %s', result['path'],
+                    percent(result['before']), result['skipped'])
+        return
+    rate = result['size'] / result['seconds'] / 1e6 \
+        if result['seconds'] else 0.0
+    logger.info('%s: %s -> %s resident, %d MB in %.1f s (%.0f MB/s)',
+                result['path'], percent(result['before']),
+                percent(result['after']), result['size'] // 1000000,
+                result['seconds'], rate)
+
+
+def boot_files(domain: libvirt.virDomain) -> List[str]:
+    ''' Return the firmware files and the backing images of the system
+        disk of a domain, the files every boot reads. '''
+    root = ET.fromstring(domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+    files = []
+    loader = root.find('./os/loader')
+    if loader is not None and loader.text:
+        files.append(loader.text)
+    nvram = root.find('./os/nvram')
+    if nvram is not None and nvram.get('template'):
+        files.append(nvram.get('template'))
+    disk = root.find("./devices/disk[@device='disk']/source")
+    if disk is not None and disk.get('file'):
+        try:
+            # The overlay itself is private to the domain and small.
+            files.extend(item['path'] for item in
+                         backing_chain(disk.get('file'))[1:])
+        except (OSError, ValueError) as exp:
+            logger.warning('%s: %s', domain.name(), exp)
+    return files
+
+
+def prewarm(paths: List[str]) -> List[dict]:
+    ''' Prewarm each distinct existing file once, in order. '''
+    results = []
+    seen = set()
+    for path in paths:
+        real = os.path.realpath(path)
+        if real in seen or not os.path.isfile(real):
+            continue
+        seen.add(real)
+        result = prewarm_file(real)
+        report(result)
+        results.append(result)
+    return results
+
+
+def main():
+    ''' Main. '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('files', nargs='+', help='files to prewarm')
+    parser.add_argument('--status', action='store_true',
+                        help='only report how much of each file is cached')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.status:
+        for path in args.files:
+            fraction = resident_fraction(path)
+            print(f'{path}: ' + ('unknown' if fraction is None
+                                 else f'{100 * fraction:.1f}% resident'))
+        return
+    prewarm(args.files)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+'''Network readiness probes for OpenVMS nodes being set up.
+
+   A node counts as reachable once its SSH server answers with an
+   identification banner on TCP port 22, and optionally once its
+   DECnet-Plus OSI transport over TCP (RFC 1006, port 102) accepts
+   connections.  Probes are retried with exponential backoff and
+   jitter, and the time from the start of the setup to the first
+   successful probe is recorded for each kind.'''
+
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SSH_PORT = 22
+# DECnet-Plus over TCP/IP uses the RFC 1006 ISO transport port.
+DECNET_PORT = 102
+
+
+async def probe_ssh(host: str, port: int = SSH_PORT,
+                    timeout: float = 5.0) -> bool:
+    ''' Return True if an SSH server answers with its banner. '''
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        # Servers may send other lines before the identification.
+        for _line in range(5):
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line:
+                return False
+            if line.startswith(b'SSH-'):
+                return True
+        return False
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+
+
+async def probe_tcp(host: str, port: int = DECNET_PORT,
+                    timeout: float = 5.0) -> bool:
+    ''' Return True if a TCP connection to the port succeeds. '''
+    try:
+        _reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+
+# Probe kind -> probe and the port it checks by default.
+PROBES = {
+    'ssh': (probe_ssh, SSH_PORT),
+    'decnet': (probe_tcp, DECNET_PORT)}
+
+
+# pylint: disable=too-many-instance-attributes, too-few-public-methods
+class ReadinessProber():
+    ''' Probe a node until every requested service answers. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, name: str, address: Callable[[], Optional[str]],
+                 kinds: List[str], initial: float = 1.0,
+                 maximum: float = 15.0, timeout: float = 600.0,
+                 ports: Optional[Dict[str, int]] = None) -> None:
+        self.name = name
+        # Called before each round, the address may only show up once
+        # the node has its DHCP lease.
+        self.address = address
+        self.kinds = kinds
+        self.initial = initial
+        self.maximum = maximum
+        self.timeout = timeout
+        self.ports = {kind: port for kind, (_probe, port) in PROBES.items()}
+        self.ports.update(ports or {})
+        self.reachable = {}     # Dict [str, float]
+
+    async def run(self, start: Optional[float] = None) -> Dict[str, float]:
+        ''' Probe until every kind answers or the timeout passes.
+
+            Returns the seconds from start, the time.monotonic() the
+            setup started at, to the first successful probe of each
+            kind.'''
+        start = time.monotonic() if start is None else start
+        deadline = time.monotonic() + self.timeout
+        delay = self.initial
+        while len(self.reachable) < len(self.kinds):
+            host = self.address()
+            if host:
+                for kind in self.kinds:
+                    if kind in self.reachable:
+                        continue
+                    probe = PROBES[kind][0]
+                    if await probe(host, self.ports[kind]):
+                        self.reachable[kind] = time.monotonic() - start
+                        logger.info('%s: %s reachable at %s after %.1f s',
+                                    self.name, kind, host,
+                                    self.reachable[kind])
+                        delay = self.initial
+            if len(self.reachable) == len(self.kinds):
+                break
+            if time.monotonic() + delay > deadline:
+                logger.warning('%s: not reachable by %s within %.0f s',
+                               self.name, ', '.join(
+                                   kind for kind in self.kinds
+                                   if kind not in self.reachable),
+                               self.timeout)
+                break
+            await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, self.maximum)
+        return self.reachable
@@ -0,0 +1,359 @@
+#!/usr/bin/python
+
+'''Console transcript recording, replay and matcher benchmark.
+
+   A recording holds the raw console bytes received from a domain and
+   the commands sent back, each with the time since the start of the
+   run.  Replaying a recording feeds the received bytes through the same
+   dialogue engine and profile the setup script used, with a fake
+   console stream, and checks that the same commands are sent back.
+   None of this needs libvirt or a running OpenVMS guest.
+
+   Recording format: the line b'VMSREC1\\n', one line of JSON with the
+   profile name, the options it was built with, whether commands were
+   typed ahead and the target settings, then records of a struct '<cdI'
+   header (direction b'<' received or b'>' sent, seconds since start,
+   length) followed by the data.  The password is redacted from the
+   answers to password prompts.'''
+
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import struct
+import sys
+import time
+import types
+from typing import BinaryIO, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'VMSREC1\n'
+RECEIVED = b'<'
+SENT = b'>'
+RECORD = struct.Struct('<cdI')
+REDACTED = b'<password>'
+
+Record = Tuple[bytes, float, bytes]
+
+# Profile name -> setup script module that builds it.
+PROFILES = {
+    'v923': 'setup_vms_community_kvm',
+    'v922': 'setup_vms_community_kvm_v922'}
+
+
+def redact(data: bytes, secrets: List[bytes]) -> bytes:
+    ''' Replace secrets in data so they never reach a transcript. '''
+    for secret in secrets:
+        if secret:
+            data = data.replace(secret, REDACTED)
+    return data
+
+
+class TranscriptRecorder():
+    ''' Writes a console transcript recording.
+
+        Sent records that answer one of secret_prompts have the password
+        redacted, without secret_prompts every sent record has.'''
+    # pylint: disable=too-many-arguments
+    def __init__(self, path: str, target, profile: str = 'v923',
+                 options: Optional[dict] = None, typeahead: bool = False,
+                 secret_prompts: Optional[Set[str]] = None) -> None:
+        self.path = path
+        self.secrets = [target.password]
+        self.secret_prompts = secret_prompts
+        self.start = time.monotonic()
+        # pylint: disable=consider-using-with
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        header = {'profile': profile, 'options': options or {},
+                  'typeahead': typeahead, 'settings': target.settings}
+        self.file.write(json.dumps(header).encode('utf-8') + b'\n')
+
+    def record(self, direction: bytes, data: bytes,
+               prompt: Optional[str] = None) -> None:
+        ''' Append one record, sent data with the key of the prompt it
+            answers. '''
+        if self.file is None:
+            return
+        if direction == SENT and (self.secret_prompts is None or
+                                  prompt in self.secret_prompts):
+            data = redact(bytes(data), self.secrets)
+        self.file.write(RECORD.pack(direction,
+                                    time.monotonic() - self.start,
+                                    len(data)))
+        self.file.write(data)
+
+    def close(self) -> None:
+        ''' Flush and close the recording. '''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_header(recording: BinaryIO) -> dict:
+    ''' Read the magic, profile name and target settings. '''
+    if recording.readline() != MAGIC:
+        raise ValueError(f'{recording.name}: not a console recording')
+    header = json.loads(recording.readline())
+    if not isinstance(header, dict) or \
+            'profile' not in header or 'settings' not in header:
+        raise ValueError(f'{recording.name}: malformed recording header')
+    return header
+
+
+def read_records(recording: BinaryIO) -> Iterator[Record]:
+    ''' Yield (direction, seconds, data) for each record. '''
+    while True:
+        header = recording.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        direction, offset, length = RECORD.unpack(header)
+        yield direction, offset, recording.read(length)
+
+
+def load_recording(path: str) -> Tuple[dict, List[Record]]:
+    ''' Load the header and all records of a recording. '''
+    with open(path, 'rb') as recording:
+        header = read_header(recording)
+        return header, list(read_records(recording))
+
+
+def load_profile(header: dict, **options):
+    ''' Return the target and profile a recording was made with, options
+        override those recorded. '''
+    offline_libvirt()
+    # pylint: disable=import-outside-toplevel
+    from vms_kvm_fleet import Target
+
+    module = importlib.import_module(PROFILES[header['profile']])
+    target = Target.from_dict(header['settings'], {'password': REDACTED})
+    options = {**header.get('options', {}), **options}
+    return target, module.build_profile(target, **options)
+
+
+def offline_libvirt() -> None:
+    ''' Provide the few libvirt names the engine uses when libvirt is
+        not installed, so recordings can be replayed on any box. '''
+    try:
+        # pylint: disable=import-outside-toplevel, unused-import
+        import libvirt     # type: ignore  # noqa: F401
+        import libvirtaio  # type: ignore  # noqa: F401
+        return
+    except ImportError:
+        pass
+    stand_in = types.ModuleType('libvirt')
+    stand_in.VIR_DOMAIN_RUNNING = 1
+    stand_in.VIR_DOMAIN_PAUSED = 3
+    stand_in.VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+    stand_in.VIR_STREAM_NONBLOCK = 1
+    stand_in.VIR_STREAM_EVENT_READABLE = 1
+    stand_in.VIR_STREAM_EVENT_ERROR = 4
+    stand_in.VIR_STREAM_EVENT_HANGUP = 8
+    stand_in.VIR_DOMAIN_CONSOLE_FORCE = 1
+    stand_in.VIR_NODE_MEMORY_STATS_ALL_CELLS = -1
+    stand_in.VIR_ERR_RPC = 39
+    stand_in.VIR_FROM_STREAMS = 38
+    stand_in.libvirtError = type('libvirtError', (Exception,), {})
+    for name in ('virConnect', 'virDomain', 'virStream'):
+        setattr(stand_in, name, type(name, (), {}))
+    aio = types.ModuleType('libvirtaio')
+    aio.virEventRegisterAsyncIOImpl = lambda loop=None: None
+    sys.modules.setdefault('libvirt', stand_in)
+    sys.modules.setdefault('libvirtaio', aio)
+
+
+class FakeStream():
+    ''' Console stream that collects what is sent to it. '''
+    def __init__(self) -> None:
+        self.sent = []
+
+    def send(self, data: bytes) -> int:
+        ''' Record a send. '''
+        self.sent.append(bytes(data))
+        return len(data)
+
+    @staticmethod
+    def recv(_nbytes: int) -> int:
+        ''' Replayed output is fed in directly, a read would block. '''
+        return -2
+
+    def eventRemoveCallback(self) -> None:    # pylint: disable=invalid-name
+        ''' Nothing to remove. '''
+
+    def abort(self) -> None:
+        ''' Nothing to close. '''
+
+
+class FakeDomain():
+    ''' Domain that is always running. '''
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def state(self, _flags: int) -> list:
+        ''' Always running. '''
+        return [1, 1]
+
+    def create(self) -> None:
+        ''' Already running. '''
+
+    def isActive(self) -> bool:    # pylint: disable=invalid-name
+        ''' Always running. '''
+        return True
+
+
+class FakeConnection():
+    ''' Connection with one always running domain. '''
+    def __init__(self, name: str) -> None:
+        self.domain = FakeDomain(name)
+
+    # pylint: disable=invalid-name
+    def lookupByName(self, _name: str) -> FakeDomain:
+        ''' Return the domain. '''
+        return self.domain
+
+    def domainEventRegisterAny(self, *_args) -> int:
+        ''' No events are ever delivered. '''
+        return 0
+
+    def domainEventDeregisterAny(self, _callback_id: int) -> None:
+        ''' Nothing to deregister. '''
+
+
+async def replay_console(header: dict, records: List[Record],
+                         speed: Optional[float] = None,
+                         **options) -> List[bytes]:
+    ''' Feed the received records through the recorded profile and
+        return the commands it sent, with the same placeholder for the
+        password as the recording.
+
+        With speed None the bytes are fed as fast as possible and the
+        reboot delay is skipped, otherwise the recorded timing is
+        followed, divided by speed.'''
+    target, profile = load_profile(header, **options)
+    # pylint: disable=import-outside-toplevel
+    import vms_kvm_dialogue as dialogue
+
+    console = dialogue.Console(FakeConnection(target.name), target, profile)
+    stream = FakeStream()
+    console.session.stream = stream
+    console.typeahead = header.get('typeahead', False)
+    console.intset_delay = 0 if speed is None else \
+        console.intset_delay / speed
+    task = asyncio.create_task(dialogue.run_dialogue(console))
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for direction, offset, data in records:
+        if task.done():
+            break
+        if direction != RECEIVED:
+            continue
+        if speed is None:
+            await asyncio.sleep(0)
+        else:
+            await asyncio.sleep(max(0.0, start + offset / speed - loop.time()))
+        console.session.received(data)
+    while console.session.inbox and not task.done():
+        await asyncio.sleep(0)
+    try:
+        await asyncio.wait_for(task, console.intset_delay + 1)
+    except asyncio.TimeoutError:
+        # The recording ended before the dialogue finished.
+        pass
+    return stream.sent
+
+
+def check_replay(records: List[Record], sent: List[bytes]) -> int:
+    ''' Compare replayed sends with the recording, return mismatches. '''
+    expected = [data for direction, _offset, data in records
+                if direction == SENT]
+    errors = 0
+    for index in range(max(len(expected), len(sent))):
+        want = expected[index] if index < len(expected) else None
+        got = sent[index] if index < len(sent) else None
+        if want != got:
+            logger.error('command %d: recorded %r, replay sent %r',
+                         index, want, got)
+            errors += 1
+    logger.info('%d commands recorded, %d sent on replay, %d mismatches',
+                len(expected), len(sent), errors)
+    return errors
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ''' Return the given percentile of a list of values. '''
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def bench_matcher(header: dict, records: List[Record],
+                  speed: Optional[float] = None) -> dict:
+    ''' Time the console buffer and prompt matcher over a recording.
+
+        Returns bytes per second of matcher time, and per chunk latency
+        percentiles in microseconds.  With speed set, chunks arrive at
+        the recorded times divided by speed.'''
+    _target, profile = load_profile(header)
+    # pylint: disable=import-outside-toplevel
+    from vms_kvm_buffer import ConsoleBuffer
+    from vms_kvm_matcher import PromptMatcher
+
+    # Every prompt of the profile at once, the worst case of any phase.
+    matcher = PromptMatcher(profile.prompts())
+    buffer = ConsoleBuffer()
+    chunks = [(offset, data) for direction, offset, data in records
+              if direction == RECEIVED]
+    latencies = []
+    matches = 0
+    busy = 0.0
+    start = time.perf_counter()
+    for offset, data in chunks:
+        if speed is not None:
+            delay = start + offset / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        before = time.perf_counter()
+        matches += len(buffer.feed(data, matcher))
+        elapsed = time.perf_counter() - before
+        busy += elapsed
+        latencies.append(elapsed * 1e6)
+    total = sum(len(data) for _offset, data in chunks)
+    return {
+        'speed': 'unthrottled' if speed is None else speed,
+        'chunks': len(chunks),
+        'bytes': total,
+        'prompts': matches,
+        'bytes_per_second': total / busy if busy else 0.0,
+        'wall_seconds': time.perf_counter() - start,
+        'chunk_us_p50': percentile(latencies, 0.50),
+        'chunk_us_p99': percentile(latencies, 0.99),
+        'chunk_us_max': max(latencies, default=0.0)}
+
+
+def main():
+    ''' Main. '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('recording', help='recorded console transcript')
+    parser.add_argument('--bench', action='store_true',
+                        help='benchmark the prompt matcher')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='follow the recorded timing, sped up by SPEED')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    header, records = load_recording(args.recording)
+    if args.bench:
+        results = [bench_matcher(header, records)]
+        results.append(bench_matcher(header, records, args.speed or 1.0))
+        print(json.dumps(results, indent=2))
+        return
+    sent = asyncio.run(replay_console(header, records, args.speed))
+    sys.exit(1 if check_replay(records, sent) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+'''Placement of OpenVMS nodes across several libvirt hosts.
+
+   Each host is asked for its memory, available memory (free plus the
+   buffers and page cache the kernel can reclaim), CPUs and the domains
+   it has defined and running.  Every node that is not already defined
+   on a host, or pinned to one by the uri of its fleet entry, is then
+   placed on the host with the most headroom left after taking it: the
+   smaller of its free memory and its free vCPU share.  A host never
+   takes a node that would leave it with less than the memory reserve
+   free, or more vCPUs than the overcommit ratio allows.
+
+   `vms_kvm_scheduler.py --host test:///default --memory 512 robin wren
+   finch` shows the hosts and the placement against the libvirt test
+   driver; give --host once for each host.'''
+
+import argparse
+import logging
+import sys
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple
+
+import libvirt     # type: ignore
+
+from vms_kvm_domain import TEMPLATE
+
+logger = logging.getLogger(__name__)
+
+MIB = 1024 * 1024
+# Memory left free on every host for the host itself.
+MEMORY_RESERVE = 1024 * MIB
+# Guest vCPUs allowed per host CPU.
+CPU_OVERCOMMIT = 2.0
+
+
+# pylint: disable=too-many-instance-attributes
+class Host():
+    ''' Capacity and planned use of one libvirt host. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, uri: str, memory: int, free_memory: int, cpus: int,
+                 vcpus: int = 0, domains: Optional[List[str]] = None,
+                 running: Optional[List[str]] = None) -> None:
+        self.uri = uri
+        self.memory = memory
+        self.free_memory = free_memory
+        self.cpus = cpus
+        # vCPUs of the running domains.
+        self.vcpus = vcpus
+        # Names of the defined and of the running domains.
+        self.domains = set(domains or [])
+        self.running = set(running or [])
+        self.placed = []    # List [str]
+
+    def headroom(self, memory: int, vcpus: int) -> Optional[float]:
+        ''' Return the headroom left after taking a node, as a fraction
+            of the host, or None if the node does not fit. '''
+        free_memory = self.free_memory - MEMORY_RESERVE - memory
+        vcpu_limit = self.cpus * CPU_OVERCOMMIT
+        free_vcpus = vcpu_limit - self.vcpus - vcpus
+        if free_memory < 0 or free_vcpus < 0:
+            return None
+        return min(free_memory / self.memory, free_vcpus / vcpu_limit)
+
+    def place(self, name: str, memory: int, vcpus: int) -> None:
+        ''' Count a node as running on this host. '''
+        self.placed.append(name)
+        self.free_memory -= memory
+        self.vcpus += vcpus
+
+    def summary(self) -> dict:
+        ''' Return the host as a JSON friendly dict. '''
+        return {'uri': self.uri, 'memory_mib': self.memory // MIB,
+                'free_memory_mib': self.free_memory // MIB,
+                'cpus': self.cpus, 'vcpus': self.vcpus,
+                'running': len(self.running), 'placed': list(self.placed)}
+
+
+def query_host(connection: libvirt.virConnect, uri: str) -> Host:
+    ''' Return the capacity and current use of a host. '''
+    _model, memory_mib, cpus = connection.getInfo()[:3]
+    domains = []
+    running = []
+    used = 0
+    vcpus = 0
+    for domain in connection.listAllDomains(0):
+        domains.append(domain.name())
+        if domain.isActive():
+            _state, _max_kib, memory_kib, domain_vcpus = domain.info()[:4]
+            running.append(domain.name())
+            used += memory_kib * 1024
+            vcpus += domain_vcpus
+    return Host(uri, memory_mib * MIB,
+                available_memory(connection, memory_mib * MIB - used),
+                cpus, vcpus, domains, running)
+
+
+def available_memory(connection: libvirt.virConnect, estimate: int) -> int:
+    ''' Return the memory guests can take on a host in bytes: the free
+        memory plus the buffers and page cache, e.g. of prewarmed golden
+        images, that the kernel reclaims, as MemAvailable counts it.
+
+        Without memory statistics from the driver only the free memory
+        is known, without that the estimate is returned.'''
+    try:
+        stats = connection.getMemoryStats(
+            libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS, 0)
+        return sum(stats.get(key, 0) for key in
+                   ('free', 'buffers', 'cached')) * 1024
+    except libvirt.libvirtError as exp:
+        logger.debug('node memory statistics not available: %s', exp)
+    try:
+        return connection.getFreeMemory()
+    except libvirt.libvirtError:
+        # Not every driver reports it, assume the guests use the rest.
+        return estimate
+
+
+def domain_demand(xml_path: str = TEMPLATE) -> Tuple[int, int]:
+    ''' Return the memory in bytes and the vCPUs of a domain XML file. '''
+    root = ET.parse(xml_path).getroot()
+    memory = root.find('memory')
+    scale = {'b': 1, 'bytes': 1, 'KiB': 1024, 'k': 1024, 'MiB': MIB,
+             'M': MIB, 'GiB': 1024 * MIB, 'G': 1024 * MIB}
+    size = int(memory.text) * scale[memory.get('unit', 'KiB')]
+    return size, int(root.findtext('vcpu') or 1)
+
+
+def place(names: List[str], hosts: List[Host], memory: int, vcpus: int,
+          pinned: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    ''' Return the host URI for each node name.
+
+        Nodes pinned to a URI, or already defined on a host, stay where
+        they are; the rest go one at a time to the host with the most
+        headroom.  Raises ValueError if a node fits on no host.'''
+    pinned = dict(pinned or {})
+    by_uri = {host.uri: host for host in hosts}
+    placement = {}
+    for name in names:
+        uri = pinned.get(name)
+        if uri is None:
+            uri = next((host.uri for host in hosts if name in host.domains),
+                       None)
+        if uri is None:
+            continue
+        host = by_uri.get(uri)
+        # A running node is already counted in the use of its host.
+        if host and name not in host.running:
+            host.place(name, memory, vcpus)
+        placement[name] = uri
+    for name in names:
+        if name in placement:
+            continue
+        scored = [(host.headroom(memory, vcpus), host) for host in hosts]
+        scored = [(score, host) for score, host in scored
+                  if score is not None]
+        if not scored:
+            raise ValueError(f'{name}: no host has {memory // MIB} MiB and'
+                             f' {vcpus} vCPUs to spare')
+        _score, host = max(scored, key=lambda item: item[0])
+        host.place(name, memory, vcpus)
+        placement[name] = host.uri
+    return placement
+
+
+def schedule(targets: List, hosts: List[Host], memory: int,
+             vcpus: int) -> None:
+    ''' Set the uri of every target to the host it is placed on. '''
+    placement = place([target.name for target in targets], hosts, memory,
+                      vcpus, {target.name: target.uri for target in targets
+                              if target.uri})
+    for target in targets:
+        target.uri = placement[target.name]
+        logger.info('%s: placed on %s', target.name, target.uri)
+
+
+def main():
+    ''' Main. '''
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('names', nargs='+', help='names of the nodes')
+    parser.add_argument('--host', action='append', required=True,
+                        metavar='URI', help='libvirt URI of a host; may be'
+                        ' given more than once')
+    parser.add_argument('--memory', type=int, metavar='MIB',
+                        help='memory of a node (default from the template)')
+    parser.add_argument('--vcpus', type=int,
+                        help='vCPUs of a node (default from the template)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    memory, vcpus = domain_demand()
+    memory = args.memory * MIB if args.memory else memory
+    vcpus = args.vcpus or vcpus
+    hosts = []
+    for uri in dict.fromkeys(args.host):
+        connection = libvirt.open(uri)
+        hosts.append(query_host(connection, uri))
+        connection.close()
+    try:
+        placement = place(args.names, hosts, memory, vcpus)
+    except ValueError as exp:
+        print(exp)
+        sys.exit(1)
+    for host in hosts:
+        print(host.summary())
+    for name in args.names:
+        print(f'{name}: {placement[name]}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+'''Console transcript output for the OpenVMS setup scripts.
+
+   Console output is kept in a fixed size ring of recent bytes for error
+   reports, and handed to a background writer thread that writes it in
+   batches to the terminal and to per domain transcript files.  The
+   event loop only ever appends to a queue, so a slow terminal or disk
+   can not stall the installs.
+
+   Transcript files are rotated by size, and the rotated files are
+   compressed with gzip, or with zstd when the zstandard module is
+   installed.'''
+
+import gzip
+import logging
+import os
+import queue
+import shutil
+import sys
+import threading
+from typing import List, Optional
+
+try:
+    import zstandard   # type: ignore
+except ImportError:
+    zstandard = None   # pylint: disable=invalid-name
+
+logger = logging.getLogger(__name__)
+
+COMPRESSION = ('gzip', 'zstd', 'none')
+
+
+class OutputRing():
+    ''' The last ring_max bytes of console output. '''
+    def __init__(self, ring_max: int = 16384) -> None:
+        self.ring_max = ring_max
+        self.ring_buffer = bytearray(ring_max)
+        self.ring_index = 0
+        self.wrapped = False
+
+    def write(self, data) -> None:
+        ''' Add console output, overwriting the oldest bytes. '''
+        data = memoryview(data)[-self.ring_max:]
+        size = len(data)
+        first = min(size, self.ring_max - self.ring_index)
+        self.ring_buffer[self.ring_index:self.ring_index + first] = \
+            data[:first]
+        if first < size:
+            self.ring_buffer[0:size - first] = data[first:]
+            self.wrapped = True
+        self.ring_index = (self.ring_index + size) % self.ring_max
+        if self.ring_index == 0 and size:
+            self.wrapped = True
+
+    def contents(self) -> bytes:
+        ''' Return the retained output, oldest first. '''
+        if not self.wrapped:
+            return bytes(self.ring_buffer[:self.ring_index])
+        return bytes(self.ring_buffer[self.ring_index:] +
+                     self.ring_buffer[:self.ring_index])
+
+    def text(self) -> str:
+        ''' Return the retained output as printable text. '''
+        return self.contents().decode('utf-8', 'replace').replace('\x00', '')
+
+
+class TerminalSink():
+    ''' Echo console output to the terminal. '''
+    def __init__(self, fd: Optional[int] = None) -> None:
+        self.fd = sys.stdout.fileno() if fd is None else fd
+
+    def write(self, data: bytes) -> None:
+        ''' Write one batch. '''
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def close(self) -> None:
+        ''' The terminal stays open. '''
+
+
+class RotatingTranscript():
+    ''' Transcript file rotated by size, rotated files compressed. '''
+    def __init__(self, path: str, max_bytes: int = 16 * 1024 * 1024,
+                 backups: int = 5, compression: str = 'gzip') -> None:
+        if compression not in COMPRESSION:
+            raise ValueError(f'Unknown compression {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard module')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compression = compression
+        self.suffix = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}[compression]
+        # pylint: disable=consider-using-with
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+
+    def backup_name(self, index: int) -> str:
+        ''' Name of the index'th rotated file. '''
+        return f'{self.path}.{index}{self.suffix}'
+
+    def rotate(self) -> None:
+        ''' Shift the rotated files and compress the current one. '''
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.backup_name(index)):
+                os.replace(self.backup_name(index),
+                           self.backup_name(index + 1))
+        if self.backups > 0:
+            self.compress(self.path, self.backup_name(1))
+        os.remove(self.path)
+        # pylint: disable=consider-using-with
+        self.file = open(self.path, 'ab')
+        self.size = 0
+
+    def compress(self, source: str, destination: str) -> None:
+        ''' Copy source to destination with the configured compression. '''
+        with open(source, 'rb') as source_file:
+            if self.compression == 'gzip':
+                with gzip.open(destination, 'wb') as dest_file:
+                    shutil.copyfileobj(source_file, dest_file)
+            elif self.compression == 'zstd':
+                with open(destination, 'wb') as dest_file:
+                    zstandard.ZstdCompressor().copy_stream(source_file,
+                                                           dest_file)
+            else:
+                with open(destination, 'wb') as dest_file:
+                    shutil.copyfileobj(source_file, dest_file)
+
+    def write(self, data: bytes) -> None:
+        ''' Write one batch, rotating first if the file is full. '''
+        if self.size and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def close(self) -> None:
+        ''' Close the transcript file. '''
+        self.file.close()
+
+
+class TranscriptWriter():
+    ''' Background thread writing console output to its sinks.
+
+        write() only queues the data.  The thread takes everything that
+        has queued up since its last pass and writes it with one call
+        per sink.'''
+    def __init__(self) -> None:
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='transcript',
+                                       daemon=True)
+        self.thread.start()
+
+    def write(self, sinks: List, data: bytes) -> None:
+        ''' Queue data for each of sinks. '''
+        for sink in sinks:
+            self.queue.put((sink, data))
+
+    def run(self) -> None:
+        ''' Writer thread. '''
+        running = True
+        while running:
+            items = [self.queue.get()]
+            try:
+                while True:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            batches = {}
+            for item in items:
+                if item is None:
+                    running = False
+                    continue
+                sink, data = item
+                batches.setdefault(sink, []).append(data)
+            for sink, chunks in batches.items():
+                try:
+                    sink.write(b''.join(chunks))
+                except OSError as exp:
+                    logger.warning('transcript write failed: %s', exp)
+
+    def close(self, sinks: Optional[List] = None) -> None:
+        ''' Write out everything queued, stop the thread and close sinks. '''
+        self.queue.put(None)
+        self.thread.join()
+        for sink in sinks or []:
+            sink.close()
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+'''AUTOGEN tuning profiles sized from the memory and vCPUs of a domain.
+
+   The setup writes only SCSNODE and SCSSYSTEMID to MODPARAMS.DAT, so
+   AUTOGEN sizes everything else from its defaults.  A tuning profile
+   adds working set, page file, lock and cache entries that suit the
+   role of the node, scaled to the memory and vCPUs libvirt gives the
+   domain, so the one AUTOGEN run of the setup already tunes the node:
+
+   * `build`: a build server, with large working sets, more processes
+     and channels, a larger lock hash table and file cache, and a page
+     file the size of memory.
+   * `router`: a DECnet router, with a larger nonpaged pool and buffer
+     size for the network and a small file cache.
+   * `minimal`: a small test node, with a small file cache, a half size
+     page file and compressed selective dumps.
+
+   `vms_kvm_tuning.py build --memory 4096 --vcpus 4` prints the entries
+   for a node of that size, `--domain robin` for a defined domain, and
+   without either for the XML template.'''
+
+import argparse
+import logging
+import sys
+from typing import Callable, Dict, Tuple
+
+import libvirt     # type: ignore
+
+from vms_kvm_scheduler import MIB, domain_demand
+
+logger = logging.getLogger(__name__)
+
+# OpenVMS pagelets and disk blocks per MiB, both are 512 bytes.
+PAGELETS = 2048
+BLOCKS = 2048
+
+
+def build_server(memory_mib: int, vcpus: int) -> Dict[str, int]:
+    ''' Compilers and linkers: big working sets, many processes. '''
+    return {
+        'MIN_WSMAX': memory_mib * PAGELETS // 4,
+        'ADD_GBLPAGES': memory_mib * 64,
+        'MIN_MAXPROCESSCNT': max(200, 64 * vcpus),
+        'MIN_CHANNELCNT': 2000,
+        'MIN_RESHASHTBL': 16384,
+        'VCC_MAX_CACHE': memory_mib // 4,
+        'PAGEFILE': memory_mib * BLOCKS}
+
+
+def decnet_router(memory_mib: int, _vcpus: int) -> Dict[str, int]:
+    ''' Routing: nonpaged pool and buffers for the circuits. '''
+    return {
+        'MIN_NPAGEDYN': memory_mib * MIB // 64,
+        'MIN_MAXBUF': 8192,
+        'MIN_RESHASHTBL': 4096,
+        'VCC_MAX_CACHE': memory_mib // 8,
+        'PAGEFILE': memory_mib * BLOCKS // 2}
+
+
+def minimal_node(memory_mib: int, _vcpus: int) -> Dict[str, int]:
+    ''' Test nodes: keep memory and disk use small. '''
+    return {
+        'VCC_MAX_CACHE': max(32, memory_mib // 16),
+        'PAGEFILE': memory_mib * BLOCKS // 2,
+        'DUMPSTYLE': 9}
+
+
+TUNING_PROFILES: Dict[str, Callable[[int, int], Dict[str, int]]] = {
+    'build': build_server,
+    'router': decnet_router,
+    'minimal': minimal_node}
+
+
+def domain_resources(domain: libvirt.virDomain) -> Tuple[int, int]:
+    ''' Return the maximum memory in MiB and the vCPUs of a domain. '''
+    _state, max_kib, _memory_kib, vcpus = domain.info()[:4]
+    return max_kib // 1024, vcpus
+
+
+def modparams(profile: str, memory_mib: int, vcpus: int) -> Dict[str, int]:
+    ''' Return the MODPARAMS.DAT entries of a tuning profile for a node
+        of this size.  Raises ValueError for an unknown profile. '''
+    if profile not in TUNING_PROFILES:
+        raise ValueError(f'no tuning profile {profile}, choose from'
+                         f' {", ".join(TUNING_PROFILES)}')
+    return TUNING_PROFILES[profile](memory_mib, vcpus)
+
+
+def main():
+    ''' Main. '''
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('profile', choices=TUNING_PROFILES,
+                        help='tuning profile')
+    parser.add_argument('--memory', type=int, metavar='MIB',
+                        help='memory of the node (default from the template)')
+    parser.add_argument('--vcpus', type=int,
+                        help='vCPUs of the node (default from the template)')
+    parser.add_argument('--domain', metavar='NAME',
+                        help='take the memory and vCPUs of a defined domain')
+    parser.add_argument('--uri', default='qemu:///system',
+                        help='libvirt URI for --domain')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.domain:
+        connection = libvirt.open(args.uri)
+        try:
+            memory_mib, vcpus = domain_resources(
+                connection.lookupByName(args.domain))
+        except libvirt.libvirtError as exp:
+            print(exp)
+            sys.exit(1)
+        finally:
+            connection.close()
+    else:
+        memory, vcpus = domain_demand()
+        memory_mib = memory // MIB
+    memory_mib = args.memory or memory_mib
+    vcpus = args.vcpus or vcpus
+    for name, value in modparams(args.profile, memory_mib, vcpus).items():
+        print(f'{name}={value}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+'''Stall watchdog for the OpenVMS setup dialogue.
+
+   A console is stalled when it has printed nothing for the inactivity
+   timeout, or has printed no prompt of its current phase for the
+   prompt timeout; phases may set their own values for both.  A stall
+   is escalated one step at a time, each step given a grace period to
+   bring up a prompt:
+
+   1. a CR is sent, which makes DCL and most menus repeat their prompt;
+   2. the recent output is scanned again for a prompt of the phase that
+      is still the last thing on the screen, for example a login prompt
+      ignored because no reboot was seen, and that prompt is answered;
+   3. the recent output is logged;
+   4. the node fails with a StallError, or with the reset action is
+      reverted to its last checkpoint snapshot, or reset and set up
+      again from the start.
+
+   A stall that comes back without any progress since the last one is
+   escalated straight to the last two steps.'''
+
+import asyncio
+import json
+import logging
+import time
+from typing import Optional
+
+from vms_kvm_checkpoint import restore
+from vms_kvm_matcher import PromptEntry
+
+logger = logging.getLogger(__name__)
+
+# Seconds without console output.
+INACTIVITY_TIMEOUT = 300.0
+# Seconds without a prompt of the current phase.
+PROMPT_TIMEOUT = 900.0
+# Seconds each escalation step is given to bring up a prompt.
+STALL_GRACE = 30.0
+# Seconds between checks.
+CHECK_INTERVAL = 5.0
+
+ACTIONS = ('fail', 'reset')
+
+
+class StallError(Exception):
+    ''' A console stopped making progress. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, name: str, phase: str, reason: str,
+                 idle: float, waited: float, progress: tuple) -> None:
+        super().__init__(f'{name}: stalled in phase {phase}, {reason}')
+        self.name = name
+        self.phase = phase
+        self.reason = reason
+        self.idle = idle
+        self.waited = waited
+        self.progress = progress
+
+    def details(self) -> dict:
+        ''' Return the failure as a JSON friendly dict. '''
+        return {'node': self.name, 'error': 'stalled',
+                'phase': self.phase, 'reason': self.reason,
+                'idle_seconds': round(self.idle, 3),
+                'waited_seconds': round(self.waited, 3),
+                'commands_sent': self.progress[0],
+                'commands_total': self.progress[1]}
+
+
+# pylint: disable=too-many-instance-attributes
+class Watchdog():
+    ''' Expect prompts for one console, escalating stalls. '''
+    # pylint: disable=too-many-arguments
+    def __init__(self, inactivity: float = INACTIVITY_TIMEOUT,
+                 prompt_timeout: float = PROMPT_TIMEOUT,
+                 grace: float = STALL_GRACE, action: str = 'fail',
+                 max_resets: int = 1,
+                 interval: float = CHECK_INTERVAL) -> None:
+        self.inactivity = inactivity
+        self.prompt_timeout = prompt_timeout
+        self.grace = grace
+        self.action = action
+        self.max_resets = max_resets
+        self.interval = interval
+        self.resets = 0
+        # Phase and commands sent after the last stall recovered from.
+        self.recovered = None   # Optional [tuple]
+        # Time of the output a rescanned prompt was last answered from.
+        self.answered = None    # Optional [float]
+
+    def stalled(self, console, idle: float,
+                waited: float) -> Optional[str]:
+        ''' Return why the console is stalled, or None if it is not. '''
+        phase = console.phase
+        inactivity = phase.inactivity or self.inactivity
+        timeout = phase.timeout or self.prompt_timeout
+        if idle >= inactivity:
+            return f'no output for {idle:.0f} seconds'
+        if waited >= timeout:
+            return f'no prompt for {waited:.0f} seconds'
+        return None
+
+    @staticmethod
+    def mark(console) -> tuple:
+        ''' Return the phase and the count of everything sent, to tell
+            whether a console got anywhere since its last stall. '''
+        return console.phase.name, console.session.metrics.commands
+
+    @staticmethod
+    def pending_prompt(console) -> Optional[PromptEntry]:
+        ''' Return the prompt of the current phase that ends the recent
+            output, if there is one. '''
+        output = console.session.ring.contents()
+        matches, _consumed = console.phase.matcher.scan(output)
+        if not matches:
+            return None
+        end, prompt = matches[-1]
+        if output[end:].strip(b' \t\r\n\x00'):
+            return None
+        return prompt
+
+    async def expect(self, console) -> PromptEntry:
+        ''' Wait for the next prompt of the console's current phase. '''
+        session = console.session
+        stage = 0
+        started = time.monotonic()
+        escalated = started
+        while True:
+            try:
+                return await session.expect(console.phase.matcher,
+                                            self.interval)
+            except asyncio.TimeoutError:
+                pass
+            now = time.monotonic()
+            idle = now - session.last_received
+            waited = now - started
+            if stage == 0:
+                reason = self.stalled(console, idle, waited)
+                if reason is None:
+                    continue
+                if self.recovered == self.mark(console):
+                    stage = 2
+                    reason += ' again'
+                else:
+                    logger.warning('%s: %s in phase %s, sending CR',
+                                   console.name, reason, console.phase.name)
+                    await session.send(b'\r')
+                    self.recovered = self.mark(console)
+                    stage = 1
+                    escalated = now
+                    continue
+            elif now - escalated < self.grace:
+                continue
+            if stage == 1:
+                prompt = self.pending_prompt(console)
+                if prompt is not None and \
+                        session.last_received != self.answered:
+                    self.answered = session.last_received
+                    logger.warning('%s: answering %s prompt found in the'
+                                   ' recent output', console.name, prompt[1])
+                    if prompt[1] == 'USERNAME':
+                        # Login prompts are otherwise only answered after
+                        # a reboot was seen.
+                        console.reboot = True
+                    return prompt
+                stage = 2
+            logger.error('%s: %s in phase %s, recent output:\n%s',
+                         console.name, reason, console.phase.name,
+                         session.ring.text())
+            if self.action == 'reset' and self.resets < self.max_resets:
+                self.resets += 1
+                await self.reset(console)
+                stage = 0
+                started = time.monotonic()
+                continue
+            error = StallError(console.name, console.phase.name, reason,
+                               idle, waited, console.progress())
+            logger.error('%s: %s', console.name, json.dumps(error.details()))
+            raise error
+
+    @staticmethod
+    async def reset(console) -> None:
+        ''' Revert the domain to its last checkpoint snapshot, or reset
+            it and start the dialogue over if there is none or it can
+            not be reverted to.
+
+            The output not matched yet is dropped either way.  Starting
+            over waits for an admission slot like any console entering
+            a heavy phase.'''
+        checkpoint = console.checkpoint
+        if checkpoint and checkpoint.snapshot:
+            console.session.discard()
+            step = await asyncio.to_thread(checkpoint.revert, console.domain)
+            if step:
+                restore(console, step)
+                await console.session.send(b'\r')
+                return
+        logger.warning('%s: resetting the domain and starting over',
+                       console.name)
+        console.set_phase(console.profile.start)
+        for key in console.prompt_index:
+            console.prompt_index[key] = 0
+        console.reboot = False
+        if console.admission and \
+                console.phase.name in console.profile.heavy_phases:
+            await console.admission.acquire(console)
+        console.session.discard()
+        await asyncio.to_thread(console.domain.reset, 0)
@@ -0,0 +1,16 @@
+'''Shared setup for the offline tests of the OpenVMS console scripts.
+
+   The modules live in kvm/ and import libvirt at the top; where libvirt
+   is not installed the stand-in of vms_kvm_replay is used, as for
+   replaying recordings.'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'kvm'))
+
+# pylint: disable=wrong-import-position
+from vms_kvm_replay import offline_libvirt  # noqa: E402
+
+offline_libvirt()
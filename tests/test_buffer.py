@@ -0,0 +1,80 @@
+'''Console buffer and session reads with output split into chunks.'''
+
+import asyncio
+
+import pytest
+
+from vms_kvm_aio import ConsoleSession
+from vms_kvm_buffer import ConsoleBuffer
+from vms_kvm_matcher import PromptMatcher
+
+TABLE = [('\r\nUsername: ', 'USERNAME', []),
+         ('\r\nPassword: ', 'PASSWORD', []),
+         ('\r\n\x00$ ', 'DOLLAR', []),
+         ('$ ', 'SHORT', [])]
+OUTPUT = (b'%STDRV-I-STARTUP, OpenVMS startup begun\r\n'
+          b'Welcome to OpenVMS\r\nUsername: SYSTEM\r\nPassword: \r\n'
+          b'$ is not a prompt, nor is Username: without a new line\r\n'
+          b'\x00$ show time\r\n  17-OCT-2026 12:00:00\r\n\x00$ ')
+EXPECTED = ['USERNAME', 'PASSWORD', 'SHORT', 'DOLLAR', 'DOLLAR']
+
+
+def keys(matches: list) -> list:
+    ''' Return the prompt keys of matches. '''
+    return [entry[1] for _end, entry in matches]
+
+
+def test_whole():
+    ''' The output fed at once. '''
+    assert keys(ConsoleBuffer().feed(OUTPUT, PromptMatcher(TABLE))) == \
+        EXPECTED
+
+
+@pytest.mark.parametrize('capacity', [32, 65536])
+def test_every_split(capacity):
+    ''' A prompt split anywhere between two chunks is still matched
+        once, also in a buffer that has to slide its window. '''
+    matcher = PromptMatcher(TABLE)
+    for split in range(len(OUTPUT) + 1):
+        buffer = ConsoleBuffer(capacity)
+        matches = buffer.feed(OUTPUT[:split], matcher)
+        matches += buffer.feed(OUTPUT[split:], matcher)
+        assert keys(matches) == EXPECTED, split
+
+
+def test_byte_at_a_time():
+    ''' Output arriving one byte per read. '''
+    matcher = PromptMatcher(TABLE)
+    buffer = ConsoleBuffer(32)
+    matches = []
+    for offset in range(len(OUTPUT)):
+        matches += buffer.feed(OUTPUT[offset:offset + 1], matcher)
+    assert keys(matches) == EXPECTED
+
+
+class ChunkStream():
+    ''' Console stream that returns the output in fixed size reads. '''
+    def __init__(self, data: bytes, size: int) -> None:
+        self.chunks = [data[offset:offset + size]
+                       for offset in range(0, len(data), size)]
+
+    def recv(self, _nbytes: int):
+        ''' Return the next chunk, or -2 as if it would block. '''
+        return self.chunks.pop(0) if self.chunks else -2
+
+
+@pytest.mark.parametrize('size', [1, 7, 4096])
+def test_session_reads(size):
+    ''' Reads are queued as they come and matched by expect, also when
+        the buffer takes only part of a chunk. '''
+    session = ConsoleSession(None, None, 'robin')
+    session.buffer = ConsoleBuffer(32)
+    session.stream = ChunkStream(OUTPUT, size)
+    assert session.drain() == len(OUTPUT)
+    matcher = PromptMatcher(TABLE)
+
+    async def expect_all() -> list:
+        return [(await session.expect(matcher, 1))[1] for _ in EXPECTED]
+
+    assert asyncio.run(expect_all()) == EXPECTED
+    assert session.metrics.reads == -(-len(OUTPUT) // size)
@@ -0,0 +1,77 @@
+'''Saving the dialogue state and resuming from it.'''
+
+import asyncio
+
+import vms_kvm_dialogue as dialogue
+from vms_kvm_checkpoint import Checkpoint, restore
+from vms_kvm_replay import FakeConnection, FakeStream, load_profile
+
+HEADER = {'profile': 'v923', 'settings': {'name': 'robin', 'decnet': '1.13'}}
+
+
+def new_console() -> dialogue.Console:
+    ''' Return a console of the default profile on a stand-in stream. '''
+    target, profile = load_profile(HEADER)
+    console = dialogue.Console(FakeConnection(target.name), target, profile)
+    console.session.stream = FakeStream()
+    return console
+
+
+def test_resume_without_snapshot(tmp_path):
+    ''' A running domain resumed without a snapshot gets a CR to print
+        its prompt again, then the dialogue continues where it was. '''
+    console = new_console()
+    console.set_phase('DCL')
+    console.prompt_index['DOLLAR'] = 3
+    asyncio.run(Checkpoint(str(tmp_path), 'robin', 'v923').save(console))
+
+    resumed = new_console()
+    step = dialogue.resume_target(resumed.connection, resumed.target,
+                                  Checkpoint(str(tmp_path), 'robin', 'v923'))
+    restore(resumed, step)
+    assert resumed.phase.name == 'DCL'
+    assert resumed.nudge
+    stream = resumed.session.stream
+
+    async def run() -> None:
+        task = asyncio.create_task(dialogue.run_dialogue(resumed))
+        await asyncio.sleep(0.05)
+        resumed.session.received(b'\r\n\x00$ ')
+        await asyncio.sleep(0.05)
+        resumed.finish()
+        await asyncio.wait_for(task, 1)
+
+    asyncio.run(run())
+    commands = resumed.profile.phases['DCL'].prompts[0][2]
+    assert stream.sent[:2] == [b'\r', commands[3] + b'\r']
+
+
+def test_nothing_saved(tmp_path):
+    ''' Without a state file the setup starts over. '''
+    console = new_console()
+    assert dialogue.resume_target(
+        console.connection, console.target,
+        Checkpoint(str(tmp_path), 'robin', 'v923')) is None
+
+
+def test_snapshot_gone(tmp_path):
+    ''' A saved snapshot that no longer exists is forgotten and the
+        running domain is resumed from the state file instead. '''
+    console = new_console()
+    console.set_phase('DCL')
+    console.prompt_index['DOLLAR'] = 3
+    checkpoint = Checkpoint(str(tmp_path), 'robin', 'v923')
+    checkpoint.snapshot = {'name': 'vms-setup-dcl'}
+    asyncio.run(checkpoint.save(console))
+
+    def lookup(name, _flags):
+        raise dialogue.libvirt.libvirtError(f'no snapshot {name}')
+
+    resumed = new_console()
+    resumed.connection.domain.snapshotLookupByName = lookup
+    checkpoint = Checkpoint(str(tmp_path), 'robin', 'v923')
+    step = dialogue.resume_target(resumed.connection, resumed.target,
+                                  checkpoint)
+    assert checkpoint.snapshot is None
+    assert step['phase'] == 'DCL'
+    assert step['prompt_index']['DOLLAR'] == 3
@@ -0,0 +1,57 @@
+'''Device profiles of the domain XML generator.'''
+
+import xml.etree.ElementTree as ET
+
+import libvirt     # type: ignore
+import pytest
+
+import vms_kvm_domain as domain
+
+
+@pytest.mark.parametrize('profile', list(domain.PROFILES))
+def test_render(profile):
+    ''' Every profile renders XML that has its settings. '''
+    root = ET.fromstring(domain.render_domain('robin', profile, '/images'))
+    domain.check_domain(root, domain.PROFILES[profile])
+    disks = [disk.find('source').get('file') for disk in
+             root.findall("./devices/disk[@device='disk']")]
+    assert disks == ['/images/robin' + suffix for suffix in domain.DISKS]
+
+
+def test_virtio_has_no_sata():
+    ''' The virtio profile only declares the controllers its disks use. '''
+    root = ET.fromstring(domain.render_domain('robin', 'virtio'))
+    types = [controller.get('type') for controller in
+             root.findall('./devices/controller')]
+    assert 'sata' not in types
+    assert types.count('scsi') == 1
+
+
+@pytest.mark.skipif(not hasattr(libvirt, 'open'),
+                    reason='libvirt is not installed')
+def test_check_profiles():
+    ''' Every profile defines on the libvirt test driver unchanged. '''
+    assert domain.check_profiles('test:///default') == {}
+
+
+@pytest.mark.parametrize('profile', list(domain.PROFILES))
+def test_validate(profile):
+    ''' Every profile renders XML that libvirt would define as it is,
+        checked offline where the test driver is not installed. '''
+    domain.validate_domain(ET.fromstring(domain.render_domain(
+        'robin', profile)))
+
+
+def test_validate_rejects():
+    ''' A disk on a bus without its controller and a duplicate disk
+        target are refused. '''
+    root = ET.fromstring(domain.render_domain('robin', 'virtio'))
+    devices = root.find('devices')
+    devices.remove(devices.find("controller[@type='scsi']"))
+    with pytest.raises(ValueError):
+        domain.validate_domain(root)
+    root = ET.fromstring(domain.render_domain('robin', 'template'))
+    disks = root.findall('./devices/disk/target')
+    disks[1].set('dev', disks[0].get('dev'))
+    with pytest.raises(ValueError):
+        domain.validate_domain(root)
@@ -0,0 +1,71 @@
+'''Fleet files and waiting for the consoles of a fleet.'''
+
+import asyncio
+import json
+
+import pytest
+
+import vms_kvm_dialogue as dialogue
+from vms_kvm_fleet import FleetProgress, load_fleet
+from vms_kvm_replay import FakeConnection, FakeStream, load_profile
+
+
+def console_for(name: str, decnet: str) -> dialogue.Console:
+    ''' Return a console of the default profile on a stand-in stream. '''
+    target, profile = load_profile({'profile': 'v923', 'settings': {
+        'name': name, 'decnet': decnet}})
+    console = dialogue.Console(FakeConnection(target.name), target, profile)
+    console.session.stream = FakeStream()
+    return console
+
+
+def test_raising_task_fails_its_node():
+    ''' A task that raises fails only its own node and the wait ends. '''
+    robin = console_for('robin', '1.13')
+    kite = console_for('kite', '1.14')
+    fleet = FleetProgress([robin, kite])
+    robin.fleet = fleet
+    kite.fleet = fleet
+
+    async def broken() -> None:
+        raise RuntimeError('console went away')
+
+    async def complete() -> None:
+        await asyncio.sleep(0.05)
+        kite.finish()
+
+    async def run() -> None:
+        tasks = {asyncio.create_task(broken()): robin,
+                 asyncio.create_task(complete()): kite}
+        await asyncio.wait_for(dialogue.wait_consoles(tasks, fleet), 5)
+
+    asyncio.run(run())
+    assert set(fleet.finished) == {'robin', 'kite'}
+    assert fleet.failed == {'robin'}
+    assert not robin.run_console
+
+
+def test_fleet_defaults(tmp_path):
+    ''' Fleet defaults apply to every target, targets override them. '''
+    path = tmp_path / 'fleet.json'
+    path.write_text(json.dumps({
+        'defaults': {'domain': 'xile.realm'},
+        'targets': [{'name': 'robin', 'decnet': '1.13'},
+                    {'name': 'kite', 'decnet': '1.14',
+                     'domain': 'other.realm'}]}), encoding='utf-8')
+    robin, kite = load_fleet(str(path))
+    assert robin.domain == b'xile.realm'
+    assert kite.domain == b'other.realm'
+    assert kite.scssystemid_int == 1 * 1024 + 14
+
+
+@pytest.mark.parametrize('second', [
+    {'name': 'robin', 'decnet': '1.14'},
+    {'name': 'kite', 'decnet': '1.13'}])
+def test_fleet_duplicates(tmp_path, second):
+    ''' Two targets may not share a name or a DECnet address. '''
+    path = tmp_path / 'fleet.json'
+    path.write_text(json.dumps([{'name': 'robin', 'decnet': '1.13'},
+                                second]), encoding='utf-8')
+    with pytest.raises(ValueError):
+        load_fleet(str(path))
@@ -0,0 +1,87 @@
+'''Golden image clones: overlay naming and data disks.'''
+
+import json
+import os
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import vms_kvm_golden as golden
+from vms_kvm_image import create_image, image_size, read_header
+
+GIB = 1024 * 1024 * 1024
+
+DOMAIN_XML = '''<domain type='kvm'>
+  <name>robin</name>
+  <uuid>6b3c9a44-0c55-4d7e-9b43-6f0a3b9a1b1e</uuid>
+  <memory unit='KiB'>4194304</memory>
+  <vcpu placement='static'>2</vcpu>
+  <devices>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2'/>
+      <source file='/images/robin_vms923.qcow2'/>
+    </disk>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2'/>
+      <source file='/images/robin_data.qcow2'/>
+    </disk>
+    <interface type='network'>
+      <mac address='52:54:00:12:34:56'/>
+    </interface>
+  </devices>
+</domain>'''
+
+
+class DefiningConnection():
+    ''' Keeps the XML of the domain defined. '''
+    def __init__(self) -> None:
+        self.xml = None
+
+    def defineXML(self, xml: str) -> str:   # pylint: disable=invalid-name
+        ''' Return the XML instead of a domain. '''
+        self.xml = xml
+        return xml
+
+
+@pytest.fixture(name='golden_dir')
+def golden_dir_fixture(tmp_path) -> str:
+    ''' A golden image of a node with a data disk. '''
+    path = tmp_path / 'golden'
+    path.mkdir()
+    create_image(str(path / golden.GOLDEN_DISK), size=GIB)
+    (path / golden.GOLDEN_XML).write_text(DOMAIN_XML, encoding='utf-8')
+    (path / golden.GOLDEN_INFO).write_text(json.dumps(
+        {'source': 'robin', 'settings': {},
+         'disks': {'_data.qcow2': 2 * GIB}}), encoding='utf-8')
+    return str(path)
+
+
+def test_clone_disks(golden_dir, tmp_path):
+    ''' The overlay is named like a node's system disk and the data disk
+        is a new empty disk of the saved size. '''
+    image_dir = str(tmp_path)
+    connection = DefiningConnection()
+    golden.clone_domain(connection, golden_dir, 'kite', image_dir)
+    files = [source.get('file') for source in
+             ET.fromstring(connection.xml).findall('./devices/disk/source')]
+    overlay = os.path.join(image_dir, 'kite_vms923.qcow2')
+    data = os.path.join(image_dir, 'kite_data.qcow2')
+    assert files == [overlay, data]
+    assert read_header(overlay)['backing_file'] == \
+        os.path.join(golden_dir, golden.GOLDEN_DISK)
+    assert image_size(data) == 2 * GIB
+
+
+def test_clone_existing_overlay(golden_dir, tmp_path):
+    ''' An existing system disk is never overwritten. '''
+    create_image(str(tmp_path / 'kite_vms923.qcow2'), size=GIB)
+    with pytest.raises(ValueError):
+        golden.clone_domain(DefiningConnection(), golden_dir, 'kite',
+                            str(tmp_path))
+
+
+def test_unknown_disk():
+    ''' Disks other than the data and backup disks are refused. '''
+    root = ET.fromstring(DOMAIN_XML.replace('robin_data', 'robin_scratch'))
+    with pytest.raises(ValueError):
+        golden.data_disks(root)
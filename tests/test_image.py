@@ -0,0 +1,37 @@
+'''qcow2 images written without qemu-img.'''
+
+import pytest
+
+from vms_kvm_image import (GIB, backing_chain, create_image, create_images,
+                           image_size, read_header)
+
+
+def test_overlay(tmp_path):
+    ''' An overlay takes the size of its backing file. '''
+    base = str(tmp_path / 'base.qcow2')
+    overlay = str(tmp_path / 'robin_vms923.qcow2')
+    create_image(base, size=2 * GIB, preallocation='metadata')
+    create_image(overlay, backing=base)
+    assert image_size(overlay) == 2 * GIB
+    assert read_header(overlay)['backing_file'] == base
+    assert [item['path'] for item in backing_chain(overlay)] == \
+        [overlay, base]
+
+
+def test_existing_image(tmp_path):
+    ''' An existing image is never overwritten. '''
+    path = str(tmp_path / 'robin_data.qcow2')
+    create_image(path, size=GIB)
+    with pytest.raises(ValueError):
+        create_image(path, size=2 * GIB)
+    assert image_size(path) == GIB
+
+
+def test_create_missing(tmp_path):
+    ''' Only the missing images of a set are created. '''
+    existing = str(tmp_path / 'robin_data.qcow2')
+    missing = str(tmp_path / 'robin_backup.qcow2')
+    create_image(existing, size=GIB)
+    created = create_images([(existing, {'size': GIB}),
+                             (missing, {'size': GIB})])
+    assert created == [missing]
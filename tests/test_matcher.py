@@ -0,0 +1,65 @@
+'''Prompt matcher against a naive search.'''
+
+import random
+
+import pytest
+
+from vms_kvm_matcher import PromptMatcher
+
+
+def naive_scan(data: bytes, patterns: list, start: int = 0,
+               first: bool = False) -> tuple:
+    ''' The matcher rules spelled out: at each end offset the longest
+        prompt that ends there after the last match wins, the first in
+        the table among equals. '''
+    matches = []
+    consumed = 0
+    for end in range(1, len(data) + 1):
+        found = [(len(pattern), -index) for index, pattern
+                 in enumerate(patterns)
+                 if end - len(pattern) >= consumed and
+                 data[end - len(pattern):end] == pattern]
+        if not found:
+            continue
+        index = -max(found)[1]
+        consumed = end
+        if end > start:
+            matches.append((end, index))
+            if first:
+                break
+    return matches, consumed
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_tables(seed):
+    ''' Random prompt tables over a small alphabet, where prompts often
+        overlap and contain each other. '''
+    rng = random.Random(seed)
+    patterns = [bytes(rng.choice(b'ab$\r') for _ in
+                      range(rng.randint(1, 5))) for _ in range(6)]
+    table = [(pattern, f'P{index}', []) for index, pattern
+             in enumerate(patterns)]
+    matcher = PromptMatcher(table)
+    for _ in range(20):
+        data = bytes(rng.choice(b'ab$\r') for _ in range(rng.randint(0, 60)))
+        start = rng.randint(0, len(data))
+        for first in (False, True):
+            found, consumed = matcher.scan(data, start, first)
+            expected, expected_consumed = naive_scan(data, patterns, start,
+                                                     first)
+            assert [(end, table.index(entry)) for end, entry in found] == \
+                expected
+            assert consumed == expected_consumed
+
+
+def test_longest_prompt_wins():
+    ''' A prompt ending in another one is preferred over it. '''
+    table = [('$ ', 'SHORT', []), ('\r\n\x00$ ', 'LONG', [])]
+    found, _consumed = PromptMatcher(table).scan(b'output\r\n\x00$ ')
+    assert [entry[1] for _end, entry in found] == ['LONG']
+
+
+def test_empty_prompt():
+    ''' An empty prompt would match everywhere. '''
+    with pytest.raises(ValueError):
+        PromptMatcher([('', 'EMPTY', [])])
@@ -0,0 +1,141 @@
+'''Host topology and the placement ledger, on a made up /sys tree.'''
+
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from vms_kvm_placement import (HUGEPAGE_KIB, Ledger, apply_placement,
+                               clear_placement, read_topology)
+
+PAGES = f'hugepages/hugepages-{HUGEPAGE_KIB}kB'
+
+
+def write(path, text) -> None:
+    ''' Write a sysfs file, creating its directory. '''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(f'{text}\n', encoding='utf-8')
+
+
+def make_sysfs(root, nodes: int = 2, cores: int = 4, pages: int = 4096,
+               numa: bool = True):
+    ''' A host with nodes sockets of cores cores, two threads each, the
+        threads of a core numbered cores apart as Linux does. '''
+    cpu_dir = root / 'devices' / 'system' / 'cpu'
+    total = nodes * cores * 2
+    write(cpu_dir / 'online', f'0-{total - 1}')
+    for node in range(nodes):
+        cpus = []
+        for core in range(cores):
+            first = node * cores + core
+            for cpu in (first, first + nodes * cores):
+                cpus.append(cpu)
+                topology = cpu_dir / f'cpu{cpu}' / 'topology'
+                write(topology / 'physical_package_id', node)
+                write(topology / 'core_id', core)
+        if numa:
+            node_dir = root / 'devices' / 'system' / 'node' / f'node{node}'
+            write(node_dir / 'cpulist', ','.join(map(str, sorted(cpus))))
+            write(node_dir / PAGES / 'nr_hugepages', pages)
+            write(node_dir / PAGES / 'free_hugepages', pages)
+    if not numa:
+        write(root / 'kernel' / 'mm' / PAGES / 'nr_hugepages', pages)
+        write(root / 'kernel' / 'mm' / PAGES / 'free_hugepages', pages)
+    return str(root)
+
+
+def test_topology(tmp_path):
+    ''' Threads of a core are kept together, per NUMA node. '''
+    nodes = read_topology(make_sysfs(tmp_path))
+    assert [node.node for node in nodes] == [0, 1]
+    assert nodes[0].cores == [[0, 8], [1, 9], [2, 10], [3, 11]]
+    assert nodes[1].socket == 1
+    assert nodes[1].free_hugepages == 4096
+
+
+def test_without_numa(tmp_path):
+    ''' A kernel without NUMA is one node with every CPU. '''
+    nodes = read_topology(make_sysfs(tmp_path, numa=False))
+    assert len(nodes) == 1
+    assert len(nodes[0].cores) == 8
+    assert nodes[0].hugepages == 4096
+
+
+def test_no_overlap(tmp_path):
+    ''' Domains get whole cores that no other domain and not the host
+        core has, until the host is full. '''
+    nodes = read_topology(make_sysfs(tmp_path / 'sys'))
+    ledger = Ledger(str(tmp_path / 'ledger.json'))
+    host = {cpu for node in nodes for cpu in node.cores[0]}
+    used = set()
+    for index in range(6):
+        allocation = ledger.allocate(f'node{index}', 2, 1024, nodes,
+                                     hugepages=False)
+        cpus = set(allocation.cpus)
+        assert len(cpus) == 2
+        assert not cpus & used and not cpus & host
+        assert cpus in [set(core) for node in nodes for core in node.cores]
+        assert set(allocation.emulator) == \
+            set(nodes[allocation.node].cores[0])
+        used |= cpus
+    with pytest.raises(ValueError):
+        ledger.allocate('node6', 2, 1024, nodes, hugepages=False)
+    # The ledger survives, a domain keeps its allocation.
+    assert Ledger(str(tmp_path / 'ledger.json')).load()['node0'].cpus == \
+        ledger.allocate('node0', 2, 1024, nodes).cpus
+
+
+def test_spread_over_nodes(tmp_path):
+    ''' Each new domain goes to the node with the most cores left. '''
+    nodes = read_topology(make_sysfs(tmp_path / 'sys'))
+    ledger = Ledger(str(tmp_path / 'ledger.json'))
+    placed = [ledger.allocate(f'node{index}', 2, 1024, nodes,
+                              hugepages=False).node for index in range(4)]
+    assert sorted(placed) == [0, 0, 1, 1]
+
+
+def test_hugepages(tmp_path):
+    ''' Memory is placed where the hugepages are free. '''
+    nodes = read_topology(make_sysfs(tmp_path / 'sys', pages=2048))
+    ledger = Ledger(str(tmp_path / 'ledger.json'))
+    first = ledger.allocate('robin', 2, 4096, nodes)
+    second = ledger.allocate('kite', 2, 4096, nodes)
+    assert first.hugepages == second.hugepages == 2048
+    assert {first.node, second.node} == {0, 1}
+    with pytest.raises(ValueError):
+        ledger.allocate('hawk', 2, 4096, nodes)
+
+
+def test_release_and_prune(tmp_path):
+    ''' Released and undefined domains give their cores back. '''
+    nodes = read_topology(make_sysfs(tmp_path / 'sys', nodes=1))
+    ledger = Ledger(str(tmp_path / 'ledger.json'))
+    for name in ('robin', 'kite', 'hawk'):
+        ledger.allocate(name, 2, 1024, nodes, hugepages=False)
+    with pytest.raises(ValueError):
+        ledger.allocate('owl', 2, 1024, nodes, hugepages=False)
+    assert ledger.release('robin')
+    assert not ledger.release('robin')
+    ledger.allocate('owl', 2, 1024, nodes, hugepages=False)
+    ledger.allocate('lark', 2, 1024, nodes, hugepages=False,
+                    defined=['owl', 'lark'])
+    assert set(ledger.load()) == {'owl', 'lark'}
+
+
+def test_domain_xml(tmp_path):
+    ''' The allocation is written into the domain XML and cleared. '''
+    nodes = read_topology(make_sysfs(tmp_path / 'sys'))
+    allocation = Ledger(str(tmp_path / 'ledger.json')).allocate(
+        'robin', 2, 1024, nodes)
+    root = ET.fromstring('<domain><memory>1048576</memory>'
+                         '<vcpu>4</vcpu><devices/></domain>')
+    apply_placement(root, allocation)
+    pins = [int(pin.get('cpuset')) for pin in root.findall(
+        './cputune/vcpupin')]
+    assert pins == allocation.cpus
+    assert root.find('./numatune/memory').get('nodeset') == \
+        str(allocation.node)
+    assert root.find('./memoryBacking/hugepages/page') is not None
+    clear_placement(root)
+    assert root.find('cputune') is None
+    assert root.find('memoryBacking') is None
+    assert 'cpuset' not in root.find('vcpu').attrib
@@ -0,0 +1,79 @@
+'''Readiness probe hand-off against a local stand-in SSH listener.'''
+
+import asyncio
+import functools
+
+import vms_kvm_dialogue as dialogue
+from vms_kvm_fleet import FleetProgress
+from vms_kvm_probe import ReadinessProber
+from vms_kvm_replay import FakeConnection, FakeStream, load_profile
+
+HEADER = {'profile': 'v923',
+          'settings': {'name': 'robin', 'decnet': '1.13',
+                       'address': '127.0.0.1'}}
+
+
+async def ssh_banner(_reader, writer) -> None:
+    ''' Answer like an SSH server and hang up. '''
+    writer.write(b'SSH-2.0-OpenSSH_stand_in\r\n')
+    await writer.drain()
+    writer.close()
+
+
+def ready_console() -> dialogue.Console:
+    ''' Return a console waiting for a prompt in the SSH phase. '''
+    target, profile = load_profile(HEADER)
+    console = dialogue.Console(FakeConnection(target.name), target, profile)
+    console.session.stream = FakeStream()
+    console.set_phase(profile.ready_phase)
+    return console
+
+
+async def probe_hand_off(monkeypatch, stall_action: str) -> tuple:
+    ''' Run the dialogue and the probe of one console until both end. '''
+    server = await asyncio.start_server(ssh_banner, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    monkeypatch.setattr(dialogue, 'ReadinessProber', functools.partial(
+        ReadinessProber, ports={'ssh': port}, initial=0.01))
+    console = ready_console()
+    console.fleet = FleetProgress([console])
+    if stall_action != 'none':
+        console.watchdog = dialogue.Watchdog(0.3, 0.3, grace=0.05,
+                                             action=stall_action,
+                                             interval=0.05)
+    try:
+        await asyncio.wait_for(asyncio.gather(
+            dialogue.run_dialogue(console),
+            dialogue.probe_console(console, ['ssh'])), 10.0)
+        # A late watchdog must not turn the hand-off into a failure.
+        await asyncio.sleep(1.0)
+    finally:
+        server.close()
+        await server.wait_closed()
+    return console, console.fleet
+
+
+def test_probe_hands_off_without_watchdog(monkeypatch):
+    ''' The dialogue waiting for a prompt ends when the probe finishes
+        the console. '''
+    console, fleet = asyncio.run(probe_hand_off(monkeypatch, 'none'))
+    assert not console.run_console
+    assert console.session.metrics.failure is None
+    assert 'ssh' in console.session.metrics.reachable
+    assert fleet.finished and not fleet.failed
+
+
+def test_probe_hand_off_is_not_a_stall(monkeypatch):
+    ''' With the watchdog on, the handed off node is not failed later. '''
+    console, fleet = asyncio.run(probe_hand_off(monkeypatch, 'fail'))
+    assert console.session.metrics.failure is None
+    assert console.session.metrics.summary()['failure'] is None
+    assert not fleet.failed
+
+
+def test_finish_is_idempotent():
+    ''' Only the first finish of a console counts. '''
+    console = ready_console()
+    console.finish()
+    console.finish(failure={'reason': 'stalled'})
+    assert console.session.metrics.failure is None
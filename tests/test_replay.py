@@ -0,0 +1,111 @@
+'''Recording a setup against the emulated guest and replaying it.'''
+
+import asyncio
+import json
+
+import pytest
+
+import vms_kvm_dialogue as dialogue
+from vms_kvm_emulator import Guest
+from vms_kvm_fleet import Target
+from vms_kvm_replay import (MAGIC, REDACTED, SENT, FakeConnection,
+                            FakeStream, TranscriptRecorder, check_replay,
+                            load_profile, load_recording, replay_console)
+import setup_vms_community_kvm
+
+# The password is also the node name, so a bare substring replace would
+# redact the SCSNODE entry as well.
+SETTINGS = {'name': 'robin', 'decnet': '1.13', 'domain': 'xile.realm'}
+PASSWORD = 'robin'
+
+
+class GuestStream(FakeStream):
+    ''' Console stream whose sends are read by the emulated guest. '''
+    def __init__(self, reader: asyncio.StreamReader) -> None:
+        super().__init__()
+        self.reader = reader
+
+    def send(self, data: bytes) -> int:
+        ''' Pass a send on to the guest. '''
+        self.reader.feed_data(bytes(data))
+        return super().send(data)
+
+
+class GuestWriter():
+    ''' Guest output, received by the console session. '''
+    def __init__(self, session) -> None:
+        self.session = session
+
+    def write(self, data: bytes) -> None:
+        ''' Queue output for the session. '''
+        self.session.received(data)
+
+    @staticmethod
+    async def drain() -> None:
+        ''' Let the dialogue run. '''
+        await asyncio.sleep(0)
+
+
+async def record(path: str, typeahead: bool) -> None:
+    ''' Set up the emulated guest once, recording the console. '''
+    target = Target.from_dict(SETTINGS, {'password': PASSWORD})
+    profile = setup_vms_community_kvm.build_profile(target)
+    console = dialogue.Console(FakeConnection(target.name), target, profile)
+    reader = asyncio.StreamReader()
+    console.session.stream = GuestStream(reader)
+    console.intset_delay = 0
+    console.typeahead = typeahead
+    console.session.recorder = TranscriptRecorder(
+        path, target, profile.name, {'clone': False, 'power_off': False},
+        typeahead, profile.secret_prompts)
+    guest = Guest(target.name, profile, reader,
+                  GuestWriter(console.session), output=64)
+    guest_task = asyncio.create_task(guest.run())
+    await asyncio.wait_for(dialogue.run_dialogue(console), 30)
+    reader.feed_eof()
+    report = await guest_task
+    assert report['complete'] and not report['errors']
+
+
+@pytest.mark.parametrize('typeahead', [False, True])
+def test_round_trip(tmp_path, typeahead):
+    ''' A replay sends exactly the recorded commands. '''
+    path = str(tmp_path / 'robin.vmsrec')
+    asyncio.run(record(path, typeahead))
+    header, records = load_recording(path)
+    assert header['typeahead'] is typeahead
+    sent = asyncio.run(replay_console(header, records))
+    assert check_replay(records, sent) == 0
+
+
+def test_redaction(tmp_path):
+    ''' Only the answers to password prompts are redacted. '''
+    path = str(tmp_path / 'robin.vmsrec')
+    asyncio.run(record(path, False))
+    _header, records = load_recording(path)
+    sent = [data for direction, _offset, data in records
+            if direction == SENT]
+    assert REDACTED + b'\r' in sent
+    assert b'MODIFY SYSTEM/NOPWDEXP/NOPWDLIFE/PASS="' + REDACTED + b'"\r' \
+        in sent
+    assert b'write mpd "SCSNODE="""robin""\r' in sent
+
+
+def test_recorded_options():
+    ''' The profile is rebuilt with the recorded options. '''
+    header = {'profile': 'v923', 'options': {'clone': True},
+              'settings': SETTINGS}
+    _target, profile = load_profile(header)
+    assert profile.start == 'REBOOT'
+    _target, profile = load_profile(header, clone=False)
+    assert profile.start == 'ESC'
+
+
+@pytest.mark.parametrize('header', [SETTINGS, {'settings': SETTINGS},
+                                    {'profile': 'v923'}])
+def test_malformed_header(tmp_path, header):
+    ''' A header without the profile or the settings is refused. '''
+    path = tmp_path / 'robin.vmsrec'
+    path.write_bytes(MAGIC + json.dumps(header).encode() + b'\n')
+    with pytest.raises(ValueError):
+        load_recording(str(path))
@@ -0,0 +1,45 @@
+'''Host capacity as the scheduler reads it.'''
+
+import libvirt     # type: ignore
+
+from vms_kvm_scheduler import MIB, query_host
+
+
+class Host():
+    ''' Connection to an idle host with 8 GiB, 6 of them page cache. '''
+    def __init__(self, stats: bool = True) -> None:
+        self.stats = stats
+
+    # pylint: disable=invalid-name
+    @staticmethod
+    def getInfo() -> list:
+        ''' 8 GiB and 4 CPUs. '''
+        return ['x86_64', 8192, 4]
+
+    @staticmethod
+    def listAllDomains(_flags: int) -> list:
+        ''' No domains. '''
+        return []
+
+    def getMemoryStats(self, _cell: int, _flags: int) -> dict:
+        ''' Node memory in KiB, if the driver has it. '''
+        if not self.stats:
+            raise libvirt.libvirtError('not supported')
+        return {'total': 8 * 1024 * 1024, 'free': 1024 * 1024,
+                'buffers': 0, 'cached': 6 * 1024 * 1024}
+
+    @staticmethod
+    def getFreeMemory() -> int:
+        ''' MemFree alone. '''
+        return 1024 * MIB
+
+
+def test_page_cache_is_available():
+    ''' Reclaimable page cache counts as available memory. '''
+    assert query_host(Host(), 'test:///default').free_memory == 7168 * MIB
+
+
+def test_without_memory_statistics():
+    ''' Drivers without statistics fall back to the free memory. '''
+    assert query_host(Host(stats=False),
+                      'test:///default').free_memory == 1024 * MIB
@@ -0,0 +1,65 @@
+'''Typing DCL commands ahead and falling back when an echo is lost.'''
+
+import asyncio
+
+import vms_kvm_dialogue as dialogue
+from vms_kvm_replay import FakeConnection, FakeStream, load_profile
+
+PROMPT = b'\r\n\x00$ '
+
+
+def dcl_console() -> dialogue.Console:
+    ''' Return a console at the DCL prompt before the MODPARAMS writes. '''
+    target, profile = load_profile({'profile': 'v923', 'settings': {
+        'name': 'robin', 'decnet': '1.13'}})
+    console = dialogue.Console(FakeConnection(target.name), target, profile)
+    console.session.stream = FakeStream()
+    console.set_phase('DCL')
+    console.typeahead = True
+    return console
+
+
+def test_lost_echo_clears_typeahead(monkeypatch):
+    ''' The commands left in the type-ahead buffer are discarded before
+        they are sent again one per prompt. '''
+    monkeypatch.setattr(dialogue, 'TYPEAHEAD_TIMEOUT', 1.0)
+    console = dcl_console()
+    commands = console.profile.phases['DCL'].prompts[0][2]
+    first = next(index for index, cmd in enumerate(commands)
+                 if cmd.startswith(b'open/'))
+    batch = console.profile.typeahead_batch(commands[first:])
+    assert len(batch) > 2
+    console.prompt_index['DOLLAR'] = first + len(batch)
+
+    async def run() -> None:
+        # Only the first command is echoed, the second prompt is not
+        # followed by the echo of the second.
+        console.session.received(batch[0] + b'\r\n' + PROMPT + PROMPT)
+        await dialogue.send_typeahead(console, batch)
+
+    asyncio.run(run())
+    sent = console.session.stream.sent
+    assert sent[0] == b''.join(cmd + b'\r' for cmd in batch)
+    assert sent[-1] == dialogue.CTRL_X + b'\r'
+    assert console.prompt_index['DOLLAR'] == first + 1
+    assert not console.typeahead
+
+
+def test_echoes_seen():
+    ''' A batch whose echoes all come back is sent once. '''
+    console = dcl_console()
+    commands = console.profile.phases['DCL'].prompts[0][2]
+    first = next(index for index, cmd in enumerate(commands)
+                 if cmd.startswith(b'open/'))
+    batch = console.profile.typeahead_batch(commands[first:])
+    console.prompt_index['DOLLAR'] = first + len(batch)
+
+    async def run() -> None:
+        console.session.received(PROMPT.join(cmd + b'\r\n' for cmd in batch))
+        await dialogue.send_typeahead(console, batch)
+
+    asyncio.run(run())
+    assert console.session.stream.sent == [
+        b''.join(cmd + b'\r' for cmd in batch)]
+    assert console.prompt_index['DOLLAR'] == first + len(batch)
+    assert console.typeahead
@@ -0,0 +1,41 @@
+'''Resetting a stalled console and starting its setup over.'''
+
+import asyncio
+
+import vms_kvm_dialogue as dialogue
+from vms_kvm_admission import AdmissionController
+from vms_kvm_replay import FakeConnection, FakeStream, load_profile
+from vms_kvm_watchdog import Watchdog
+
+
+def test_reset_starts_over():
+    ''' The output of the dead boot is dropped and the console waits
+        for a slot before the domain is reset into a heavy phase. '''
+    target, profile = load_profile({'profile': 'v923', 'settings': {
+        'name': 'robin', 'decnet': '1.13'}})
+    console = dialogue.Console(FakeConnection(target.name), target, profile)
+    console.session.stream = FakeStream()
+    console.set_phase('DCL')
+    console.prompt_index['DOLLAR'] = 3
+    resets = []
+    console.domain.reset = resets.append
+
+    async def run() -> None:
+        console.admission = AdmissionController('test:///default', None,
+                                                limit=1)
+        console.admission.holders.add('kite')
+        console.session.received(b'\r\n\x00$ ')
+        task = asyncio.create_task(Watchdog.reset(console))
+        await asyncio.sleep(0.05)
+        assert not resets
+        console.admission.holders.discard('kite')
+        await console.admission.notify()
+        await asyncio.wait_for(task, 1)
+
+    asyncio.run(run())
+    assert console.phase.name == profile.start
+    assert profile.start in profile.heavy_phases
+    assert console.admission.holders == {'robin'}
+    assert resets == [0]
+    assert console.prompt_index['DOLLAR'] == 0
+    assert not console.session.inbox and not len(console.session.buffer)